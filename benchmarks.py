@@ -7,6 +7,11 @@ import threading
 from itertools import zip_longest, chain, islice
 import contextlib
 import queue
+import time
+import random
+import tempfile
+import gzip
+import struct
 
 import grpc
 from OpenSSL import crypto
@@ -19,6 +24,11 @@ import ed25519
 import schnorr
 import common
 import cheats
+import cryptopu
+import pep3_collect
+import database
+import storage_facility
+import sql
 
 class Benchmarks:
     def __init__(self, args):
@@ -46,9 +56,10 @@ class Benchmarks:
             self.args.secrets = secrets
 
         with contextlib.ExitStack() as exitstack:
+            self.servers = None
             if self.args.run_servers:
-                g = exitstack.enter_context(pep3.RunServers(self.args.config, 
-                        self.args.secrets, 
+                self.servers = exitstack.enter_context(pep3.RunServers(
+                        self.args.config, self.args.secrets, 
                         executor_type=self.args.executor_type))
 
             self.investigator = pep3.PepContext(self.args.config, 
@@ -92,6 +103,127 @@ class Benchmarks:
             for feedback in gen:
                 pass
 
+    def benchmark_store_sf(self, args):
+        parser = argparse.ArgumentParser("... store_sf")
+        parser.add_argument("--batchsize",
+                help="number of flowrecords per batch",
+                type=int, default="1024")
+        parser.add_argument("--batches",
+                help="number of batches",
+                type=int, default="10")
+        parser.add_argument("--duplicates",
+                help="fraction of flowrecords that repeat an earlier one",
+                type=float, default="0")
+        args = parser.parse_args(args)
+
+        # prepare StoreRequests encrypted for the storage facility
+        pu = self.collector._cryptopu
+        sf_key = cheats.public_key(self.args.secrets, 
+                b"PEP3 storage_facility", 'pseudonym')
+        requests = []
+        flowrecords = [] # the ones not duplicating an earlier one
+        for i in range(args.batches):
+            names = [ pep3_pb2.Pseudonymizable(data=os.urandom(32)) 
+                    for j in range(2*args.batchsize) ]
+            pu.elligator(names)
+            cryptopu.split_data(names, pu.encrypt_packed(
+                cryptopu.join_data(names, 32), sf_key), 96)
+            for name in names:
+                name.state = pep3_pb2.Pseudonymizable.ENCRYPTED_PSEUDONYM
+
+            request = pep3_pb2.StoreRequest()
+            request.id = os.urandom(16)
+            for j in range(args.batchsize):
+                flowrecord = request.records.add()
+                if flowrecords and random.random() < args.duplicates:
+                    flowrecord.CopyFrom(random.choice(flowrecords))
+                    continue
+                flowrecord.source_ip.CopyFrom(names[2*j])
+                flowrecord.destination_ip.CopyFrom(names[2*j+1])
+                flowrecord.anonymous_part.number_of_bytes = 123
+                flowrecord.anonymous_part.number_of_packets = 456
+                flowrecords.append(flowrecord)
+            requests.append(request)
+
+
+        # modes are pairs (batched_decryption, pseudonym_index)
+        modes = [ None ]
+        if self.servers != None:
+            store_processor = self.servers.contexts[("storage_facility",
+                None)].grpc_servicer.store_processor
+            modes = [ (False, None), (True, None), (True, 
+                storage_facility.PseudonymIndex(args.batches*args.batchsize)) ]
+
+        for mode in modes:
+            if mode != None:
+                store_processor.batched_decryption, \
+                        store_processor.pseudonym_index = mode
+            for request in requests:
+                request.id = os.urandom(16)
+
+            start = time.time()
+            for feedback in self.collector.connect_to("storage_facility")\
+                    .Store(iter(requests)):
+                assert(len(feedback.errors)==0)
+            elapsed = time.time() - start
+
+            if mode == None:
+                name = "configured decryption"
+            else:
+                name = "batched decryption" if mode[0] \
+                        else "cached decryption"
+                if mode[1] != None:
+                    name += " with pseudonym index (skipped " \
+                        f"{args.batches*args.batchsize-len(mode[1])} " \
+                        "duplicates)"
+            print(f"{name}: "
+                    f"{args.batches*args.batchsize/elapsed:.1f} "
+                    "flows/second")
+
+    def benchmark_store_database(self, args):
+        parser = argparse.ArgumentParser("... store_database")
+        parser.add_argument("--batchsize",
+                help="number of flowrecords per batch",
+                type=int, default="1024")
+        parser.add_argument("--batches",
+                help="number of batches",
+                type=int, default="64")
+        args = parser.parse_args(args)
+
+        sf = pep3.PepContext(self.args.config, self.args.secrets,
+                "storage_facility", None, allow_enrollment=False)
+
+        requests = []
+        for i in range(args.batches):
+            request = pep3_pb2.StoreRequest()
+            for j in range(args.batchsize):
+                flowrecord = request.records.add()
+                flowrecord.source_ip.data = os.urandom(32)
+                flowrecord.destination_ip.data = os.urandom(32)
+                flowrecord.anonymous_part.number_of_bytes = 123
+                flowrecord.anonymous_part.number_of_packets = 456
+            requests.append(request)
+
+        # one stream per request is what the storage facility does when
+        # its queue holds only one request at a time
+        for name, streams in (
+                ("one request per stream", [ [ request ] 
+                    for request in requests ]),
+                ("all requests in one stream", [ requests ])):
+            for request in requests:
+                request.id = os.urandom(16)
+
+            start = time.time()
+            for stream in streams:
+                for feedback in sf.connect_to("database")\
+                        .Store(iter(stream)):
+                    pass
+            elapsed = time.time() - start
+
+            print(f"{name}: "
+                    f"{args.batches*args.batchsize/elapsed:.1f} "
+                    "flows/second")
+
     def _benchmark_store_several_generator(self, args):
         for i in range(args.batches):
             request = pep3_pb2.StoreRequest()
@@ -109,9 +241,153 @@ class Benchmarks:
         
             yield request
 
+    def benchmark_relocalize(self, args):
+        parser = argparse.ArgumentParser("... relocalize")
+        parser.add_argument("--batchsize",
+                help="number of names per batch",
+                type=int, default="1024")
+        parser.add_argument("--batches",
+                help="number of batches to relocalize",
+                type=int, default="10")
+        parser.add_argument("--subbatchsize",
+                help="size of the sub-batches used by pipelined "
+                "relocalization",
+                type=int, default="256")
+        parser.add_argument("--threads",
+                help="numbers of crypto threads of the peers to try "
+                "(requires --run-servers); as configured when omitted",
+                type=int, nargs="*", default=[])
+        args = parser.parse_args(args)
+
+        peers = []
+        if self.servers != None:
+            peers = [ context for (type_name, instance_name), context
+                    in self.servers.contexts.items() if type_name=="peer" ]
+        elif args.threads:
+            print("--threads requires --run-servers")
+            return
+
+        collector = pep3.PepContext(self.args.config, self.args.secrets,
+                "collector", None)
+        warrant = self.args.config.collector.warrants.to_sf
+
+        batches = []
+        for i in range(args.batches):
+            names = [ pep3_pb2.Pseudonymizable(data=os.urandom(16),
+                state=pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME) 
+                    for j in range(args.batchsize) ]
+            collector.pseudonymize(names)
+            batches.append(names)
+
+        for threads in args.threads or [ None ]:
+            suffix = ""
+            if threads != None:
+                suffix = f" ({threads} crypto threads)"
+                for peer in peers:
+                    peer._cryptopu.shutdown()
+                    peer._cryptopu = cryptopu.CryptoPU(
+                            number_of_threads=threads)
+
+            for mode, subbatchsize in (("sequential", 0), 
+                    ("pipelined", args.subbatchsize)):
+                start = time.time()
+
+                for names in batches:
+                    names = [ pep3_pb2.Pseudonymizable(data=name.data,
+                        state=name.state) for name in names ]
+                    collector.relocalize(names, warrant, 
+                            subbatchsize=subbatchsize)
+
+                elapsed = time.time() - start
+                print(f"{mode}{suffix}: "
+                        f"{args.batches*args.batchsize/elapsed:.1f} "
+                        "names/second")
+
+    def benchmark_query(self, args):
+        parser = argparse.ArgumentParser("... query")
+        parser.add_argument("--rows",
+                help="number of rows in the result",
+                type=int, default="4096")
+        parser.add_argument("--ips",
+                help="number of distinct ip addresses in the result; "
+                "all are distinct when 0",
+                type=int, default="0")
+        args = parser.parse_args(args)
+
+        sf = pep3.PepContext(self.args.config, self.args.secrets,
+                "storage_facility", None, allow_enrollment=False)
+
+        ips = [ ed25519.Point.lizard(os.urandom(16)).pack() 
+                for i in range(args.ips) ]
+        random_ip = lambda: random.choice(ips) if ips \
+                else ed25519.Point.lizard(os.urandom(16)).pack()
+
+        request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        for i in range(args.rows):
+            flowrecord = request.records.add()
+            flowrecord.source_ip.data = random_ip()
+            flowrecord.destination_ip.data = random_ip()
+        for feedback in sf.connect_to("database").Store(iter([request])):
+            pass
+
+        # the servers read the configuration when handling a query, so
+        # we can only change query_chunks_in_flight if we run them
+        chunks_in_flight = [ self.args.config.query_chunks_in_flight ]
+        if self.servers != None:
+            chunks_in_flight = [ 0, chunks_in_flight[0] ]
+
+        # 32 rows per chunk is what the database used to send
+        for name, max_rows in (("32 rows per chunk", 32),
+                ("default chunks", 0)):
+            for in_flight in chunks_in_flight:
+                self.args.config.query_chunks_in_flight = in_flight
+
+                query = pep3_pb2.SqlQuery(max_rows_per_chunk=max_rows)
+                query.query = """SELECT peped_flows.p_src_ip, 
+                    peped_flows.p_dst_ip FROM peped_flows"""
+
+                start = time.time()
+                rows = 0
+                for chunk in self.investigator.connect_to("investigator")\
+                        .Query(query):
+                    rows += len(chunk.rows)
+                elapsed = time.time() - start
+
+                assert(rows>=args.rows)
+                print(f"{name}, {in_flight} chunks in flight: "
+                        f"{rows/elapsed:.1f} rows/second")
+
     def benchmark_depseudonymize(self, args):
-        ip = os.urandom(16)
+        warrant = self._create_warrant(os.urandom(16))
+
+        result = self.investigator.connect_to("investigator")\
+                .Depseudonymize(warrant)
+
+    def benchmark_depseudonymize_bulk(self, args):
+        parser = argparse.ArgumentParser("... depseudonymize_bulk")
+        parser.add_argument("--count",
+                help="number of warrants",
+                type=int, default="100")
+        args = parser.parse_args(args)
+
+        ips = [ os.urandom(16) for i in range(args.count) ]
+        warrants = [ self._create_warrant(ip) for ip in ips ]
+        investigator = self.investigator.connect_to("investigator")
 
+        start = time.time()
+        results = [ investigator.Depseudonymize(warrant) 
+                for warrant in warrants ]
+        elapsed = time.time() - start
+        assert([ result.data for result in results ] == ips)
+        print(f"one by one: {args.count/elapsed:.1f} warrants/second")
+
+        start = time.time()
+        results = list(investigator.DepseudonymizeBulk(iter(warrants)))
+        elapsed = time.time() - start
+        assert([ result.data for result in results ] == ips)
+        print(f"in bulk: {args.count/elapsed:.1f} warrants/second")
+
+    def _create_warrant(self, ip):
         # manually compute investigator-local pseudonym
         pseudonym_secrets = {}
         for peer_secrets in self.args.secrets.peers.values():
@@ -142,14 +418,179 @@ class Benchmarks:
                     self.args.secrets.root_certificate_keys.warrants),
                 warrant.act.SerializeToString(), 'sha256')
 
-        result = self.investigator.connect_to("investigator")\
-                .Depseudonymize(warrant)
+        return warrant
+
+    def benchmark_parse_csv(self, args):
+        parser = argparse.ArgumentParser("... parse_csv")
+        parser.add_argument("--records",
+                help="number of lines in the generated csv file",
+                type=int, default="100000")
+        parser.add_argument("--batchsize",
+                type=int, default="512")
+        args = parser.parse_args(args)
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            self._write_csv(f, args.records)
+
+            for name, batches in (
+                    ("rowwise", pep3_collect.rowwise_batches),
+                    ("columnar", lambda inputf, handlers, batchsize:
+                        pep3_collect.columnar_batches(inputf, f.name,
+                            handlers, batchsize))):
+                with open(f.name, "rb") as inputf:
+                    handlers = pep3_collect.parse_header(f.name,
+                            inputf.readline().decode('utf-8'))
+                    start = time.time()
+                    for request in batches(inputf, handlers, 
+                            args.batchsize):
+                        pass
+                    elapsed = time.time() - start
+                print(f"{name}: {args.records/elapsed:.0f} records/second")
+
+    def benchmark_read_formats(self, args):
+        parser = argparse.ArgumentParser("... read_formats")
+        parser.add_argument("--records",
+                help="number of flow records",
+                type=int, default="100000")
+        parser.add_argument("--batchsize",
+                type=int, default="512")
+        args = parser.parse_args(args)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "flows.csv")
+            with open(path, "w") as f:
+                self._write_csv(f, args.records)
+
+            with open(path, "rb") as f:
+                csv = f.read()
+                f.seek(0)
+                requests = list(pep3_collect.read_batches(f, path, "csv",
+                    args.batchsize))
+            records = [ record for request in requests 
+                    for record in request.records ]
+
+            files = { 
+                "flows.csv": csv,
+                "flows.csv.gz": gzip.compress(csv),
+                "flows.flowrecords": b"".join([ 
+                    bytes([record.ByteSize()]) 
+                    + record.SerializeToString() for record in records ]),
+                "flows.bin": b"".join([ struct.pack(">16s16sQQIIHHB3x",
+                    record.source_ip.data, record.destination_ip.data,
+                    record.anonymous_part.start_time,
+                    record.anonymous_part.end_time,
+                    record.anonymous_part.number_of_packets,
+                    record.anonymous_part.number_of_bytes,
+                    record.anonymous_part.source_port,
+                    record.anonymous_part.destination_port,
+                    record.anonymous_part.protocol) 
+                    for record in records ]),
+            }
+
+            for name, data in files.items():
+                path = os.path.join(tmpdir, name)
+                with open(path, "wb") as f:
+                    f.write(data)
+
+                with contextlib.ExitStack() as stack:
+                    start = time.time()
+                    inputf = pep3_collect.open_input(path, "auto", stack)
+                    for request in pep3_collect.read_batches(inputf, path,
+                            "auto", args.batchsize):
+                        pass
+                    elapsed = time.time() - start
+                print(f"{name}: {args.records/elapsed:.0f} records/second")
+
+    def _write_csv(self, f, records):
+        f.write("serial,src_ip,dst_ip,sport,dport,protocol,tstart,tend,"
+                "packets,bytes,tcp_flags\n")
+        for i in range(records):
+            ip = lambda: ".".join(str(random.randrange(256)) 
+                    for j in range(4))
+            f.write(f"{i},{ip()},{ip()},{random.randrange(2**16)},"
+                    f"{random.randrange(2**16)},6,"
+                    f"{1500000000000+i},{1500000000100+i},"
+                    f"{random.randrange(1,100)},"
+                    f"{random.randrange(40,10**6)},0\n")
+        f.flush()
+
+    def benchmark_check_query(self, args):
+        parser = argparse.ArgumentParser("... check_query")
+        parser.add_argument("--count",
+                help="number of checks",
+                type=int, default="1000")
+        args = parser.parse_args(args)
+
+        db_desc = database.Database.load_db_desc_from(self.args.config)
+        param_desc = { 'tstart': 'plain', 'tend': 'plain', 
+                'ip': 'pseudonymized' }
+        query = """SELECT peped_flows.p_dst_ip, peped_flows.protocol,
+                peped_flows.dst_port, SUM(peped_flows.packets),
+                SUM(peped_flows.bytes)
+            FROM peped_flows
+            WHERE peped_flows.start_time > :tstart 
+                AND peped_flows.end_time < :tend
+                AND (peped_flows.p_src_ip = :ip 
+                    OR peped_flows.p_dst_ip = :ip)
+            GROUP BY peped_flows.p_dst_ip, peped_flows.protocol, 
+                peped_flows.dst_port
+            ORDER BY SUM(peped_flows.bytes) DESC LIMIT 10"""
+
+        for name, check in (
+                ("uncached", lambda: sql.QueryChecker(db_desc, 
+                    param_desc).parse(query)),
+                ("cached", lambda: sql.check_query(db_desc, 
+                    param_desc, query))):
+            start = time.time()
+            for i in range(args.count):
+                check()
+            elapsed = time.time() - start
+            print(f"{name}: {args.count/elapsed:.1f} checks/second")
 
     def benchmark_enroll(self, args):
         pep3.PepContext(self.args.config, 
                 self.args.secrets, "investigator", None,
                 allow_enrollment=True).public_keys
 
+    def benchmark_scalar_multiplication(self, args):
+        parser = argparse.ArgumentParser("... scalar_multiplication")
+        parser.add_argument("--count",
+                help="number of multiplications per method",
+                type=int, default="100")
+        args = parser.parse_args(args)
+
+        B = ed25519.Point.B()
+        A = ed25519.Point.random()
+        scalars = [ ed25519.scalar_random() for i in range(args.count) ]
+
+        for name, f in (
+                ("B, double-and-add", lambda s: 
+                    ed25519.double_and_add_multiplication(B, s, 
+                        ed25519.Point.Zero())),
+                ("B, fixed base table", ed25519.Point.B_times),
+                ("A, double-and-add", lambda s: 
+                    ed25519.double_and_add_multiplication(A, s, 
+                        ed25519.Point.Zero())),
+                ("A, window", lambda s: 
+                    ed25519.window_multiplication(A, s)),
+                ("A, cached table", lambda s: A*s)):
+            start = time.time()
+            for s in scalars:
+                f(s)
+            elapsed = time.time() - start
+            print(f"{name}: {1000*elapsed/args.count:.3f} ms")
+
+        a = ed25519.scalar_random()
+        M = ed25519.Point.random()
+        proof = schnorr.DHTProof.create(a, M)
+        A, N = ed25519.Point.B_times(a), M*a
+
+        start = time.time()
+        for i in range(args.count):
+            assert(proof.is_valid_proof_for(A, M, N))
+        elapsed = time.time() - start
+        print(f"DHTProof verification: {1000*elapsed/args.count:.3f} ms")
+
     def benchmark_certified_component(self, args):
         for i in range(1):
             k = ed25519.scalar_random()
@@ -0,0 +1,22 @@
+import os
+
+from cffi import FFI
+import os.path, inspect
+
+ffi = FFI()
+
+curdir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+
+header = None
+source = None
+
+with open(os.path.join(curdir, "flows.h")) as f:
+    header = f.read()
+with open(os.path.join(curdir, "flows.c")) as f:
+    source = header + f.read()
+            
+ffi.set_source("_flows",  source, extra_compile_args=["-O3", "-march=native", "-fomit-frame-pointer", "-std=c99"])
+ffi.cdef(header)
+
+ffi.compile()
@@ -5,30 +5,73 @@ import pep3_pb2_grpc
 
 import common
 import xthreading
+import pseudonymstore
 import xqueue
 import xos
+import xasyncio
 import error
 import traceback
 
 import queue
 import functools
+import threading
+import concurrent.futures
 
 class Collector(pep3_pb2_grpc.CollectorServicer):
     def __init__(self, pep):
         self.pep = pep
         self.cache = xthreading.Cache(
                 self._process_raw_ips, pep.global_config.batchsize)
+
+        # optional persistent tier below self.cache
+        self.store = None
+        if pep.config.pseudonym_store != "":
+            self.store = pseudonymstore.PseudonymStore(
+                    pep.config.pseudonym_store, 
+                    pep.config.pseudonym_store_size or 2**20,
+                    self._store_fingerprint())
+            self.cache.preload(reversed(self.store.most_recently_used(
+                pep.global_config.batchsize**2)))
         self.queue = xqueue.Queue()
+        # the StoreRequests not yet acknowledged by the storage facility
+        self.window = xthreading.Window(pep.config.max_requests_in_flight,
+                pep.config.max_records_in_flight)
         self.shutdown_called = False
         self.request_id_to_feedback_queue = {}
 
-        self.process_queue_fut \
-                = self.pep._executor.submit(self._process_queue_try)
+        # the queue is emptied by number_of_streams threads, each 
+        # with its own Store stream to the storage facility
+        number_of_streams = max(pep.config.number_of_streams, 1)
+        self.number_of_streams = number_of_streams
+        # to make sure a flush ends each stream exactly once, see 
+        # _flush_streams
+        self.flush_barrier = threading.Barrier(number_of_streams)
+        self.streams_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=number_of_streams,
+                thread_name_prefix="Collector streams")
+        self.process_queue_futs = [ 
+                self.streams_executor.submit(self._process_queue_try)
+                for i in range(number_of_streams) ]
 
     def shutdown(self):
         self.shutdown_called = True
+        self.window.stop()
         self.queue.stop()
-        self.process_queue_fut.result() # wait
+        self.flush_barrier.abort()
+        for fut in self.process_queue_futs:
+            fut.result() # wait
+        self.streams_executor.shutdown()
+        if self.store != None:
+            self.store.close()
+
+    # the pseudonyms in the store are only valid for the current 
+    # components (i.e. secrets) of the peers, and the current warrant.
+    def _store_fingerprint(self):
+        config = pep3_pb2.Configuration()
+        config.components.MergeFrom(self.pep.global_config.components)
+        config.collector.warrants.to_sf.CopyFrom(
+                self.pep.config.warrants.to_sf)
+        return common.sha256(config.SerializeToString(deterministic=True))
 
     def _process_queue_try(self):
         with xos.terminate_on_exception("Collector: "
@@ -50,6 +93,7 @@ class Collector(pep3_pb2_grpc.CollectorServicer):
                                 "a request id not known to us; reraising "
                                 "exception, but not sure if it will register")
                         raise
+                    self.window.release(store_feedback.stored_id)
                     feedback_queue.put(store_feedback)
         except grpc.RpcError as e:
             assert(isinstance(e, grpc.Call))
@@ -72,21 +116,47 @@ class Collector(pep3_pb2_grpc.CollectorServicer):
             if stopped:
                 return
             if item==None: # flush
+                # wait for the other streams to get their flush too
+                try:
+                    self.flush_barrier.wait()
+                except threading.BrokenBarrierError:
+                    pass # we're shutting down
                 return
             else:
                 yield item
 
+    # Ends all streams to the storage facility (which are then reopened,)
+    # after the requests already on the queue, so that the storage 
+    # facility flushes its cache too.  As each stream waits for the others
+    # after getting its flush, no stream gets two.
+    def _flush_streams(self):
+        for i in range(self.number_of_streams):
+            self.queue.put(None)
+
     def _process_raw_ips(self, batch):
+        stored = {}
+        if self.store != None:
+            stored = self.store.get_many(batch)
+
         pseudonymizables = []
         for raw_ip in batch:
+            if raw_ip in stored:
+                continue
             p = pep3_pb2.Pseudonymizable()
             p.data = raw_ip
             p.state = pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME
             pseudonymizables.append(p)
-        self.pep.pseudonymize(pseudonymizables)
-        self.pep.relocalize(pseudonymizables, 
-                self.pep.config.warrants.to_sf)
-        return [ p for p in pseudonymizables ]
+
+        if len(pseudonymizables)>0:
+            raw_ips = [ p.data for p in pseudonymizables ]
+            self.pep.pseudonymize(pseudonymizables)
+            self.pep.relocalize(pseudonymizables, 
+                    self.pep.config.warrants.to_sf)
+            if self.store != None:
+                self.store.put_many(zip(raw_ips, pseudonymizables))
+            stored.update(zip(raw_ips, pseudonymizables))
+
+        return [ stored[raw_ip] for raw_ip in batch ]
 
     def _handle_request_with_cached_ips(self, request, results):
         for flowrecord in request.records:
@@ -102,6 +172,7 @@ class Collector(pep3_pb2_grpc.CollectorServicer):
             except Exception as e:
                 feedback_queue = self.request_id_to_feedback_queue.pop(
                         request.id)
+                self.window.release(request.id)
                 feedback_queue.put(pep3_pb2.StoreFeedback(
                     stored_id=request.id,
                     errors=[traceback.format_exc()]))
@@ -121,36 +192,70 @@ class Collector(pep3_pb2_grpc.CollectorServicer):
         feedback_queue = queue.SimpleQueue()
 
         for request in request_it:
-            
-            if request.id in self.request_id_to_feedback_queue:
-                raise ValueError("request id already in use")
-
-            self.request_id_to_feedback_queue[request.id] = feedback_queue
+            self._store_request(request, context, feedback_queue)
             expected_responses += 1
-
-            raw_ips = []
-            
-            for flowrecord in request.records:
-                common.check_is_plaintext(flowrecord.source_ip, context)
-                common.check_is_plaintext(flowrecord.destination_ip, context)
-                
-                raw_ips.append(flowrecord.source_ip.data)
-                raw_ips.append(flowrecord.destination_ip.data)
-
-            self.cache.request(raw_ips,
-                    functools.partial(
-                        self._handle_request_with_cached_ips, request))
             
-        self.cache.flush()
-        self.queue.put(None) # flush storage facility too
+        self._flush()
         
         while expected_responses > 0:
             store_feedback = feedback_queue.get()
             expected_responses -= 1
             yield store_feedback
 
+    # like Store, but runs on the event loop (see xasyncio.py,) so that
+    # it does not occupy a thread while waiting for requests or feedback
+    async def Store_async(self, request_it, context):
+        context = xasyncio.SyncContext(context)
+        executor = self.pep._executor
+        await xasyncio.run(executor, common.authenticate, context, 
+                [b"PEP3 collector"])
 
+        expected_responses = 0
+        feedback_queue = xasyncio.Queue()
+
+        async for request in request_it:
+            await xasyncio.run(executor, self._store_request, 
+                    request, context, feedback_queue)
+            expected_responses += 1
+
+        await xasyncio.run(executor, self._flush)
+
+        while expected_responses > 0:
+            store_feedback, stopped = await feedback_queue.get()
+            expected_responses -= 1
+            yield store_feedback
+
+    # passes on the request of a Store call to self.cache, after which
+    # its StoreFeedback is put on the feedback_queue
+    def _store_request(self, request, context, feedback_queue):
+        if request.id in self.request_id_to_feedback_queue:
+            raise ValueError("request id already in use")
+
+        # check the request before it takes up room in the window
+        raw_ips = []
+        for flowrecord in request.records:
+            common.check_is_plaintext(flowrecord.source_ip, context)
+            common.check_is_plaintext(flowrecord.destination_ip, context)
             
+            raw_ips.append(flowrecord.source_ip.data)
+            raw_ips.append(flowrecord.destination_ip.data)
+
+        # wait until there's room in the window;  as the requests 
+        # in flight might be waiting for more ips to fill a batch,
+        # we flush first.
+        if not self.window.acquire(request.id, len(request.records),
+                block=False):
+            self._flush()
+            if not self.window.acquire(request.id, len(request.records)):
+                context.abort(grpc.StatusCode.UNAVAILABLE,
+                        "collector is shutting down")
 
+        self.request_id_to_feedback_queue[request.id] = feedback_queue
 
+        self.cache.request(raw_ips,
+                functools.partial(
+                    self._handle_request_with_cached_ips, request))
 
+    def _flush(self):
+        self.cache.flush()
+        self._flush_streams() # flush storage facility too
@@ -8,6 +8,7 @@ import queue
 import sys
 import collections
 import contextlib
+import time
 
 import pep3_pb2
 import grpc
@@ -178,36 +179,178 @@ class iterqueue:
 # Given an iterator, return basically the same iterator, but under the hood
 # it uses a separate thread to get the next items as quickly as possible,
 # storing them in an internal queue.
+#
+# The queue holds at most maxitems items, and the items in it have a total
+# size of at most maxbytes (but for a single item,) where the size of an
+# item is given by sizeof;  when the queue is full, the thread waits.
+# By default the queue is unbounded.
+#
+# The returned iterator may be shared by several threads (e.g. gRPC
+# streams), which are served in the order in which they asked for an item.
+# The time the thread spent waiting for room in the queue is kept in 
+# producer_stall, and the total time spent by consumers waiting for an
+# item in consumer_stall (both in seconds.)
 class chuck:
-    def __init__(self, it):
-        self._queue = queue.SimpleQueue()
+    def __init__(self, it, maxitems=None, maxbytes=None, sizeof=None):
+        assert(maxitems==None or maxitems>0)
+        assert((maxbytes==None) == (sizeof==None))
+        self.maxitems = maxitems
+        self.maxbytes = maxbytes
+        self.producer_stall = 0.0
+        self.consumer_stall = 0.0
+
+        self._sizeof = sizeof
+        self._cond = threading.Condition()
+        self._queue = collections.deque() # of (item, size) pairs
+        self._nbytes = 0
+        self._exception = None # raised once the queue is empty
+        self._closed = False
+        self._tickets = 0 # handed out to consumers
+        self._served = 0 # number of consumers served
+
         self._thread = threading.Thread(
                 target=self._threads_work, 
-                kwargs={
-                    "it": iter(it), 
-                    "queue": self._queue}
-        ).start()
+                kwargs={ "it": iter(it) },
+                daemon=True)
+        self._thread.start()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        item, exception  = self._queue.get()
-        if exception != None:
-            self._queue.put_nowait( (None, exception) )
-            raise exception
-        return item
+        with self._cond:
+            ticket = self._tickets
+            self._tickets += 1
 
-    def size(self):
-        return self._queue.qsize()
+            start = None
+            while self._served != ticket or (len(self._queue)==0
+                    and self._exception==None):
+                if start==None:
+                    start = time.monotonic()
+                self._cond.wait()
+            if start!=None:
+                self.consumer_stall += time.monotonic() - start
+
+            self._served += 1
+            self._cond.notify_all()
 
-    @staticmethod
-    def _threads_work(it, queue):
+            if len(self._queue)==0:
+                raise self._exception
+
+            item, size = self._queue.popleft()
+            self._nbytes -= size
+            return item
+
+    def size(self):
+        return len(self._queue)
+
+    def nbytes(self):
+        return self._nbytes
+
+    # stops reading from the iterator (for when there are no consumers
+    # anymore;) what's left in the queue can still be consumed
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _is_full(self, size):
+        if len(self._queue)==0:
+            return False
+        if self.maxitems!=None and len(self._queue)>=self.maxitems:
+            return True
+        if self.maxbytes!=None and self._nbytes+size>self.maxbytes:
+            return True
+        return False
+
+    def _threads_work(self, it):
         while True:
             try:
                 item = next(it)
+                size = 0 if self._sizeof==None else self._sizeof(item)
             except Exception as e:
-                queue.put_nowait( (None, e) )
+                exception = e
                 break
-            queue.put_nowait( (item, None) )
 
+            with self._cond:
+                start = None
+                while self._is_full(size) and not self._closed:
+                    if start==None:
+                        start = time.monotonic()
+                    self._cond.wait()
+                if start!=None:
+                    self.producer_stall += time.monotonic() - start
+
+                if self._closed:
+                    exception = StopIteration()
+                    break
+
+                self._queue.append( (item, size) )
+                self._nbytes += size
+                self._cond.notify_all()
+
+        with self._cond:
+            self._exception = exception
+            self._cond.notify_all()
+
+
+
+# Iterates over the responses of the given streaming gRPC call, while 
+# reading up to maxitems responses ahead on another thread (when 
+# maxitems>0,) and cancels the call when the iteration stops early.
+def read_ahead(call, maxitems):
+    if maxitems==0:
+        yield from call
+        return
+
+    responses = chuck(call, maxitems=maxitems)
+    try:
+        yield from responses
+    finally:
+        responses.close()
+        call.cancel()
+
+
+# A bounded, thread-safe cache for the values of an expensive function;
+# the least recently used values are forgotten first.
+class LRUCache:
+    def __init__(self, maxsize):
+        assert(maxsize>0)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._values = collections.OrderedDict()
+        self._generation = 0 # increased by clear()
+
+    # Returns the value stored under key, storing compute() under key
+    # first if there is none.  As compute is called without holding the
+    # lock, it might be called more than once for the same key.
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                self._values.move_to_end(key)
+                return self._values[key]
+            self.misses += 1
+            generation = self._generation
+
+        value = compute()
+
+        with self._lock:
+            # don't store values computed before the last clear()
+            if generation==self._generation:
+                self._values[key] = value
+                self._values.move_to_end(key)
+                if len(self._values)>self.maxsize:
+                    self._values.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._generation += 1
+
+    def __len__(self):
+        return len(self._values)
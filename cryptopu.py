@@ -1,3 +1,6 @@
+import concurrent.futures
+import os
+
 import _ristretto as ristretto
 import ed25519
 import schnorr
@@ -6,167 +9,172 @@ class InvalidArgument(Exception):
     pass
 
 class CryptoPU:
-    def rsk(self, pseudonyms, k, s, rs):
-        n = len(pseudonyms)
-        assert(n==len(rs))
-
-        if n==0:
-            return;
-
-        # fill cs and ck
-        cs = ristretto.ffi.new("group_scalar*")
-        ck = ristretto.ffi.new("group_scalar*")
-
-        assert(ristretto.lib.group_scalar_unpack(cs, 
-            ed25519.scalar_pack(s))==0)
+    # The functions of _ristretto release the GIL, so by splitting a batch
+    # over number_of_threads threads the work is done on as many cores.
+    def __init__(self, number_of_threads=1):
+        self._number_of_threads = max(number_of_threads, 1)
+        self._executor = None
+        if self._number_of_threads > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._number_of_threads,
+                    thread_name_prefix="CryptoPU")
+
+    def shutdown(self):
+        if self._executor != None:
+            self._executor.shutdown()
+
+    # calls fn(start, count) for consecutive ranges covering range(n),
+    # one range per thread
+    def _in_parallel(self, fn, n):
+        if self._executor == None or n < 2:
+            fn(0, n)
+            return
+
+        count = -(-n // self._number_of_threads) # rounded up
+        futs = [ self._executor.submit(fn, start, min(count, n-start))
+                for start in range(0, n, count) ]
+        for fut in futs:
+            fut.result()
+
+    # The methods rsk, encrypt, and decrypt operate on lists of
+    # Pseudonymizables, while their *_packed counterparts operate
+    # on contiguous buffers (bytes, bytearrays, memoryviews, numpy uint8
+    # arrays, ...) holding n packed triples (96 bytes each) or points
+    # (32 bytes each), which avoids copying each name separately.
+    # The rs passed to the *_packed methods should be a buffer of
+    # n packed scalars, or None, in which case they are chosen at random.
 
-        assert(ristretto.lib.group_scalar_unpack(ck, 
-            ed25519.scalar_pack(k))==0)
-
-        # fill crs
-        crs = ristretto.ffi.new("group_scalar[]", n)
-        cerror_codes = ristretto.ffi.new("int[]", n)
-
-        ristretto.lib.group_scalars_unpack(crs, 
-                b''.join([ ed25519.scalar_pack(rs[i]) for i in range(n)  ]), 
-                cerror_codes, n)
-
-        for i in range(n):
-            assert(cerror_codes[i]==0)
-
-        ccores = ristretto.ffi.new("group_ge[]", n)
-        cblindings = ristretto.ffi.new("group_ge[]", n)
-        ctarget = ristretto.ffi.new("group_ge*")
+    def rsk(self, pseudonyms, k, s, rs):
+        assert(len(pseudonyms)==len(rs))
 
-        packed_target = None
+        triples = join_data(pseudonyms, 96)
+        self.rsk_packed(triples, k, s, 
+                b''.join([ ed25519.scalar_pack(r) for r in rs ]))
+        split_data(pseudonyms, triples, 96)
 
-        cbuf = ristretto.ffi.new("unsigned char[]", 32*n)
-        buf = ristretto.ffi.buffer(cbuf)
+    # reshuffles, rekeys and rerandomizes the triples in place;
+    # if an InvalidArgument is raised, the triples might be garbled.
+    def rsk_packed(self, triples, k, s, rs=None):
+        ctriples = ristretto.ffi.from_buffer("unsigned char[]", triples,
+                require_writable=True)
+        n = _count(ctriples, 96)
 
-        for i in range(n):
-            ristretto.ffi.memmove(cbuf+32*i, pseudonyms[i].data[0:32], 32)
-        
-        ristretto.lib.group_ges_unpack(cblindings, cbuf, cerror_codes, n)
+        if n==0:
+            return
 
-        for i in range(n):
-            if cerror_codes[i]!=0:
-                raise InvalidArgument(f"couldn't unpack the {i}th triples' "
-                        "blinding")
+        ck = _scalar(k)
+        cs = _scalar(s)
+        crs = _scalars(rs, n)
 
-        for i in range(n):
-            ristretto.ffi.memmove(cbuf+32*i, pseudonyms[i].data[32:64], 32)
+        ctarget = ristretto.ffi.new("unsigned char[]", 32)
+        ristretto.ffi.memmove(ctarget, ctriples+64, 32)
 
-        ristretto.lib.group_ges_unpack(ccores, cbuf, cerror_codes, n)
-
-        for i in range(n):
-            if cerror_codes[i]!=0:
-                raise InvalidArgument(f"couldn't unpack the {i}th triples' "
-                        "core")
-
-        for i in range(n): 
-            if i==0:
-                packed_target = pseudonyms[i].data[64:96]
-            elif pseudonyms[i].data[64:96] != packed_target:
-                raise InvalidArgument("the triples' targets are not all "
-                        f"the same; the {i}th triple's target differs "
-                        "from the target of the first triple")
-
-        if ristretto.lib.group_ge_unpack(ctarget, packed_target)!=0:
+        cge = ristretto.ffi.new("group_ge*")
+        if ristretto.lib.group_ge_unpack(cge, ctarget)!=0:
             raise InvalidArgument("couldn't unpack the target of the first "
                     "triple")
 
-        if ristretto.lib.group_ge_isneutral(ctarget)!=0: 
-            # ctarget==0
+        if ristretto.lib.group_ge_isneutral(cge)!=0: 
             raise InvalidArgument("target can't be zero")
 
-        ristretto.lib.elgamal_triples_rsk(
-                cblindings, ccores, cblindings, ccores,
-                ctarget, ctarget,
-                ck, cs, crs, n)
+        cerror_codes = ristretto.ffi.new("int[]", n)
 
-        cblindingbuf = ristretto.ffi.new("unsigned char[]", 32*n)
-        blindingbuf = ristretto.ffi.buffer(cblindingbuf)
-        ccorebuf = ristretto.ffi.new("unsigned char[]", 32*n)
-        corebuf = ristretto.ffi.buffer(ccorebuf)
-        ctargetbuf = ristretto.ffi.new("unsigned char[]", 32)
-        targetbuf = ristretto.ffi.buffer(ctargetbuf)
+        self._in_parallel(lambda start, count:
+                ristretto.lib.elgamal_triples_rsk_packed(
+                    ctriples+96*start, ctarget, ck, cs, crs+start,
+                    cerror_codes+start, count), n)
 
-        ristretto.lib.group_ge_pack(ctargetbuf, ctarget)
+        i = _first_error(cerror_codes)
+        if i==None:
+            return
 
-        ristretto.lib.group_ges_pack(cblindingbuf, cblindings, n)
-        ristretto.lib.group_ges_pack(ccorebuf, ccores, n)
+        raise InvalidArgument({
+            1: f"couldn't unpack the {i}th triples' blinding",
+            2: f"couldn't unpack the {i}th triples' core",
+            3: "the triples' targets are not all the same; "
+                f"the {i}th triple's target differs from the target "
+                "of the first triple"}[cerror_codes[i]])
 
-        for i in range(n):
-            pseudonyms[i].data = b''.join(( 
-                blindingbuf[32*i:32*(i+1)], 
-                corebuf[32*i:32*(i+1)],
-                targetbuf[:]))
+    def encrypt(self, pseudonyms, target, rs):
+        assert(len(pseudonyms)==len(rs))
 
+        triples = self.encrypt_packed(join_data(pseudonyms, 32), target,
+                b''.join([ ed25519.scalar_pack(r) for r in rs ]))
+        split_data(pseudonyms, triples, 96)
 
-    def encrypt(self, pseudonyms, target, rs):
-        n = len(pseudonyms)
-        assert(n==len(rs))
+    # encrypts the points for target, and writes the resulting triples 
+    # to out (a new bytearray if None), which is returned.
+    def encrypt_packed(self, points, target, rs=None, out=None):
+        cpoints = ristretto.ffi.from_buffer("unsigned char[]", points)
+        n = _count(cpoints, 32)
+
+        if out==None:
+            out = bytearray(96*n)
+        cout = ristretto.ffi.from_buffer("unsigned char[]", out,
+                require_writable=True)
+        assert(len(cout)==96*n)
 
         ctarget = ristretto.ffi.new("group_ge*")
-        crs = ristretto.ffi.new("group_scalar[]", n)
-        cpoints = ristretto.ffi.new("group_ge[]", n)
-        ctriples = ristretto.ffi.new("elgamal_triple[]", n)
-        
         assert(0==ristretto.lib.group_ge_unpack(ctarget,target.pack()))
 
-        for i in range(n):
-            ristretto.lib.group_scalar_unpack(
-                    ristretto.ffi.addressof(crs,i),
-                    ed25519.scalar_pack(rs[i]))
-        
-        for i in range(n):
-            ristretto.lib.group_ge_unpack(
-                    ristretto.ffi.addressof(cpoints,i),
-                    pseudonyms[i].data)
-
-        ristretto.lib.elgamal_triples_encrypt(ctriples, cpoints, 
-                ctarget, crs, n)
+        crs = _scalars(rs, n)
+        cerror_codes = ristretto.ffi.new("int[]", n)
 
-        cbuf = ristretto.ffi.new("unsigned char[]", 96*n)
+        def encrypt_range(start, count):
+            cges = ristretto.ffi.new("group_ge[]", count)
+            ctriples = ristretto.ffi.new("elgamal_triple[]", count)
 
-        ristretto.lib.elgamal_triples_pack(cbuf, ctriples, n)
+            ristretto.lib.group_ges_unpack(cges, cpoints+32*start,
+                    cerror_codes+start, count)
+            ristretto.lib.elgamal_triples_encrypt(ctriples,
+                    cges, ctarget, crs+start, count)
+            ristretto.lib.elgamal_triples_pack(cout+96*start,
+                    ctriples, count)
 
-        buf = ristretto.ffi.buffer(cbuf)
+        self._in_parallel(encrypt_range, n)
 
-        for i in range(n):
-            pseudonyms[i].data = buf[ i*96 : (i+1)*96 ]
+        i = _first_error(cerror_codes)
+        if i!=None:
+            raise InvalidArgument(f"couldn't unpack {i}th point")
 
+        return out
     
     def decrypt(self, pseudonyms, key):
-        n = len(pseudonyms)
-
-        ckey = ristretto.ffi.new("group_scalar*")
-        cpoints = ristretto.ffi.new("group_ge[]", n)
-        ctriples = ristretto.ffi.new("elgamal_triple[]", n)
-        
-        assert(0==ristretto.lib.group_scalar_unpack(ckey,
-            ed25519.scalar_pack(key)))
-
+        points = self.decrypt_packed(join_data(pseudonyms, 96), key)
+        split_data(pseudonyms, points, 32)
+
+    # decrypts the triples using key, and writes the resulting points 
+    # to out (a new bytearray if None), which is returned.
+    def decrypt_packed(self, triples, key, out=None):
+        ctriples = ristretto.ffi.from_buffer("unsigned char[]", triples)
+        n = _count(ctriples, 96)
+
+        if out==None:
+            out = bytearray(32*n)
+        cout = ristretto.ffi.from_buffer("unsigned char[]", out,
+                require_writable=True)
+        assert(len(cout)==32*n)
+
+        ckey = _scalar(key)
         cerror_codes = ristretto.ffi.new("int[]", n)
 
-        ristretto.lib.elgamal_triples_unpack(ctriples,
-                b''.join([pseudonym.data for pseudonym in pseudonyms]),
-                cerror_codes, n)
+        def decrypt_range(start, count):
+            cunpacked = ristretto.ffi.new("elgamal_triple[]", count)
+            cges = ristretto.ffi.new("group_ge[]", count)
 
-        for i in range(n):
-            if cerror_codes[i]!=0:
-                raise InvalidArgument(f"couldn't unpack {i}th triple")
-
-        ristretto.lib.elgamal_triples_decrypt(cpoints, ctriples, ckey, n)
+            ristretto.lib.elgamal_triples_unpack(cunpacked,
+                    ctriples+96*start, cerror_codes+start, count)
+            ristretto.lib.elgamal_triples_decrypt(cges,
+                    cunpacked, ckey, count)
+            ristretto.lib.group_ges_pack(cout+32*start, cges, count)
 
-        cbuf = ristretto.ffi.new("unsigned char[]", 32*n)
+        self._in_parallel(decrypt_range, n)
 
-        ristretto.lib.group_ges_pack(cbuf, cpoints, n)
-
-        buf = ristretto.ffi.buffer(cbuf)
+        i = _first_error(cerror_codes)
+        if i!=None:
+            raise InvalidArgument(f"couldn't unpack {i}th triple")
 
-        for i in range(n):
-            pseudonyms[i].data = buf[ i*32 : (i+1)*32 ]
+        return out
 
 
     def elligator(self, names):
@@ -178,11 +186,15 @@ class CryptoPU:
         ristretto.lib.fe25519s_unpack(cfes, 
                 b''.join([ name.data for name in names ]), n)
 
-        ristretto.lib.group_ges_elligator(cpoints, cfes, n)
-
         cbuf = ristretto.ffi.new("unsigned char[]", 32*n)
 
-        ristretto.lib.group_ges_pack(cbuf, cpoints, n)
+        def elligator_range(start, count):
+            ristretto.lib.group_ges_elligator(cpoints+start,
+                    cfes+start, count)
+            ristretto.lib.group_ges_pack(cbuf+32*start,
+                    cpoints+start, count)
+
+        self._in_parallel(elligator_range, n)
 
         buf = ristretto.ffi.buffer(cbuf)
 
@@ -296,3 +308,382 @@ class CryptoPU:
 
         return ristretto.lib.certified_component_is_valid_for(
                 ccc, cbase_powers, cexponent)!=0
+
+    # The following methods create and verify the proofs of schnorr.py,
+    # with the same wire format, but on packed points, because packing
+    # and unpacking an ed25519.Point takes about as long as multiplying it.
+
+    # returns the packed point scalar*B
+    def base_times(self, scalar):
+        cresult = ristretto.ffi.new("group_ge*")
+        ristretto.lib.group_ge_scalarmult_base(cresult, _scalar(scalar))
+        return _pack(cresult)
+
+    # returns the packed schnorr.DHTProof.create(a, M, A, N, m)
+    def dht_proof_create(self, a, M_packed, A_packed=None, N_packed=None,
+            m=None):
+        ca = _scalar(a)
+        cM, M_packed = _unpack(M_packed)
+
+        if A_packed==None:
+            A_packed = self.base_times(a)
+
+        if N_packed==None:
+            cN = ristretto.ffi.new("group_ge*")
+            ristretto.lib.group_ge_scalarmult(cN, cM, ca)
+            N_packed = _pack(cN)
+
+        cproof = ristretto.ffi.new("unsigned char[]", 96)
+        ristretto.lib.dht_proof_create(cproof, ca, ed25519.scalar_pack(a),
+                A_packed, ristretto.ffi.NULL if m==None else _scalar(m),
+                cM, M_packed, ristretto.ffi.NULL, N_packed)
+        return ristretto.ffi.buffer(cproof)[:]
+
+    def dht_proof_is_valid_for(self, proof, A_packed, M_packed, N_packed):
+        if len(proof)!=96:
+            return False
+
+        try:
+            A, M, N = _unpack(A_packed), _unpack(M_packed), _unpack(N_packed)
+        except InvalidArgument:
+            return False
+
+        return ristretto.lib.dht_proof_is_valid_for(proof, A[0], M[0], N[0],
+                A[1], M[1], N[1])!=0
+
+    # Fills the ProductProof protobuf message msg with the proof
+    # of schnorr.ProductProof.create(factors_scalars), and returns 
+    # the packed factors and product.
+    def product_proof_create(self, factors_scalars, msg):
+        N = len(factors_scalars)
+
+        product = 1
+
+        cfactors_scalars = ristretto.ffi.new("group_scalar[]", max(N,1))
+        cfactors_scalars_packed = ristretto.ffi.new("unsigned char[]", 
+                32*max(N,1))
+        cfactors = ristretto.ffi.new("group_ge[]", max(N,1))
+        cfactors_packed = ristretto.ffi.new("unsigned char[]", 32*max(N,1))
+
+        for i, factor_scalar in enumerate(factors_scalars):
+            factor_scalar_packed = ed25519.scalar_pack(factor_scalar)
+            cfactors_scalars_packed[32*i:32*(i+1)] = factor_scalar_packed
+            ristretto.lib.group_scalar_unpack(cfactors_scalars+i,
+                    factor_scalar_packed)
+            product = ( product * factor_scalar ) % ed25519.l
+
+        ristretto.lib.group_ges_scalarmult_base(cfactors, cfactors_scalars, N)
+        ristretto.lib.group_ges_pack(cfactors_packed, cfactors, N)
+        
+        cpp = ristretto.ffi.new("product_proof*")
+        cpp.number_of_factors = N
+        cdht_proofs = ristretto.ffi.new("unsigned char[]", 96*max(N-1,0))
+        cpartial_products = ristretto.ffi.new("unsigned char[]", 32*max(N-2,0))
+        cpp.dht_proofs = cdht_proofs
+        cpp.partial_products = cpartial_products
+
+        ristretto.lib.product_proof_create(cpp, cfactors_scalars,
+                cfactors_scalars_packed, cfactors_packed)
+
+        partial_products = ristretto.ffi.buffer(cpartial_products)[:]
+        assert(len(msg.partial_products)==0)
+        for i in range(max(N-2,0)):
+            msg.partial_products.append(partial_products[32*i:32*(i+1)])
+
+        dht_proofs = ristretto.ffi.buffer(cdht_proofs)[:]
+        assert(len(msg.dht_proofs)==0)
+        for i in range(max(N-1,0)):
+            msg.dht_proofs.append(dht_proofs[96*i:96*(i+1)])
+
+        factors_packed = ristretto.ffi.buffer(cfactors_packed)[:]
+
+        return ( [ factors_packed[32*i:32*(i+1)] for i in range(N) ],
+                self.base_times(product) )
+
+    def product_proof_is_valid_for(self, msg, product_packed, 
+            factors_packed):
+        return self._are_valid(self.product_proof_dht_instances(msg,
+            product_packed, factors_packed))
+
+    # Verifying a product, rs or rsk proof amounts to some cheap checks
+    # and verifying a number of DHT proofs.  The *_dht_instances methods
+    # perform the former, and return the latter as a list of
+    # (proof, A_packed, M_packed, N_packed) (or None if the cheap checks 
+    # fail.)  The lists of several proofs can then be checked at once
+    # using dht_proofs_are_valid_for.
+
+    def product_proof_dht_instances(self, msg, product_packed, 
+            factors_packed):
+        N = len(factors_packed)
+
+        if len(msg.partial_products) != max(N-2,0)\
+                or len(msg.dht_proofs) != max(N-1,0):
+            return None
+
+        try:
+            product = _unpack(product_packed)
+            factors = [ _unpack(factor_packed) 
+                    for factor_packed in factors_packed ]
+            partial_products = [ _unpack(partial_product_packed)
+                    for partial_product_packed in msg.partial_products ]
+        except InvalidArgument:
+            return None
+
+        if N==0:
+            return [] if _equals(product, _unpack(self.base_times(1))) \
+                    else None
+
+        if N==1:
+            return [] if _equals(product, factors[0]) else None
+
+        partial_products = [ factors[0] ] + partial_products + [ product ]
+
+        return [ (msg.dht_proofs[i], factors[i+1][1], 
+            partial_products[i][1], partial_products[i+1][1])
+            for i in range(N-1) ]
+
+    # checks the DHT proofs of all instances at once
+    def dht_proofs_are_valid_for(self, instances):
+        n = len(instances)
+
+        if n==0:
+            return True
+
+        for instance in instances:
+            if len(instance[0])!=96 or \
+                    any(len(packed)!=32 for packed in instance[1:]):
+                return False
+
+        return ristretto.lib.dht_proofs_are_valid_for(
+                *[ b''.join(column) for column in zip(*instances) ],
+                os.urandom(32*n), n)!=0
+
+    # checks the DHT proofs of the instances one by one
+    def _are_valid(self, instances):
+        return instances!=None and all( 
+                self.dht_proof_is_valid_for(*instance)
+                for instance in instances )
+
+    # returns the packed schnorr.RSProof.create(triple, n, r)
+    # together with the resulting packed triple
+    def rs_proof_create(self, triple_packed, n, r):
+        b, c, y = _unpack_triple(triple_packed)
+
+        N_B = self.base_times(n)
+        R_B = self.base_times(r)
+        R_y = _scalarmult(y, r)
+
+        beta_ = _add(b, _unpack(R_B))
+        gamma_ = _add(c, R_y)
+
+        beta = _scalarmult(beta_, n)
+        gamma = _scalarmult(gamma_, n)
+
+        return ( R_B + R_y[1] + beta_[1] + gamma_[1] 
+                + self.dht_proof_create(r, y[1], A_packed=R_B, 
+                    N_packed=R_y[1])
+                + self.dht_proof_create(n, beta_[1], A_packed=N_B,
+                    N_packed=beta[1])
+                + self.dht_proof_create(n, gamma_[1], A_packed=N_B,
+                    N_packed=gamma[1]),
+            beta[1] + gamma[1] + y[1] )
+
+    # applies rs_proof_create with the same n (and random r's) to each of
+    # the given packed triples, dividing them over the threads;
+    # returns the list of proofs and the list of resulting triples.
+    def rs_proofs_create(self, triples_packed, n):
+        m = len(triples_packed)
+        proofs = [ None ] * m
+        triples_out = [ None ] * m
+
+        def create_range(start, count):
+            for i in range(start, start+count):
+                proofs[i], triples_out[i] = self.rs_proof_create(
+                        triples_packed[i], n, ed25519.scalar_random())
+
+        self._in_parallel(create_range, m)
+        return proofs, triples_out
+
+    def rs_proof_is_valid_for(self, proof, triple_in_packed, N_B_packed,
+            triple_out_packed):
+        return self._are_valid(self.rs_proof_dht_instances(proof,
+            triple_in_packed, N_B_packed, triple_out_packed))
+
+    def rs_proof_dht_instances(self, proof, triple_in_packed, N_B_packed,
+            triple_out_packed):
+        if len(proof)!=416:
+            return None
+
+        try:
+            b, c, y = _unpack_triple(triple_in_packed)
+            beta, gamma, tau = _unpack_triple(triple_out_packed)
+            N_B = _unpack(N_B_packed)
+            R_B, R_y, beta_, gamma_ = [ _unpack(proof[32*i:32*(i+1)])
+                    for i in range(4) ]
+        except InvalidArgument:
+            return None
+
+        if not ( _equals(beta_, _add(b, R_B)) 
+                and _equals(gamma_, _add(c, R_y)) 
+                and _equals(tau, y) ):
+            return None
+
+        return [ (proof[128:224], R_B[1], y[1], R_y[1]),
+                (proof[224:320], N_B[1], beta_[1], beta[1]),
+                (proof[320:416], N_B[1], gamma_[1], gamma[1]) ]
+
+    # returns the packed schnorr.RSKProof.create(triple, k, n, r)
+    # together with the resulting packed triple
+    def rsk_proof_create(self, triple_packed, k, n, r):
+        b, c, y = _unpack_triple(triple_packed)
+
+        nkinv = ( n * ed25519.scalar_inv(k) ) % ed25519.l
+        nkinvB = self.base_times(nkinv)
+
+        R_B = self.base_times(r)
+        R_y = _scalarmult(y, r)
+
+        K_B = self.base_times(k)
+
+        beta_ = _add(b, _unpack(R_B))
+        gamma_ = _add(c, R_y)
+
+        beta = _scalarmult(beta_, nkinv)
+        gamma = _scalarmult(gamma_, n)
+        tau = _scalarmult(y, k)
+
+        return ( R_B + R_y[1] + nkinvB + beta_[1] + gamma_[1] 
+                + self.dht_proof_create(r, y[1], A_packed=R_B, 
+                    N_packed=R_y[1])
+                + self.dht_proof_create(k, y[1], A_packed=K_B,
+                    N_packed=tau[1])
+                + self.dht_proof_create(k, nkinvB, A_packed=K_B)
+                + self.dht_proof_create(nkinv, beta_[1], A_packed=nkinvB,
+                    N_packed=beta[1])
+                + self.dht_proof_create(n, gamma_[1], N_packed=gamma[1]),
+            beta[1] + gamma[1] + tau[1] )
+
+    def rsk_proof_is_valid_for(self, proof, triple_in_packed, 
+            K_B_packed, N_B_packed, triple_out_packed):
+        return self._are_valid(self.rsk_proof_dht_instances(proof,
+            triple_in_packed, K_B_packed, N_B_packed, triple_out_packed))
+
+    def rsk_proof_dht_instances(self, proof, triple_in_packed, 
+            K_B_packed, N_B_packed, triple_out_packed):
+        if len(proof)!=640:
+            return None
+
+        try:
+            b, c, y = _unpack_triple(triple_in_packed)
+            beta, gamma, tau = _unpack_triple(triple_out_packed)
+            K_B = _unpack(K_B_packed)
+            N_B = _unpack(N_B_packed)
+            R_B, R_y, T_B, beta_, gamma_ = [ _unpack(proof[32*i:32*(i+1)])
+                    for i in range(5) ]
+        except InvalidArgument:
+            return None
+
+        if not ( _equals(beta_, _add(b, R_B)) 
+                and _equals(gamma_, _add(c, R_y)) ):
+            return None
+
+        return [ (proof[160:256], R_B[1], y[1], R_y[1]),
+                (proof[256:352], K_B[1], y[1], tau[1]),
+                (proof[352:448], K_B[1], T_B[1], N_B[1]),
+                (proof[448:544], T_B[1], beta_[1], beta[1]),
+                (proof[544:640], N_B[1], gamma_[1], gamma[1]) ]
+
+
+# returns a bytearray with the concatenated data of the pseudonyms, 
+# which should all be size bytes long
+def join_data(pseudonyms, size):
+    datas = [ pseudonym.data for pseudonym in pseudonyms ]
+    buf = bytearray(b''.join(datas))
+
+    if len(buf)!=size*len(datas):
+        for i, data in enumerate(datas):
+            if len(data)!=size:
+                raise InvalidArgument(f"the {i}th name is {len(data)} "
+                        f"bytes long instead of {size}")
+
+    return buf
+
+# inverse of join_data
+def split_data(pseudonyms, buf, size):
+    buf = bytes(buf)
+    for i in range(len(pseudonyms)):
+        pseudonyms[i].data = buf[ i*size : (i+1)*size ]
+
+# The helpers below represent a point by a pair (cge, packed) of its
+# unpacked and (canonically) packed forms.
+
+def _unpack(packed):
+    if len(packed)!=32:
+        raise InvalidArgument(f"a packed point should be 32 bytes long,"
+                f" not {len(packed)}")
+    cge = ristretto.ffi.new("group_ge*")
+    if ristretto.lib.group_ge_unpack(cge, packed)!=0:
+        raise InvalidArgument("couldn't unpack point")
+    return cge, _pack(cge)
+
+def _unpack_triple(packed):
+    if len(packed)!=96:
+        raise InvalidArgument(f"a packed triple should be 96 bytes long,"
+                f" not {len(packed)}")
+    return [ _unpack(packed[32*i:32*(i+1)]) for i in range(3) ]
+
+def _pack(cge):
+    cbuf = ristretto.ffi.new("unsigned char[]", 32)
+    ristretto.lib.group_ge_pack(cbuf, cge)
+    return ristretto.ffi.buffer(cbuf)[:]
+
+def _add(x, y):
+    cresult = ristretto.ffi.new("group_ge*")
+    ristretto.lib.group_ge_add(cresult, x[0], y[0])
+    return cresult, _pack(cresult)
+
+def _scalarmult(x, scalar):
+    cresult = ristretto.ffi.new("group_ge*")
+    ristretto.lib.group_ge_scalarmult(cresult, x[0], _scalar(scalar))
+    return cresult, _pack(cresult)
+
+def _equals(x, y):
+    return ristretto.lib.group_ge_equals(x[0], y[0])!=0
+
+def _count(cbuf, size):
+    if len(cbuf)%size!=0:
+        raise InvalidArgument(f"the length of the buffer, {len(cbuf)}, "
+                f"is not a multiple of {size}")
+    return len(cbuf)//size
+
+def _scalar(x):
+    cx = ristretto.ffi.new("group_scalar*")
+    assert(ristretto.lib.group_scalar_unpack(cx, ed25519.scalar_pack(x))==0)
+    return cx
+
+def _scalars(xs, n):
+    cxs = ristretto.ffi.new("group_scalar[]", n)
+
+    if xs==None:
+        ristretto.lib.group_scalars_from64bytes(cxs, os.urandom(64*n), n)
+        return cxs
+
+    cxs_packed = ristretto.ffi.from_buffer("unsigned char[]", xs)
+    assert(len(cxs_packed)==32*n)
+
+    cerror_codes = ristretto.ffi.new("int[]", n)
+    ristretto.lib.group_scalars_unpack(cxs, cxs_packed, cerror_codes, n)
+
+    i = _first_error(cerror_codes)
+    if i!=None:
+        raise InvalidArgument(f"couldn't unpack {i}th scalar")
+
+    return cxs
+
+# returns the index of the first non-zero error code, or None
+def _first_error(cerror_codes):
+    buf = ristretto.ffi.buffer(cerror_codes)[:]
+    rest = buf.lstrip(b'\0')
+    if len(rest)==0:
+        return None
+    return (len(buf)-len(rest)) // ristretto.ffi.sizeof("int")
@@ -4,13 +4,15 @@ import common
 import sql
 
 import threading
+import collections
+import contextlib
+import re
 
 import codecs
 
 # for database communication
-from sqlalchemy import inspect, create_engine
+from sqlalchemy import inspect, create_engine, MetaData, Table, Index
 from sqlalchemy import Column, Integer, String, DateTime, LargeBinary
-from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.schema import Sequence
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy.pool
@@ -74,6 +76,23 @@ class PepedFlow(Base):
             self.packets
         )
 
+# The columns of peped_flows set by Database.Store, in the order used
+# by flow_record_to_row.
+FLOW_COLUMNS = ("start_time", "end_time", "p_src_ip", "p_dst_ip", 
+        "src_port", "dst_port", "protocol", "packets", "bytes")
+
+def flow_record_to_row(record):
+    anonymous_part = record.anonymous_part
+    return (anonymous_part.start_time,
+            anonymous_part.end_time,
+            record.source_ip.data,
+            record.destination_ip.data,
+            anonymous_part.source_port,
+            anonymous_part.destination_port,
+            anonymous_part.protocol,
+            anonymous_part.number_of_packets,
+            anonymous_part.number_of_bytes)
+
 class Database(pep3_pb2_grpc.DatabaseServicer):
     def __init__(self, pep):
         self.pep = pep
@@ -84,16 +103,44 @@ class Database(pep3_pb2_grpc.DatabaseServicer):
         if econf.poolclass!="":
             poolclass = getattr(sqlalchemy.pool, econf.poolclass)
 
+        # the configured indexes and partitioning of peped_flows
+        self.table_desc = pep3_pb2.Configuration.TableDescriptor()
+        if 'peped_flows' in self.pep.global_config.db_desc:
+            self.table_desc = self.pep.global_config.db_desc['peped_flows']
+        self.partition_length = self.table_desc.partition_length
+        if self.partition_length>0:
+            column = PepedFlow.__table__.columns.get(
+                    self.table_desc.partition_column)
+            if self.table_desc.partition_column not in FLOW_COLUMNS \
+                    or not isinstance(column.type, Integer):
+                raise ValueError("can not partition peped_flows by "
+                        f"'{self.table_desc.partition_column}';  "
+                        "it should be an integer column")
+            self.partition_column = FLOW_COLUMNS.index(
+                    self.table_desc.partition_column)
+
+        # our own copies of the peped_flows table (and its partitions,)
+        # as the indexes depend on the configuration
+        self.metadata = MetaData()
+        self.partitions = {} # partition number -> table
+        self.partitions_lock = threading.Lock()
+        self.inserts = {} # table name -> compiled insert statement
+
         try:
             self.engine = create_engine(econf.uri, poolclass=poolclass,
                     connect_args=econf.connect_args)
 
+            self.flows_table = self._flows_table('peped_flows')
             if self.pep.config.engine.create_tables:
-                Base.metadata.create_all(self.engine)
+                self.metadata.create_all(self.engine)
 
             inspector = inspect(self.engine)
-            session_factory = sessionmaker(bind=self.engine)
-            self.Session = scoped_session(session_factory)
+            for table_name in inspector.get_table_names():
+                match = re.fullmatch(r"peped_flows_([0-9]+)", table_name)
+                if match!=None:
+                    self.partitions[int(match.group(1))] \
+                            = self._flows_table(table_name)
+
         except Exception as e:
             raise Exception(f"DB error: {e}")
 
@@ -111,33 +158,127 @@ class Database(pep3_pb2_grpc.DatabaseServicer):
         return db_desc
 
 
+    # Returns a copy of the peped_flows table with the given name, 
+    # and the configured indexes.
+    def _flows_table(self, name):
+        table = Table(name, self.metadata, *[ column.copy() 
+            for column in PepedFlow.__table__.columns ])
+
+        for index in self.table_desc.indexes:
+            for column in index.columns:
+                if column not in table.c:
+                    raise ValueError(f"index on unknown column {column}")
+            kwargs = {}
+            if index.using!="":
+                kwargs['postgresql_using'] = index.using
+            Index(f"ix_{name}_{'_'.join(index.columns)}",
+                    *[ table.c[column] for column in index.columns ],
+                    **kwargs)
+
+        # Store passes rows directly to the DBAPI's executemany, 
+        # bypassing sqlalchemy's (per row) processing of parameters.
+        insert = table.insert().compile(dialect=self.engine.dialect, 
+                column_keys=FLOW_COLUMNS)
+        if insert.positional:
+            assert(tuple(insert.positiontup)==FLOW_COLUMNS)
+        self.inserts[name] = insert
+
+        return table
+
+    # Returns the partition with the given number, creating it when needed.
+    def _partition(self, number):
+        with self.partitions_lock:
+            if number not in self.partitions:
+                table = self._flows_table(f"peped_flows_{number}")
+                table.create(self.engine, checkfirst=True)
+                self.partitions[number] = table
+            return self.partitions[number]
+
+    # Stores the StoreRequests that are already waiting together in one
+    # transaction (up to max_records_per_transaction records,) and 
+    # acknowledges each of them only after this transaction is committed.
     def Store(self, request_it, context):
         common.authenticate(context,
                 must_be_one_of=[b"PEP3 storage_facility"])
-        
-        for request in request_it:
-            local_session = self.Session()
-            local_session.bulk_insert_mappings(PepedFlow, [dict(
-                start_time  = record.anonymous_part.start_time,
-                end_time    = record.anonymous_part.end_time,
-                p_src_ip    = record.source_ip.data,
-                p_dst_ip    = record.destination_ip.data,
-                src_port    = record.anonymous_part.source_port,
-                dst_port    = record.anonymous_part.destination_port,
-                protocol    = record.anonymous_part.protocol,
-                packets     = record.anonymous_part.number_of_packets,
-                bytes       = record.anonymous_part.number_of_bytes
-            ) for record in request.records])
-            local_session.commit()
-            yield pep3_pb2.StoreFeedback(stored_id=request.id)
 
-        
+        max_records = self.pep.config.max_records_per_transaction
+
+        # Converts the requests to rows ahead (on another thread,) 
+        # so we can see which requests are waiting.
+        requests = common.chuck(( (request.id, [ flow_record_to_row(record)
+            for record in request.records ]) for request in request_it ),
+            maxitems=64)
+        try:
+            item = next(requests, None)
+            while item != None:
+                request_ids = []
+                rows = []
+
+                while item != None and (len(request_ids)==0 
+                        or len(rows)+len(item[1])<=max_records):
+                    request_ids.append(item[0])
+                    rows.extend(item[1])
+                    item = None
+                    if requests.size()>0: 
+                        item = next(requests)
+
+                self._insert_flows(rows)
+
+                for request_id in request_ids:
+                    yield pep3_pb2.StoreFeedback(stored_id=request_id)
+
+                if item==None:
+                    item = next(requests, None)
+        finally:
+            requests.close()
+
+    def _insert_flows(self, rows):
+        if self.partition_length==0:
+            rows_by_table = { self.flows_table: rows }
+        else:
+            rows_by_partition = collections.defaultdict(list)
+            for row in rows:
+                rows_by_partition[row[self.partition_column]
+                        // self.partition_length].append(row)
+            rows_by_table = { self._partition(number): rows 
+                    for number, rows in rows_by_partition.items() }
+
+        with self.engine.begin() as connection, \
+                contextlib.closing(connection.connection.cursor()) as cursor:
+            for table, rows in rows_by_table.items():
+                if not self.inserts[table.name].positional:
+                    rows = [ dict(zip(FLOW_COLUMNS, row)) for row in rows ]
+                cursor.executemany(str(self.inserts[table.name]), rows)
+
+    # Replaces peped_flows in the FROM clause of the query by the union 
+    # of peped_flows and the partitions that might contain rows 
+    # satisfying its WHERE clause.
+    def _route_query(self, query, params):
+        lower, upper = sql.column_bounds(query, 
+                f"peped_flows.{self.table_desc.partition_column}", params)
+
+        with self.partitions_lock:
+            numbers = sorted(self.partitions)
+
+        tables = [ 'peped_flows' ] # holds rows from before partitioning
+        for number in numbers:
+            if upper!=None and number*self.partition_length > upper:
+                continue
+            if lower!=None and (number+1)*self.partition_length <= lower:
+                continue
+            tables.append(f"peped_flows_{number}")
+
+        if len(tables)==1:
+            return query
+
+        return sql.replace_table(query, 'peped_flows', "(" 
+                + " UNION ALL ".join([ f"SELECT * FROM {table}"
+                    for table in tables ]) + ") AS peped_flows")
+
     def Query(self, query, context): 
         common.authenticate(context,
                 must_be_one_of=[b"PEP3 storage_facility"])
 
-        local_session = self.Session()
-
         params = {}
         param_desc = {}
 
@@ -152,25 +293,97 @@ class Database(pep3_pb2_grpc.DatabaseServicer):
             context.abort(grpc.StatusCode.INVALID_ARGUMENT,
                     f"invalid query: {e}")
 
-        sql_rows = local_session.execute(query.query, params)
+        max_rows, max_pseudonyms, max_bytes \
+                = self._chunk_limits(query)
+        pseudonyms_per_row = result_desc.count('pseudonymized')
+
+        sql_query = query.query
+        if self.partition_length>0:
+            sql_query = self._route_query(sql_query, params)
+
+        # with stream_results, sqlalchemy asks for a server-side cursor
+        # (where the DBAPI supports it,) so the result is not 
+        # kept in memory in its entirety.  This costs extra round trips,
+        # and is not needed when a LIMIT keeps the result within one 
+        # chunk, as for "ORDER BY SUM(...) DESC LIMIT 10" top-n queries.
+        limit = sql.parse(query.query).limit
+        stream_results = True
+        if limit!=None and (max_rows!=None or pseudonyms_per_row>0):
+            stream_results = (max_rows!=None and limit>max_rows) \
+                    or limit*pseudonyms_per_row>max_pseudonyms
 
-        pb_rows = pep3_pb2.Rows()
+        # the index in the result's Rows.pseudonyms of the pseudonyms
+        # seen so far, when deduplicating
+        pseudonym_to_index = {}
 
-        for sql_row in sql_rows:
-            assert(len(sql_row)==len(result_desc))
+        with self.engine.connect() as connection:
+            sql_rows = connection.execution_options(
+                    stream_results=stream_results)\
+                    .execute(sqlalchemy.text(sql_query), params)
 
-            pb_row = pb_rows.rows.add()
+            pb_rows = pep3_pb2.Rows()
+            nbytes = 0
+            pseudonyms = 0 # new to this chunk
 
-            for i in range(len(result_desc)):
-                pb_cell = pb_row.cells.add()
-                common.object_and_type_to_value(pb_cell, 
-                        sql_row[i], result_desc[i])
+            for sql_row in sql_rows:
+                assert(len(sql_row)==len(result_desc))
 
-            if len(pb_rows.rows)==32:
+                pb_row = pb_rows.rows.add()
+
+                for i in range(len(result_desc)):
+                    pb_cell = pb_row.cells.add()
+
+                    if result_desc[i]=='pseudonymized' \
+                            and query.deduplicate_pseudonyms:
+                        data = bytes(sql_row[i]) # (may be a memoryview)
+                        index = pseudonym_to_index.get(data)
+                        if index==None:
+                            index = len(pseudonym_to_index)
+                            pseudonym_to_index[data] = index
+                            pseudonym = pb_rows.pseudonyms.add(
+                                data=data, state=pep3_pb2\
+                                    .Pseudonymizable.UNENCRYPTED_PSEUDONYM)
+                            nbytes += pseudonym.ByteSize()
+                            pseudonyms += 1
+                        pb_cell.pseudonym_index = index
+                        continue
+
+                    common.object_and_type_to_value(pb_cell, 
+                            sql_row[i], result_desc[i])
+                    if result_desc[i]=='pseudonymized':
+                        pseudonyms += 1
+
+                nbytes += pb_row.ByteSize()
+                if len(pb_rows.rows)==max_rows or nbytes>=max_bytes \
+                        or (pseudonyms_per_row>0 and pseudonyms 
+                            + pseudonyms_per_row>max_pseudonyms):
+                    yield pb_rows
+                    pb_rows.Clear()
+                    nbytes = 0
+                    pseudonyms = 0
+
+            if len(pb_rows.rows)>0:
                 yield pb_rows
-                pb_rows.Clear()
-        if len(pb_rows.rows)>0:
-            yield pb_rows
+
+    # Returns the maximum number of rows (None for no limit),
+    # pseudonyms and bytes of the Rows chunks in which the result of 
+    # the given query is to be returned, see SqlQuery.max_rows_per_chunk.
+    def _chunk_limits(self, query):
+        max_bytes = self.pep.config.max_bytes_per_chunk
+        if max_bytes==0:
+            max_bytes = 2**20
+        if query.max_bytes_per_chunk!=0:
+            max_bytes = min(max_bytes, query.max_bytes_per_chunk)
+
+        max_pseudonyms = query.max_pseudonyms_per_chunk
+        if max_pseudonyms==0:
+            max_pseudonyms = max(self.pep.global_config.batchsize, 1)
+
+        max_rows = None
+        if query.max_rows_per_chunk!=0:
+            max_rows = query.max_rows_per_chunk
+
+        return max_rows, max_pseudonyms, max_bytes
 
 def hextail(data):
     return codecs.encode(data, 'hex_codec').decode("utf-8")[-8:]
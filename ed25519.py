@@ -1,4 +1,7 @@
 import random
+import threading
+import collections
+
 import common
 
 q = 2**255-19 # order of the field---hence the name ed25519
@@ -707,7 +710,14 @@ class Point:
         return result
 
     def __mul__(self, other):
-        return double_and_add_multiplication(self, other, Point.Zero())
+        if not isinstance(other, int):
+            return NotImplemented
+        other %= 8*l
+
+        table = Point.table_cache.get(self)
+        if table!=None:
+            return table.times(other)
+        return window_multiplication(self, other)
 
     def equivalence_class(self):
         # doesn't include the odd points
@@ -743,18 +753,7 @@ class Point:
 
     @staticmethod
     def B_times(scalar):
-        scalar %= l 
-        result = Point.Zero()
-        i = 0
-
-        while(scalar>0):
-            if scalar&1==1:
-                result += Point.B_times_two_to_the_power[i]
-
-            scalar >>= 1
-            i += 1
-
-        return result
+        return Point._B_table.times(scalar % l)
 
     # since B is passed by-reference, and "+=" is implemented in place,
     # code like 
@@ -915,10 +914,100 @@ def double_and_add_multiplication(self, other, zero):
 
     return result
 
-# TODO: hardcode these values
-Point.B_times_two_to_the_power = []
-_tmp = Point.B()
-for _some_name_not_i in range(253): 
-    Point.B_times_two_to_the_power.append(_tmp)
-    _tmp = _tmp.double()
-del _tmp
+# returns the digits d_0, d_1, ... in (-2**(w-1), 2**(w-1)] of the
+# non-negative scalar such that scalar = d_0 + d_1 2**w + d_2 2**(2w) + ...
+def signed_digits(scalar, w=4):
+    digits = []
+    half, mask = 1 << (w-1), (1 << w) - 1
+    while scalar>0:
+        digit = scalar & mask
+        scalar >>= w
+        if digit>half:
+            digit -= 1 << w
+            scalar += 1
+        digits.append(digit)
+    return digits
+
+# computes scalar*point for non-negative scalar using the signed radix 16
+# digits of scalar, processing four bits per addition
+def window_multiplication(point, scalar):
+    multiples = [ point.Copy() ] # multiples[k] = (k+1)*point
+    for k in range(7):
+        multiples.append( multiples[-1] + point )
+
+    result = Point.Zero()
+    for digit in reversed(signed_digits(scalar)):
+        for j in range(4):
+            result.double_in_place()
+        if digit>0:
+            result += multiples[digit-1]
+        elif digit<0:
+            result += -multiples[-digit-1]
+    return result
+
+# Precomputed multiples of a fixed point so that multiplying it by a 
+# scalar of at most 256 bits takes at most 256/w+1 additions (and no 
+# doublings):  rows[j][k] = (k+1) 2**(wj) point.
+class FixedBaseTable:
+    def __init__(self, point, w=4):
+        self.w = w
+        self.rows = []
+        power = point.Copy()
+        for j in range(-(-256//w)+1):
+            row = [ power ]
+            for k in range((1 << (w-1)) - 1):
+                row.append( row[-1] + power )
+            self.rows.append(row)
+            power = row[-1].double() # 2**(w(j+1)) point
+
+    def times(self, scalar):
+        # scalar should be non-negative and less than 2**256
+        result = Point.Zero()
+        for j, digit in enumerate(signed_digits(scalar, self.w)):
+            if digit>0:
+                result += self.rows[j][digit-1]
+            elif digit<0:
+                result += -self.rows[j][-digit-1]
+        return result
+
+# Keeps the FixedBaseTables of at most size points, but only of
+# the points that are multiplied by a scalar for the second time,
+# since computing a table costs about two multiplications.
+class TableCache:
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._tables = collections.OrderedDict()
+        self._seen = collections.OrderedDict()
+
+    def get(self, point):
+        key = (point.X, point.Y, point.Z, point.T)
+
+        with self._lock:
+            table = self._tables.get(key)
+            if table!=None:
+                self.hits += 1
+                self._tables.move_to_end(key)
+                return table
+
+            self.misses += 1
+            if key not in self._seen:
+                self._seen[key] = None
+                if len(self._seen)>self.size:
+                    self._seen.popitem(last=False)
+                return None
+            del self._seen[key]
+
+        table = FixedBaseTable(point)
+
+        with self._lock:
+            self._tables[key] = table
+            if len(self._tables)>self.size:
+                self._tables.popitem(last=False)
+
+        return table
+
+Point._B_table = FixedBaseTable(Point.B(), w=8)
+Point.table_cache = TableCache(128)
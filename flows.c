@@ -0,0 +1,272 @@
+#include <string.h>
+#include <arpa/inet.h>
+
+// The maximal values of the fields of pep3.FlowRecord.AnonymousPart,
+// by field number: start_time and end_time are uint64, the others
+// uint32.
+static const unsigned long long flows_max_value[8] = {
+	0,
+	0xffffffffffffffffULL, 0xffffffffffffffffULL,
+	0xffffffffULL, 0xffffffffULL, 0xffffffffULL,
+	0xffffffffULL, 0xffffffffULL };
+
+static unsigned char *flows_put_varint(unsigned char *p,
+		unsigned long long v)
+{
+	while (v > 0x7f) {
+		*p++ = (unsigned char)(v & 0x7f) | 0x80;
+		v >>= 7;
+	}
+	*p++ = (unsigned char)v;
+	return p;
+}
+
+// serializes a record with the given anonymous part (unless values
+// is NULL) and ips (when has_ip is set) to q, preceded by the tag and
+// length of pep3.StoreRequest.records;  its size is less than
+// FLOWS_MAX_RECORD_SIZE, so its length fits in one byte.
+static unsigned char *flows_put_record(unsigned char *q,
+		const unsigned long long *values, const int *has_ip,
+		unsigned char ips[2][16])
+{
+	unsigned char *record = q;
+	q += 2;
+
+	if (values != NULL) {
+		unsigned char *anonymous_part = q;
+		q += 2;
+		for (int field=1; field<8; field++) {
+			if (values[field]==0)
+				continue;
+			*q++ = field << 3; // wire type 0: varint
+			q = flows_put_varint(q, values[field]);
+		}
+		anonymous_part[0] = (1 << 3) | 2;
+		anonymous_part[1] = q - anonymous_part - 2;
+	}
+
+	for (int i=0; i<2; i++) {
+		if (!has_ip[i])
+			continue;
+		*q++ = ((2+i) << 3) | 2; // source_ip = 2, destination_ip = 3
+		*q++ = 20;
+		*q++ = (1 << 3) | 2; // data = 1
+		*q++ = 16;
+		memcpy(q, ips[i], 16);
+		q += 16;
+		*q++ = 2 << 3; // state = 2
+		*q++ = 1; // UNENCRYPTED_NAME
+	}
+
+	record[0] = (1 << 3) | 2; // StoreRequest.records = 1
+	record[1] = q - record - 2;
+	return q;
+}
+
+static int flows_is_space(unsigned char c)
+{
+	return c==' ' || c=='\t' || c=='\r';
+}
+
+// parses the unsigned integer in [begin, end) that is at most max
+static int flows_parse_uint(const unsigned char *begin,
+		const unsigned char *end, unsigned long long max,
+		unsigned long long *result)
+{
+	unsigned long long v = 0;
+
+	if (begin<end && *begin=='+')
+		begin++;
+	if (begin==end)
+		return 0;
+
+	for (; begin<end; begin++) {
+		unsigned d = *begin - '0';
+		if (d > 9)
+			return 0;
+		if (v > (max - d) / 10)
+			return 0; // overflow
+		v = v*10 + d;
+	}
+
+	*result = v;
+	return 1;
+}
+
+// parses the ip address in [begin, end) to 16 bytes; ipv4 addresses
+// a.b.c.d are mapped to 2002::a.b.c.d
+static int flows_parse_ip(const unsigned char *begin,
+		const unsigned char *end, unsigned char *ip)
+{
+	char cell[64];
+	size_t len = end - begin;
+
+	if (len >= sizeof(cell))
+		return 0;
+	memcpy(cell, begin, len);
+	cell[len] = 0;
+
+	if (memchr(cell, ':', len) != NULL)
+		return inet_pton(AF_INET6, cell, ip) == 1;
+
+	memset(ip, 0, 12);
+	ip[0] = 0x20;
+	ip[1] = 0x02;
+	return inet_pton(AF_INET, cell, ip+12) == 1;
+}
+
+int flows_parse_csv(const unsigned char *buf, size_t n,
+		const int *column_kinds, int ncolumns,
+		unsigned char *out, size_t *out_size, size_t *consumed,
+		int max_records,
+		unsigned long long *serial, unsigned long long *jumps,
+		int *njumps)
+{
+	const unsigned char *p = buf;
+	const unsigned char *buf_end = buf + n;
+	unsigned char *q = out;
+	int has_anonymous_part = 0;
+	int records = 0;
+
+	for (int c=0; c<ncolumns; c++)
+		if (column_kinds[c] >= FLOWS_ANONYMOUS_PART)
+			has_anonymous_part = 1;
+
+	while (records < max_records && p < buf_end) {
+		const unsigned char *line_end = memchr(p, '\n', buf_end - p);
+		unsigned long long values[8] = { 0 };
+		unsigned char ips[2][16];
+		int has_ip[2] = { 0, 0 };
+
+		if (line_end == NULL)
+			break;
+
+		// parse the cells of the line
+		for (int c=0; c<ncolumns; c++) {
+			const unsigned char *cell_end = p;
+			const unsigned char *cell = p;
+			int kind = column_kinds[c];
+
+			while (cell_end < line_end && *cell_end != ',')
+				cell_end++;
+
+			// there should be exactly ncolumns cells
+			if ((c+1 < ncolumns) != (cell_end < line_end))
+				return -1-records;
+			p = cell_end + 1;
+
+			while (cell < cell_end && flows_is_space(*cell))
+				cell++;
+			while (cell < cell_end && flows_is_space(cell_end[-1]))
+				cell_end--;
+
+			if (kind==FLOWS_SOURCE_IP || kind==FLOWS_DESTINATION_IP) {
+				int i = kind - FLOWS_SOURCE_IP;
+				if (!flows_parse_ip(cell, cell_end, ips[i]))
+					return -1-records;
+				has_ip[i] = 1;
+			} else if (kind==FLOWS_SERIAL) {
+				unsigned long long s;
+				if (!flows_parse_uint(cell, cell_end,
+						0xffffffffffffffffULL, &s))
+					return -1-records;
+				if (serial[0] && serial[1] + 1 != s) {
+					jumps[2*(*njumps)] = serial[1];
+					jumps[2*(*njumps)+1] = s;
+					(*njumps)++;
+				}
+				serial[0] = 1;
+				serial[1] = s;
+			} else if (kind >= FLOWS_ANONYMOUS_PART) {
+				int field = kind - FLOWS_ANONYMOUS_PART;
+				if (field<1 || field>7)
+					return -1-records;
+				if (!flows_parse_uint(cell, cell_end,
+						flows_max_value[field], values+field))
+					return -1-records;
+			}
+		}
+		p = line_end + 1;
+
+		q = flows_put_record(q, has_anonymous_part ? values : NULL,
+				has_ip, ips);
+		records++;
+	}
+
+	*out_size = q - out;
+	*consumed = p - buf;
+	return records;
+}
+
+static unsigned long long flows_get_be(const unsigned char *p, int size)
+{
+	unsigned long long v = 0;
+	for (int i=0; i<size; i++)
+		v = (v << 8) | p[i];
+	return v;
+}
+
+int flows_parse_binary(const unsigned char *buf, size_t n,
+		unsigned char *out, size_t *out_size, size_t *consumed,
+		int max_records)
+{
+	// offsets and sizes of the fields of pep3.FlowRecord.AnonymousPart
+	// in a binary record, by field number
+	static const int offset[8] = { 0, 32, 40, 56, 58, 48, 52, 60 };
+	static const int size[8] = { 0, 8, 8, 2, 2, 4, 4, 1 };
+	static const int has_ip[2] = { 1, 1 };
+
+	const unsigned char *p = buf;
+	unsigned char *q = out;
+	int records = 0;
+
+	while (records < max_records
+			&& (size_t)(p - buf) + FLOWS_BINARY_RECORD_SIZE <= n) {
+		unsigned long long values[8] = { 0 };
+		unsigned char ips[2][16];
+
+		for (int field=1; field<8; field++)
+			values[field] = flows_get_be(p + offset[field], size[field]);
+		memcpy(ips[0], p, 16);
+		memcpy(ips[1], p+16, 16);
+
+		q = flows_put_record(q, values, has_ip, ips);
+		p += FLOWS_BINARY_RECORD_SIZE;
+		records++;
+	}
+
+	*out_size = q - out;
+	*consumed = p - buf;
+	return records;
+}
+
+int flows_parse_delimited(const unsigned char *buf, size_t n,
+		unsigned char *out, size_t *out_size, size_t *consumed,
+		int max_records)
+{
+	const unsigned char *p = buf;
+	const unsigned char *buf_end = buf + n;
+	unsigned char *q = out;
+	int records = 0;
+
+	while (records < max_records && p < buf_end) {
+		size_t size = *p;
+
+		// a FlowRecord is shorter than 128 bytes, so its length
+		// should fit in one byte
+		if (size >= 0x80)
+			return -1-records;
+		if ((size_t)(buf_end - p) < 1 + size)
+			break;
+
+		*q++ = (1 << 3) | 2; // StoreRequest.records = 1
+		memcpy(q, p, 1 + size);
+		q += 1 + size;
+		p += 1 + size;
+		records++;
+	}
+
+	*out_size = q - out;
+	*consumed = p - buf;
+	return records;
+}
@@ -0,0 +1,71 @@
+// Bulk conversion of comma separated flow records (as exported by
+// nfdump) to serialized pep3.FlowRecords; see pep3_collect.py.
+
+// kinds of columns
+#define FLOWS_IGNORED 0
+#define FLOWS_SOURCE_IP 1
+#define FLOWS_DESTINATION_IP 2
+#define FLOWS_SERIAL 3
+// FLOWS_ANONYMOUS_PART + i is the column for the field with number i
+// of pep3.FlowRecord.AnonymousPart
+#define FLOWS_ANONYMOUS_PART 16
+
+// maximal size of one serialized record produced by flows_parse_*
+#define FLOWS_MAX_RECORD_SIZE 128
+
+// size of a record in the fixed-width binary format, which consists of
+// the following fields, in network byte order:
+//
+//   offset  size  field
+//        0    16  source ip (ipv4 addresses as 2002::a.b.c.d)
+//       16    16  destination ip (idem)
+//       32     8  start time
+//       40     8  end time
+//       48     4  number of packets
+//       52     4  number of bytes
+//       56     2  source port
+//       58     2  destination port
+//       60     1  protocol
+//       61     3  (padding)
+#define FLOWS_BINARY_RECORD_SIZE 64
+
+// Parses the lines in buf (of size n) of which the columns are
+// described by the ncolumns kinds in column_kinds, until either
+// max_records lines have been parsed, or the end of buf is reached;
+// the last line in buf must end with a newline.
+//
+// For each line it writes a serialized FlowRecord, preceded by the tag
+// and length of the field pep3.StoreRequest.records, to out, which
+// should have room for max_records*FLOWS_MAX_RECORD_SIZE bytes; so out
+// will contain a serialized StoreRequest.  The number of bytes written
+// to out and the number of bytes of buf consumed are stored in out_size
+// and consumed, respectively.
+//
+// If there is a serial column, serial[0] should be 0 before the first
+// call, and serial[1] holds the last serial number seen when serial[0]
+// is 1.  When the serial number of a line is not one more than the
+// previous one, both are appended to jumps, which should thus have
+// room for 2*max_records numbers, and njumps is increased.
+//
+// Returns the number of records parsed, or -1-i when the i-th line
+// (counting from 0) could not be parsed.
+int flows_parse_csv(const unsigned char *buf, size_t n,
+		const int *column_kinds, int ncolumns,
+		unsigned char *out, size_t *out_size, size_t *consumed,
+		int max_records,
+		unsigned long long *serial, unsigned long long *jumps,
+		int *njumps);
+
+// Like flows_parse_csv, but parses the records of the fixed-width
+// binary format described above;  a partial record at the end of buf
+// is not consumed.
+int flows_parse_binary(const unsigned char *buf, size_t n,
+		unsigned char *out, size_t *out_size, size_t *consumed,
+		int max_records);
+
+// Like flows_parse_csv, but parses a stream of serialized FlowRecords,
+// each preceded by its length as varint;  a partial record at the end
+// of buf is not consumed.  Records of 128 bytes or more are rejected.
+int flows_parse_delimited(const unsigned char *buf, size_t n,
+		unsigned char *out, size_t *out_size, size_t *consumed,
+		int max_records);
@@ -9,6 +9,7 @@ class Investigator(pep3_pb2_grpc.InvestigatorServicer):
         self.pep = pep
 
     Depseudonymize = researcher.Researcher.Depseudonymize
+    DepseudonymizeBulk = researcher.Researcher.DepseudonymizeBulk
     Query = researcher.Researcher.Query
 
 
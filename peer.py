@@ -9,9 +9,8 @@ from OpenSSL import crypto
 
 import common
 import ed25519
-import elgamal
-import schnorr
 import cryptopu
+import xasyncio
 import time
 
 class Peer(pep3_pb2_grpc.PeerServicer):
@@ -24,6 +23,88 @@ class Peer(pep3_pb2_grpc.PeerServicer):
         self.messages_lock = threading.Lock()
         self.messages_queues = []
 
+        # scalars derived from the secrets, see _component
+        self.scalars_cache = common.LRUCache(1024)
+
+        # see _warrant_is_valid
+        self._warrants_certificate = crypto.load_certificate(
+                crypto.FILETYPE_PEM, 
+                pep.global_config.root_certificates.warrants)
+        self.warrants_cache = common.LRUCache(1024)
+
+    # called by PepContext.reload_secrets
+    def secrets_reloaded(self):
+        self.scalars_cache.clear()
+
+    # Checks the signature of the given warrant (of either type) against
+    # the warrants root certificate;  the digests of the warrants found
+    # to be valid are remembered, so that a warrant presented again
+    # (such as the collector's) is not checked again.
+    def _warrant_is_valid(self, warrant):
+        act = warrant.act.SerializeToString()
+        try:
+            self.warrants_cache.get(
+                    common.sha256(act) + common.sha256(warrant.signature),
+                    lambda: crypto.verify(self._warrants_certificate,
+                        warrant.signature, act, 'sha256'))
+        except crypto.Error:
+            return False
+        return True
+
+    # Returns pow(secret, sha256(name), l), where secret is the 
+    # pseudonym component secret of the given shard when domain==None,
+    # and the key component secret for the given domain otherwise.
+    def _component(self, shard, domain, name):
+        def compute():
+            shard_secrets = self.pep.secrets.by_shard[shard]
+            if domain==None:
+                secret = shard_secrets.pseudonym_component_secret
+            else:
+                secret = shard_secrets.by_domain[domain].key_component_secret
+            return pow(ed25519.scalar_unpack(secret), 
+                    ed25519.scalar_unpack(common.sha256(name)), ed25519.l)
+
+        return self.scalars_cache.get(("component", shard, domain, name), 
+                compute)
+
+    # the product of the _component(shard, domain, name) over the shards
+    def _components_product(self, shards, domain, name):
+        result = 1
+        for shard in shards:
+            result *= self._component(shard, domain, name)
+            result %= ed25519.l
+        return result
+
+    # returns the rekey and reshuffle scalars (k, s) for relocalizing
+    # according to the given act (with the given shards.)
+    def _relocalization_scalars(self, shards, act):
+        assert(len(set(shards))==len(shards))
+
+        def compute():
+            s = self._components_product(shards, None, act.target)
+
+            k = 1
+            if act.encrypt_for != b"":
+                k = self._components_product(shards, "pseudonym", 
+                        act.encrypt_for)
+
+            encrypt_from = act.source
+            if encrypt_from==b"plaintext":
+                encrypt_from = act.actor
+            k *= ed25519.scalar_inv(self._components_product(shards, 
+                "pseudonym", encrypt_from))
+            k %= ed25519.l
+
+            if act.source != b"plaintext":
+                s *= ed25519.scalar_inv(self._components_product(shards,
+                    None, act.source))
+                s %= ed25519.l
+
+            return k, s
+
+        return self.scalars_cache.get(("relocalization", frozenset(shards),
+            act.target, act.source, act.encrypt_for, act.actor), compute)
+
     def _dispatch_message(self, msg):
         msg.modePlusOne = self._mode+1
         with self.messages_lock:
@@ -50,6 +131,11 @@ class Peer(pep3_pb2_grpc.PeerServicer):
             context.abort(grpc.StatusCode.INVALID_ARGUMENT,
                     "request.which_shards is empty")
 
+        # (the scalars cache is keyed on the set of shards)
+        if len(set(request.which_shards))!=len(request.which_shards):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                    "request.which_shards contains duplicates")
+
         if len(request.names)==0:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT,
                     "request.names is empty")
@@ -60,64 +146,25 @@ class Peer(pep3_pb2_grpc.PeerServicer):
                     f"you, {common_name}, presented a warrant that "
                     f"was issued to {request.warrant.act.actor}")
 
-        try:
-            crypto.verify(crypto.load_certificate(crypto.FILETYPE_PEM,
-                        self.pep.global_config.root_certificates.warrants),
-                    request.warrant.signature,
-                    request.warrant.act.SerializeToString(),'sha256')
-        except crypto.Error as e:
+        if not self._warrant_is_valid(request.warrant):
             context.abort(grpc.StatusCode.PERMISSION_DENIED,
                     "the warrant's signature appears to be invalid")
 
         response = pep3_pb2.RelocalizationResponse()
 
         act = request.warrant.act
-
-        k = s = 1
-        for shard in request.which_shards:
-            s *= pow(ed25519.scalar_unpack(self.pep.secrets.by_shard[shard]\
-                        .pseudonym_component_secret), 
-                ed25519.scalar_unpack(common.sha256(act.target)), ed25519.l)
-            s %= ed25519.l
-
-        if act.encrypt_for != b"":
-            for shard in request.which_shards:
-                k *= pow(ed25519.scalar_unpack(self.pep.secrets.by_shard[shard]\
-                            .by_domain["pseudonym"].key_component_secret),
-                    ed25519.scalar_unpack(common.sha256(act.encrypt_for)), 
-                    ed25519.l)
-                k %= ed25519.l
-
-        k_inv_comp = 1
-        encrypt_from = act.source
-        if encrypt_from==b"plaintext":
-            encrypt_from = act.actor
-        for shard in request.which_shards:
-            k_inv_comp *= \
-                pow(ed25519.scalar_unpack(self.pep.secrets.by_shard[shard]\
-                        .by_domain["pseudonym"].key_component_secret),
-                ed25519.scalar_unpack(common.sha256(encrypt_from)), 
-                ed25519.l)
-            k_inv_comp %= ed25519.l
-        k = ( k * ed25519.scalar_inv(k_inv_comp) ) % ed25519.l
-
-        if act.source != b"plaintext":
-            for shard in request.which_shards:
-                s *= ed25519.scalar_inv(pow(ed25519.scalar_unpack(
-                    self.pep.secrets.by_shard[shard]\
-                            .pseudonym_component_secret), 
-                    ed25519.scalar_unpack(common.sha256(act.source)),
-                    ed25519.l))
-                s %= ed25519.l
+        k, s = self._relocalization_scalars(request.which_shards, act)
 
         names = request.names
 
         # reshuffle, rekey, and rerandomize
         try:
-            self.pep._cryptopu.rsk(names, k, s, 
-                    [ ed25519.scalar_random() for i in range(len(names)) ])
+            triples = cryptopu.join_data(names, 96)
+            self.pep._cryptopu.rsk_packed(triples, k, s)
         except cryptopu.InvalidArgument as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        cryptopu.split_data(names, triples, 96)
         
         # change the state of the names if we rekeyed
         if act.encrypt_for != b"":
@@ -160,7 +207,7 @@ class Peer(pep3_pb2_grpc.PeerServicer):
                 x = ed25519.scalar_unpack(domain_secrets.private_master_key)
                 k = ed25519.scalar_unpack(domain_secrets.key_component_secret)
 
-                k_local = pow(k,e,ed25519.l)
+                k_local = self._component(shard, domain, common_name)
                 
                 if return_components:
                     self.pep._cryptopu.certified_component_create(
@@ -207,35 +254,96 @@ class Peer(pep3_pb2_grpc.PeerServicer):
 
     @Depseudonymize.case(pep3_pb2.Mode.ON)
     def Depseudonymize(self, request, context):
+        response = pep3_pb2.DepseudonymizationResponse()
+
+        rs_proofs, names = self._depseudonymize(request, [ request.warrant ],
+                [ ([ link.peer_response.rs_proof ],
+                    [ link.peer_response.name ]) for link in request.chain ],
+                response, context)
+
+        response.rs_proof = rs_proofs[0]
+        response.name.CopyFrom(names[0])
+
+        return response
+
+    @common.switch
+    def DepseudonymizeBulk(self, request, context):
+        return self._mode
+
+    @DepseudonymizeBulk.case(pep3_pb2.Mode.OFF)
+    def DepseudonymizeBulk(self, request, context):
+        context.abort(grpc.StatusCode.UNAVAILABLE, "Peer is OFF.")
+
+    @DepseudonymizeBulk.case(pep3_pb2.Mode.FAULTY)
+    def DepseudonymizeBulk(self, request, context):
+        return pep3_pb2.BulkDepseudonymizationResponse()
+
+    @DepseudonymizeBulk.case(pep3_pb2.Mode.ON)
+    def DepseudonymizeBulk(self, request, context):
+        if len(request.warrants)==0:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                    "request.warrants is empty")
+
+        for i, link in enumerate(request.chain):
+            if len(link.peer_response.rs_proofs)!=len(request.warrants) \
+                    or len(link.peer_response.names)!=len(request.warrants):
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                        f"link #{i} does not contain a name and rs proof "
+                        "for each warrant")
+
+        response = pep3_pb2.BulkDepseudonymizationResponse()
+
+        rs_proofs, names = self._depseudonymize(request, request.warrants,
+                [ (link.peer_response.rs_proofs, link.peer_response.names)
+                    for link in request.chain ],
+                response, context)
+
+        response.rs_proofs.extend(rs_proofs)
+        response.names.extend(names)
+
+        return response
+
+    # Common part of Depseudonymize and DepseudonymizeBulk.  The request 
+    # is either a DepseudonymizationRequest or BulkDepseudonymizationRequest,
+    # and names_by_link[i] is the pair (rs_proofs, names) of the i-th link,
+    # both of which have an entry for each of the warrants.
+    # The parts of the response concerning the reshuffle factor s (which 
+    # are the same for all warrants) are set on the given response, 
+    # while the rs proofs and the depseudonymized names are returned.
+    def _depseudonymize(self, request, warrants, names_by_link, response,
+            context):
         common_name = common.authenticate(context)
         e = ed25519.scalar_unpack(common.sha256(common_name))
 
         self._dispatch_message(pep3_pb2.Message(text="Depseudonymizing", 
             code=pep3_pb2.Message.OK))
 
-        # catch trivial errors
-        if len(request.warrant.signature)==0:
-            context.abort(grpc.StatusCode.PERMISSION_DENIED,
-                    "warrant has empty signature")
-
         if len(request.which_shards)==0:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT,
                     "request.which_shards is empty")
 
-        # verify warrant
-        if common_name != request.warrant.act.actor:
-            context.abort(grpc.StatusCode.PERMISSION_DENIED,
-                    f"you, {common_name}, presented a warrant that "
-                    f"was issued to {request.warrant.act.actor}")
+        # (the scalars cache is keyed on the set of shards)
+        if len(set(request.which_shards))!=len(request.which_shards):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                    "request.which_shards contains duplicates")
 
-        try:
-            crypto.verify(crypto.load_certificate(crypto.FILETYPE_PEM,
-                        self.pep.global_config.root_certificates.warrants),
-                    request.warrant.signature,
-                    request.warrant.act.SerializeToString(),'sha256')
-        except crypto.Error as e:
-            context.abort(grpc.StatusCode.PERMISSION_DENIED,
-                    "the warrant's signature appears to be invalid")
+        # verify warrants
+        for j, warrant in enumerate(warrants):
+            which = "warrant" if len(warrants)==1 else f"warrant #{j}"
+
+            # catch trivial errors
+            if len(warrant.signature)==0:
+                context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                        f"{which} has empty signature")
+
+            if common_name != warrant.act.actor:
+                context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                        f"you, {common_name}, presented a {which} that "
+                        f"was issued to {warrant.act.actor}")
+
+            if not self._warrant_is_valid(warrant):
+                context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                        f"the {which}'s signature appears to be invalid")
 
         # verify reminders
         for i, reminder in enumerate(request.reminders):
@@ -244,9 +352,21 @@ class Peer(pep3_pb2_grpc.PeerServicer):
                 context.abort(grpc.StatusCode.PERMISSION_DENIED,
                         f"could not verify reminder #{i}.")
 
-        # verify chain
-        name = request.warrant.act.name
-        name_unpacked = elgamal.Triple.unpack(name.data)
+        # make a lookup dictionary for the reminders
+        reminders = {}
+        for reminder in request.reminders:
+            component = reminder.component
+            if component in reminders:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                        "double reminder")
+            reminders[component] = reminder
+
+        # verify chain;  the DHT proofs the links consist of are collected
+        # in dht_proofs, and checked all at once afterwards.
+        pu = self.pep._cryptopu
+        B_packed = pu.base_times(1)
+        names = [ warrant.act.name for warrant in warrants ]
+        dht_proofs = [] # of (error message, instances)
 
         for i, link in enumerate(request.chain):
             if link.peer not in self.pep.global_config.peers:
@@ -260,47 +380,36 @@ class Peer(pep3_pb2_grpc.PeerServicer):
                             f"the peer {link.peer} of link #{i} "
                             f"doesn't hold the shard {shard}!")
 
-            rs_p = schnorr.RSProof.unpack(link.peer_response.rs_proof)
-            sB_p = schnorr.DHTProof.unpack(link.peer_response.sB_proof)
-            sB = ed25519.Point.unpack(link.peer_response.sB)
-            kB = ed25519.Point.B_times(1)
-            s_inv_B = ed25519.Point.unpack(link.peer_response.s_inv_B)
-
-            link_name_unpacked = elgamal.Triple.unpack(
-                    link.peer_response.name.data)
-
-            # check that s_inv_B is the inverse of sB
-            if not sB_p.is_valid_proof_for(sB, s_inv_B, 
-                    ed25519.Point.B_times(1)):
-                context.abort(grpc.StatusCode.PERMISSION_DENIED,
-                        f"could not verify the sB proof of link #{i}.")
-            
-            # check the rs-operation was performed correctly
-            if not rs_p.is_valid_proof_for(name_unpacked, sB, 
-                    link_name_unpacked):
-                context.abort(grpc.StatusCode.PERMISSION_DENIED,
-                        f"could not verify the rs proof of link #{i}.")
-
-            # check that s_inv_B is indeed the product of their factors
-            s_inv_B_factors = [ ed25519.Point.unpack(pp) for
-                    pp in link.peer_response.s_inv_B_factors ]
-
-            s_inv_B_p = schnorr.ProductProof.from_protobuf(
-                    link.peer_response.s_inv_B_proof)
-
-            if not s_inv_B_p.is_valid_proof_for(s_inv_B, s_inv_B_factors):
-                context.abort(grpc.StatusCode.PERMISSION_DENIED,
-                        "could not verify the s_inv_B product proof "
-                        f"for link #{i}.")
-
-            # make a lookup dictionary for the reminders
-            reminders = {}
-            for reminder in request.reminders:
-                component = reminder.component
-                if component in reminders:
-                    context.abort(grpc.StatusCode.INVALID_ARGUMENT,
-                            "double reminder")
-                reminders[component] = reminder
+            peer_response = link.peer_response
+            rs_proofs, link_names = names_by_link[i]
+
+            checks = [
+                    # check that s_inv_B is the inverse of sB
+                    (f"could not verify the sB proof of link #{i}.",
+                        [ (peer_response.sB_proof, peer_response.sB,
+                            peer_response.s_inv_B, B_packed) ]),
+                    # check that s_inv_B is indeed the product of its factors
+                    ("could not verify the s_inv_B product proof "
+                        f"for link #{i}.",
+                        pu.product_proof_dht_instances(
+                            peer_response.s_inv_B_proof,
+                            peer_response.s_inv_B,
+                            peer_response.s_inv_B_factors)) ]
+
+            # check the rs-operations were performed correctly
+            for j in range(len(warrants)):
+                checks.append((f"could not verify the rs proof of link #{i}"
+                    + ("" if len(warrants)==1 else f" for warrant #{j}")
+                    + ".",
+                    pu.rs_proof_dht_instances(rs_proofs[j],
+                        names[j].data, peer_response.sB, 
+                        link_names[j].data)))
+
+            for error_message, instances in checks:
+                if instances==None:
+                    context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                            error_message)
+                dht_proofs.append((error_message, instances))
 
             # check that the provided factors are valid
             for j, shard in enumerate(link.which_shards):
@@ -309,15 +418,16 @@ class Peer(pep3_pb2_grpc.PeerServicer):
 
                 if shard in self.pep.config.shards:
                     # we can check s_inv_B by computing it ourselves
-                    s_ = ed25519.scalar_unpack(self.pep.secrets\
-                            .by_shard[shard].pseudonym_component_secret)
-                    s_B = ed25519.Point.B_times(pow(s_, e, ed25519.l))
-                    if s_B.pack() != s_inv_B_factor_packed:
+                    s_B_packed = self.scalars_cache.get(
+                            ("component_B", shard, common_name),
+                            lambda: pu.base_times(self._component(shard, 
+                                None, common_name)))
+                    if s_B_packed != s_inv_B_factor_packed:
                         context.abort(grpc.StatusCode.PERMISSION_DENIED,
                             f"s_inv_B factor #{j} (for shard {shard}, "
                             f"and common name {common_name}, e={e})"
                             f" of link #{i} is not correct: it should be "
-                            f"{s_B.pack()}, but {s_inv_B_factor_packed} "
+                            f"{s_B_packed}, but {s_inv_B_factor_packed} "
                             "was given.")
                 else: # we need a reminder that s_inv_B is correct
                     if s_inv_B_factor_packed not in reminders:
@@ -340,54 +450,52 @@ class Peer(pep3_pb2_grpc.PeerServicer):
                                 f"s_inv_B factor #{j} of link #{i} " 
                                 "is not correct: " + error_message)
 
-            name = link.peer_response.name
-            name_unpacked = link_name_unpacked
+            names = link_names
+
+        if not pu.dht_proofs_are_valid_for([ instance 
+                for error_message, instances in dht_proofs
+                for instance in instances ]):
+            # find out which proof is wrong
+            for error_message, instances in dht_proofs:
+                for instance in instances:
+                    if not pu.dht_proof_is_valid_for(*instance):
+                        context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                                error_message)
+            context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                    "could not verify the proofs of the chain.")
 
         # the provided request seems to be in order;
         # let us prepare our response.
 
-        response = pep3_pb2.DepseudonymizationResponse()
-
-
-        # compute rekey and reshuffle components
-        k = s_inv = 1
-        s_inv_factors = []
-
-        for shard in request.which_shards:
-            s_inv_factor = pow(ed25519.scalar_unpack(self.pep.secrets\
-                        .by_shard[shard].pseudonym_component_secret), 
-                e, ed25519.l)
-            s_inv_factors.append(s_inv_factor)
+        # compute reshuffle components
+        s_inv_factors = [ self._component(shard, None, common_name)
+                for shard in request.which_shards ]
+        s = self.scalars_cache.get(("depseudonymization", 
+            frozenset(request.which_shards), common_name),
+            lambda: ed25519.scalar_inv(self._components_product(
+                request.which_shards, None, common_name)))
 
-            s_inv *= s_inv_factor
-            s_inv %= ed25519.l
-
-        s = ed25519.scalar_inv(s_inv)
-        r = ed25519.scalar_random()
-
-        rs_proof, name_out = schnorr.RSProof.create(name_unpacked, s, r)
-        response.rs_proof = rs_proof.pack()
+        try:
+            rs_proofs, names_data = pu.rs_proofs_create(
+                    [ name.data for name in names ], s)
+        except cryptopu.InvalidArgument as err:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 
+                    f"could not unpack name: {err}")
 
-        response.name.data = name_out.pack()
-        response.name.state \
-                = pep3_pb2.Pseudonymizable.ENCRYPTED_PSEUDONYM
+        names = [ pep3_pb2.Pseudonymizable(data=data,
+                state=pep3_pb2.Pseudonymizable.ENCRYPTED_PSEUDONYM)
+                    for data in names_data ]
 
         # compute proofs for the reshuffle components
-        s_inv_B_proof, s_inv_B_factors, s_inv_B \
-                = schnorr.ProductProof.create(s_inv_factors)
-        s_inv_B_proof.to_protobuf(response.s_inv_B_proof)
-        for s_inv_B_factor in s_inv_B_factors:
-            response.s_inv_B_factors.append(s_inv_B_factor.pack())
-        response.s_inv_B = s_inv_B.pack()
-
-        sB = ed25519.Point.B_times(s)
-        sB_proof = schnorr.DHTProof.create(s, s_inv_B, A=sB, 
-                N=ed25519.Point.B_times(1))
-        
-        response.sB = sB.pack()
-        response.sB_proof = sB_proof.pack()
+        s_inv_B_factors, response.s_inv_B = pu.product_proof_create(
+                s_inv_factors, response.s_inv_B_proof)
+        response.s_inv_B_factors.extend(s_inv_B_factors)
 
-        return response
+        response.sB = pu.base_times(s)
+        response.sB_proof = pu.dht_proof_create(s, response.s_inv_B, 
+                A_packed=response.sB, N_packed=B_packed)
+
+        return rs_proofs, names
 
 
     def RegisterComponents(self, request, context):
@@ -448,6 +556,25 @@ class Peer(pep3_pb2_grpc.PeerServicer):
             with self.messages_lock:
                 self.messages_queues.remove(q)
 
+    # like Demo_Monitor, but runs on the event loop (see xasyncio.py,)
+    # so that it does not occupy a thread while waiting for messages
+    async def Demo_Monitor_async(self, void, context):
+        await xasyncio.run(self.pep._executor, common.authenticate,
+                xasyncio.SyncContext(context), (b"PEP3 demonstrator",))
+
+        q = xasyncio.Queue()
+
+        with self.messages_lock:
+            self.messages_queues.append(q)
+
+        try:
+            while True:
+                message, stopped = await q.get()
+                yield message
+        finally:
+            with self.messages_lock:
+                self.messages_queues.remove(q)
+
     
     def Demo_SetMode(self, mode, context):
         common.authenticate(context, must_be_one_of=(b"PEP3 demonstrator",))
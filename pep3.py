@@ -12,6 +12,7 @@ import os.path
 import os
 import importlib
 import collections
+import queue
 import threading
 import multiprocessing
 import itertools
@@ -23,6 +24,7 @@ import elgamal
 import cryptopu
 import common
 import xprofile
+import xasyncio
 
 from OpenSSL import crypto
 
@@ -141,11 +143,38 @@ def main():
             type=int,
             default="5",
             help="Number of streams to open to the collector.")
+    parser_collect.add_argument("--prefetch-batches",
+            type=int,
+            default="64",
+            help="Maximal number of batches read ahead of the streams.")
+    parser_collect.add_argument("--prefetch-bytes",
+            type=int,
+            default=str(64*2**20),
+            help="Maximal total size (in bytes) of the batches "
+            "read ahead of the streams.")
     parser_collect.add_argument("--keep-input-open",
             action="store_true",
             help="Also open input file for writing (but don't write "
             "anything to it,) so that when the input file is a fifo "
             "it won't close when the actual writer is done.")
+    parser_collect.add_argument("--format",
+            choices=("auto",) + pep3_collect.FORMATS,
+            default="auto",
+            help="Format of the input: comma separated values (with "
+            "header,) length delimited FlowRecords or StoreRequests, "
+            "or the fixed-width binary format described in flows.h.  "
+            "By default it's guessed from the extension of the input, "
+            f"see {', '.join(pep3_collect.EXTENSION_TO_FORMAT)}, "
+            "and otherwise csv.")
+    parser_collect.add_argument("--compression",
+            choices=("auto",) + pep3_collect.COMPRESSIONS,
+            default="auto",
+            help="Compression of the input;  by default it's detected "
+            "from the first bytes of the input.")
+    parser_collect.add_argument("--rowwise",
+            action="store_true",
+            help="Parse csv input one line at a time in Python, "
+            "instead of in large chunks using the _flows module.")
     parser_collect.add_argument("input")
 
     # .. <server_type_name>
@@ -469,6 +498,7 @@ def fill_local_config_messages(config, secrets):
     root_crt = crypto.X509()
     root_crt.get_subject().CN = "PEP3 TLS Root"
     root_crt.set_serial_number(1)
+    root_crt.set_version(2) # i.e. X.509 v3, as newer grpcio requires
     root_crt.gmtime_adj_notBefore(0)
     root_crt.gmtime_adj_notAfter(356*24*60*60)
     root_crt.set_issuer(root_crt.get_subject())
@@ -489,6 +519,8 @@ def fill_local_config_messages(config, secrets):
 
         for name, server_config in server_configs.items():
             server_config.number_of_threads = number_of_cpus
+            if server_type_name=="peer":
+                server_config.number_of_crypto_threads = number_of_cpus
         
             # set address and port
             server_config.location.address = \
@@ -501,6 +533,7 @@ def fill_local_config_messages(config, secrets):
             server_crt = crypto.X509()
             server_crt.get_subject().CN = "PEP3 " + server_type_name
             server_crt.set_serial_number(1)
+            server_crt.set_version(2)
             server_crt.gmtime_adj_notBefore(0)
             server_crt.gmtime_adj_notAfter(356*24*60*60)
             server_crt.set_issuer(root_crt.get_subject())
@@ -527,6 +560,7 @@ def fill_local_config_messages(config, secrets):
     config.database.engine.poolclass = 'StaticPool'
     config.database.engine.create_tables = True
     config.database.number_of_threads = 1
+    config.database.max_records_per_transaction = 65536
 
     # generate keys for warrants
     warrant_key = crypto.PKey()
@@ -608,8 +642,20 @@ def fill_local_config_messages(config, secrets):
             'protocol', 'packets', 'bytes'):
         columns[name] = 'plain'
 
+    indexes = config.db_desc['peped_flows'].indexes
+    indexes.add(columns=['p_src_ip'], using='hash')
+    indexes.add(columns=['p_dst_ip'], using='hash')
+    indexes.add(columns=['start_time'])
+
     #
     config.batchsize = 1024
+    config.relocalization_subbatchsize = 256
+    config.query_chunks_in_flight = 4
+    config.storage_facility.batched_decryption = True
+    config.collector.max_requests_in_flight = 64
+    config.storage_facility.max_requests_in_flight = 64
+    config.collector.number_of_streams = 2
+    config.storage_facility.number_of_streams = 2
 
         
 class PepContext:
@@ -623,13 +669,12 @@ class PepContext:
         
         if my_instance_name==None:
             self.config = getattr(config, my_type_name)
-            self.secrets = getattr(secrets, my_type_name)
         else:
             if my_instance_name not in getattr(config, my_type_name+"s"):
                 raise ValueError(f"there is no instance of \"{my_type_name}\""
                         f" named \"{my_instance_name}\"")
             self.config = getattr(config, my_type_name+"s")[my_instance_name]
-            self.secrets = getattr(secrets, my_type_name+"s")[my_instance_name]
+        self.secrets = self._my_secrets(secrets)
 
         if executor_type == None:
             executor_type = concurrent.futures.ThreadPoolExecutor
@@ -641,7 +686,9 @@ class PepContext:
         self._public_keys = None
         self._certified_components = None
         self._reminders = None # to the peers that the components are correct
-        self._cryptopu = cryptopu.CryptoPU()
+        self._cryptopu = cryptopu.CryptoPU(number_of_threads=
+                self.config.number_of_crypto_threads 
+                    if my_type_name=="peer" else 1)
 
     def shutdown_start(self):
         if not hasattr(self, "grpc_server"):
@@ -654,6 +701,25 @@ class PepContext:
     def shutdown_finish(self):
         if hasattr(self, "_executor"):
             self._executor.shutdown()
+        if hasattr(self, "grpc_server") and self.global_config.asyncio:
+            self.grpc_server.close()
+        self._cryptopu.shutdown()
+
+    def _my_secrets(self, secrets):
+        if self.my_instance_name==None:
+            return getattr(secrets, self.my_type_name)
+        return getattr(secrets, self.my_type_name+"s")[self.my_instance_name]
+
+    # replaces the secrets used by this server by those in the given
+    # Secrets message, and lets the servicer forget what it derived
+    # from the old secrets.
+    def reload_secrets(self, secrets):
+        with self._lock:
+            self.secrets = self._my_secrets(secrets)
+            self._connections = {}
+        servicer = getattr(self, "grpc_servicer", None)
+        if hasattr(servicer, "secrets_reloaded"):
+            servicer.secrets_reloaded()
 
     @property
     def MyTypeName(self):
@@ -714,9 +780,12 @@ class PepContext:
         self._executor = self._executor_type(
                 max_workers=self.config.number_of_threads,
                 thread_name_prefix=str(self))
-        server = grpc.server(self._executor, 
-                # do not allow the reuse of ports
-                options=(('grpc.so_reuseport',0),))
+        # do not allow the reuse of ports
+        options = (('grpc.so_reuseport',0),)
+        if self.global_config.asyncio:
+            server = xasyncio.Server(self._executor, options=options)
+        else:
+            server = grpc.server(self._executor, options=options)
         server.add_secure_port(self.config.location.listen_address, 
                 server_credentials)
 
@@ -744,8 +813,14 @@ class PepContext:
                 % (server_name,ServerTypeName)
         servicer_class = getattr(server_module, ServerTypeName)
         self.grpc_servicer = servicer_class(self)
-        getattr( pep3_pb2_grpc, "add_" + ServerTypeName 
-                + "Servicer_to_server" )(self.grpc_servicer, self.grpc_server)
+        add_function = getattr( pep3_pb2_grpc, "add_" + ServerTypeName 
+                + "Servicer_to_server" )
+        if self.global_config.asyncio:
+            xasyncio.add_servicer_to_server(self.grpc_servicer,
+                    pep3_pb2.DESCRIPTOR.services_by_name[ServerTypeName],
+                    add_function, self.grpc_server)
+        else:
+            add_function(self.grpc_servicer, self.grpc_server)
 
 
     def _enroll(self):
@@ -902,7 +977,7 @@ class PepContext:
             name.state = pep3_pb2.Pseudonymizable.UNENCRYPTED_PSEUDONYM
         self._cryptopu.decrypt(names, key)
 
-    def relocalize(self, pseudonyms, warrant):
+    def relocalize(self, pseudonyms, warrant, subbatchsize=None):
         if len(pseudonyms)==0:
             return
 
@@ -911,54 +986,130 @@ class PepContext:
                 pep3_pb2.Pseudonymizable.ENCRYPTED_PSEUDONYM,
                 pep3_pb2.Pseudonymizable.ENCRYPTED_NAME))
 
-        request = pep3_pb2.RelocalizationRequest()
-        request.warrant.CopyFrom(warrant)
-        request.names.extend(pseudonyms)
-        
-        unused_peers = set(self.global_config.peers)
-        unassigned_shards = set(self.global_config.shards)
+        if subbatchsize==None:
+            subbatchsize = self.global_config.relocalization_subbatchsize
 
-        while len(unassigned_shards)>0:
-            if len(unused_peers)==0:
-                raise RuntimeError("Not enough working peers")
+        if subbatchsize==0 or len(pseudonyms)<=subbatchsize:
+            subbatchsize = len(pseudonyms)
 
-            peer = random.choice(list(unused_peers))
-            unused_peers.remove(peer)
-            
-            shards = unassigned_shards \
-                            & set(self.global_config.peers[peer].shards)
+        self._relocalize_in_subbatches(pseudonyms, warrant, subbatchsize)
 
-            request.ClearField('which_shards')
-            request.which_shards.extend(shards)
+    # Splits the pseudonyms into sub-batches, and sends each of them
+    # along the peers of a single plan made up front, so that, say,
+    # peer B is already relocalizing the first sub-batch while peer A
+    # still works on the second.  With only one sub-batch, this simply
+    # passes the pseudonyms along the peers one after the other.
+    def _relocalize_in_subbatches(self, pseudonyms, warrant, subbatchsize):
+        plan = self._plan_cover(self.global_config.peers,
+                self.global_config.shards)
+
+        failed_peers = set()
+        done_queue = queue.SimpleQueue() # receives (subbatch, future)
+        in_flight = set()
+
+        def send(subbatch):
+            if subbatch.plan[0][0] in failed_peers:
+                subbatch.replan(failed_peers)
+
+            peer, shards = subbatch.plan[0]
+            subbatch.request.ClearField('which_shards')
+            subbatch.request.which_shards.extend(shards)
 
             # TODO: random check of peers
-            try:
-                resp = self.connect_to("peer", peer).Relocalize(request)
-                assert(len(resp.names)==len(pseudonyms))
-            except grpc.RpcError as e:
-                logging.warn(f"relocalization request to peer {peer}"
-                        f" failed: {e.details()}")
-                # TODO: differentiate between errors; was it our fault,
-                # or did the peer fail?
+            fut = self.connect_to("peer", peer)\
+                    .Relocalize.future(subbatch.request)
+            in_flight.add(fut)
+            fut.add_done_callback(
+                    lambda fut: done_queue.put( (subbatch, fut) ))
+
+        try:
+            for start in range(0, len(pseudonyms), subbatchsize):
+                send(_RelocalizationSubBatch(self,
+                    pseudonyms[start:start+subbatchsize], warrant, plan))
+
+            while len(in_flight)>0:
+                subbatch, fut = done_queue.get()
+                in_flight.remove(fut)
+
+                peer, shards = subbatch.plan[0]
+                subbatch.used_peers.add(peer)
+
+                try:
+                    resp = fut.result()
+                except grpc.RpcError as e:
+                    # We can not tell whether the request failed by
+                    # our fault or the peer's, so we try the shards
+                    # of this peer elsewhere; if it was our fault,
+                    # we'll run out of peers soon enough.
+                    logging.warning(f"relocalization request to peer "
+                            f"{peer} failed: {e.details()}")
+                    failed_peers.add(peer)
+                    subbatch.replan(failed_peers)
+                    send(subbatch)
+                    continue
+
+                assert(len(resp.names)==len(subbatch.pseudonyms))
+                subbatch.plan.pop(0)
+
+                if len(subbatch.plan)>0:
+                    subbatch.request.ClearField('names')
+                    subbatch.request.names.extend(resp.names)
+                    send(subbatch)
+                    continue
+
+                for i in range(len(subbatch.pseudonyms)):
+                    subbatch.pseudonyms[i].CopyFrom(resp.names[i])
+        except Exception:
+            # don't leave the other sub-batches running behind our back
+            for fut in in_flight:
+                fut.cancel()
+            while len(in_flight)>0:
+                _, fut = done_queue.get()
+                in_flight.discard(fut)
+            raise
+
+    # Returns a list [ (peer1, shards1), (peer2, shards2), ... ] of
+    # peers (chosen in random order from the given peers) together
+    # with disjoint sets of the given shards held by them that cover
+    # all the given shards.
+    def _plan_cover(self, peers, shards):
+        plan = []
+        unassigned_shards = set(shards)
+
+        peers = list(peers)
+        random.shuffle(peers)
+
+        for peer in peers:
+            if len(unassigned_shards)==0:
+                break
+
+            peer_shards = unassigned_shards \
+                    & set(self.global_config.peers[peer].shards)
+            if len(peer_shards)==0:
                 continue
-            
-            unassigned_shards -= shards
-            request.ClearField('names')
-            request.names.extend(resp.names)
 
-        for i in range(len(pseudonyms)):
-            pseudonyms[i].CopyFrom(resp.names[i])
+            plan.append( (peer, peer_shards) )
+            unassigned_shards -= peer_shards
+
+        if len(unassigned_shards)>0:
+            raise RuntimeError("Not enough working peers")
+
+        return plan
 
 
     def depseudonymize(self, warrant, out):
-        request = pep3_pb2.DepseudonymizationRequest()
-        request.warrant.CopyFrom(warrant)
-        
-        # let's plan which peers to contact for which shards
-        plan = []
-        # will be [ (peer1, (shard1, shard2, ..., shard42)),
-        #           (peer2, (sercret43, shard44, ..)), ... ]
+        self.depseudonymize_bulk([ warrant ], [ out ])
+
+    # Depseudonymizes the names of the given warrants into the given 
+    # Pseudonymizables, by passing them all through one chain of peers.
+    def depseudonymize_bulk(self, warrants, outs):
+        assert(len(warrants)==len(outs))
+        if len(warrants)==0:
+            return
 
+        request = pep3_pb2.BulkDepseudonymizationRequest()
+        request.warrants.extend(warrants)
+        
         unused_peers = set(self.global_config.peers)
         unassigned_shards = set(self.global_config.shards)
 
@@ -975,8 +1126,6 @@ class PepContext:
             shards = unassigned_shards \
                             & set(self.global_config.peers[peer].shards)
 
-            # plan.append( (peer, shards) )
-
             request.ClearField('which_shards')
             request.ClearField('reminders')
             request.which_shards.extend(shards)
@@ -989,7 +1138,8 @@ class PepContext:
                     reminder_.CopyFrom(reminder)
             
             try:
-                resp = self.connect_to("peer", peer).Depseudonymize(request)
+                resp = self.connect_to("peer", peer)\
+                        .DepseudonymizeBulk(request)
                 # TODO: check the proofs provided by the peer
             except grpc.RpcError as e:
                 logging.warning(f"depseudonymization request to peer {peer}"
@@ -1005,12 +1155,39 @@ class PepContext:
             link.which_shards.extend(shards)
             shards_in_the_chain.update(shards)
             
-        out.CopyFrom(resp.name)
+        assert(len(resp.names)==len(outs))
+        for out, name in zip(outs, resp.names):
+            out.CopyFrom(name)
+
+        # decrypt the results
+        self.decrypt(outs, self.private_keys['pseudonym'])
+        for out in outs:
+            out.data = ed25519.Point.unpack(out.data).lizard_inv()
+            out.state = pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME
+
+
+# helper class for PepContext._relocalize_in_subbatches
+class _RelocalizationSubBatch:
+    def __init__(self, pep, pseudonyms, warrant, plan):
+        self.pep = pep
+        self.pseudonyms = pseudonyms
+        self.plan = list(plan) # the steps still to be taken
+        self.used_peers = set()
+
+        self.request = pep3_pb2.RelocalizationRequest()
+        self.request.warrant.CopyFrom(warrant)
+        self.request.names.extend(pseudonyms)
+
+    def replan(self, failed_peers):
+        unassigned_shards = set()
+        for peer, shards in self.plan:
+            unassigned_shards.update(shards)
+
+        self.plan = self.pep._plan_cover(
+                set(self.pep.global_config.peers)
+                    - self.used_peers - failed_peers,
+                unassigned_shards)
 
-        # decrypt the result
-        self.decrypt([ out ], self.private_keys['pseudonym'])
-        out.data = ed25519.Point.unpack(out.data).lizard_inv()
-        out.state = pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME
 
 def raise_nofile_limit(to=1024):
     import resource
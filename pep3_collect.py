@@ -5,10 +5,16 @@ import common
 import sys
 import threading
 import os
+import io
+import stat
+import mmap
+import gzip
+import itertools
 
 import pep3
 
 import pep3_pb2
+import _flows as flows
 
 def collect(args):
     Collect(args).run()
@@ -28,54 +34,18 @@ class Collect:
                     open(self.args.input, "w")
                 )).start()
 
-            self.inputf = open(self.args.input,'r')
-            stack.enter_context(self.inputf)
-
-            cell_index_to_handler = None
-
-            # read header
-            line = next(self.inputf)
-            bits = tuple(map(lambda x: x.strip(),line.split(",")))
-
-            # see if we've got a header
-            header_name_count = len([bit for bit in bits 
-                if bit in HEADER_NAME_TO_HANDLER]) 
-            if header_name_count < len(bits):
-                # we didn't recognise all fields of the header
-                raise Exception(f"{self.args.input}:"
-                        f" I think this '{line}' is a header, but do not"
-                        " recognize these field(s): " 
-                        + ", ".join(filter(lambda bit: 
-                                bit not in HEADER_NAME_TO_HANDLER, 
-                            bits)) + ".")
-            # we've definitely got a header
-            cell_index_to_handler = [ HEADER_NAME_TO_HANDLER[bit]
-                    for bit in bits ]
-
-            def batch_generator():
-                request = pep3_pb2.StoreRequest()
-
-                for linenr, line in enumerate(self.inputf):
-                    linenr += 1 # the header was line nr. 0
-
-                    bits = tuple(map(lambda x: x.strip(),line.split(",")))
-
-                    record = request.records.add()
-
-                    for index, bit in enumerate(bits):
-                        cell_index_to_handler[index](record, bit)
-
-                    if linenr % self.args.batchsize==0:
-                        cpy = pep3_pb2.StoreRequest()
-                        cpy.CopyFrom(request)
-                        cpy.id = linenr.to_bytes(8, byteorder="big")
-                        yield cpy
-                        request.Clear()
-            
-                if request.records:
-                    yield request
+            self.inputf = open_input(self.args.input, 
+                    self.args.compression, stack)
+
+            batches = read_batches(self.inputf, self.args.input, 
+                    self.args.format, self.args.batchsize,
+                    rowwise=self.args.rowwise)
 
-            queue = common.chuck(batch_generator())
+            queue = common.chuck(batches, 
+                    maxitems=self.args.prefetch_batches,
+                    maxbytes=self.args.prefetch_bytes,
+                    sizeof=lambda request: request.ByteSize())
+            stack.callback(queue.close)
 
             gens = [ self.collector.Store(queue)
                     for i in range(self.args.streamcount) ]
@@ -88,18 +58,296 @@ class Collect:
                     counter += 1
                     if all_done.wait(.1):
                         break
-                    sys.stdout.write(f"{counter/10} {queue.size()}\r")
+                    sys.stdout.write(f"{counter/10} {queue.size()} "
+                            f"({queue.nbytes()/2**20:.1f} MiB) prefetched, "
+                            f"reader stalled {queue.producer_stall:.1f}s, "
+                            f"streams stalled {queue.consumer_stall:.1f}s\r")
 
             status_printer_thread = threading.Thread(target=status_printer)
             status_printer_thread.start()
+            stack.callback(status_printer_thread.join)
+            stack.callback(all_done.set)
 
             # wait for all streams to finish
             for gen in gens:
                 for item in gen:
                     pass
 
-            all_done.set()
-            status_printer_thread.join()
+
+# Returns the handlers for the columns of the given header line.
+def parse_header(path, line):
+    bits = tuple(map(lambda x: x.strip(),line.split(",")))
+
+    # see if we've got a header
+    header_name_count = len([bit for bit in bits 
+        if bit in HEADER_NAME_TO_HANDLER]) 
+    if header_name_count < len(bits):
+        # we didn't recognise all fields of the header
+        raise Exception(f"{path}:"
+                f" I think this '{line}' is a header, but do not"
+                " recognize these field(s): " 
+                + ", ".join(filter(lambda bit: 
+                        bit not in HEADER_NAME_TO_HANDLER, 
+                    bits)) + ".")
+    # we've definitely got a header
+    return [ HEADER_NAME_TO_HANDLER[bit] for bit in bits ]
+
+
+# Yields StoreRequests with batchsize records (except for the last one)
+# made from the lines read from the (binary) file inputf, 
+# using the given cell handlers one line at a time.
+def rowwise_batches(inputf, handlers, batchsize):
+    request = pep3_pb2.StoreRequest()
+
+    for linenr, line in enumerate(inputf):
+        linenr += 1 # the header was line nr. 0
+
+        bits = tuple(map(lambda x: x.strip(),
+            line.decode('utf-8').split(",")))
+
+        record = request.records.add()
+
+        for index, bit in enumerate(bits):
+            handlers[index](record, bit)
+
+        if linenr % batchsize==0:
+            cpy = pep3_pb2.StoreRequest()
+            cpy.CopyFrom(request)
+            cpy.id = linenr.to_bytes(8, byteorder="big")
+            yield cpy
+            request.Clear()
+
+    if request.records:
+        yield request
+
+
+# Does the same as rowwise_batches, but reads inputf in chunks of 
+# chunksize bytes, and has _flows turn all lines of a chunk directly
+# into a serialized StoreRequest at once.
+def columnar_batches(inputf, path, handlers, batchsize, chunksize=2**20):
+    ffi, lib = flows.ffi, flows.lib
+
+    kinds = ffi.new("int[]", [ column_kind(handler) 
+        for handler in handlers ])
+    serial = ffi.new("unsigned long long[2]")
+    jumps = ffi.new("unsigned long long[]", 2*batchsize)
+    njumps = ffi.new("int*")
+
+    def parse(buf, n, out, out_size, consumed, max_records):
+        njumps[0] = 0
+        result = lib.flows_parse_csv(buf, n, kinds, len(handlers), 
+                out, out_size, consumed, max_records, serial, jumps, njumps)
+        for i in range(njumps[0]):
+            print(f"WARNING: jump from serial number {jumps[2*i]} "
+                    f"to {jumps[2*i+1]}")
+        return result
+
+    return chunked_batches(read_chunks(inputf, chunksize), path, parse, 
+            batchsize, "line", terminator=b"\n")
+
+
+# Yields StoreRequests with batchsize records (except for the last one)
+# from the given chunks of bytes, using parse, which should behave like
+# (and is usually one of) the flows_parse_* functions from _flows, 
+# see flows.h.  Records may be split over several chunks.
+#
+# A record at the very end without terminator is completed with it,
+# or is an error when terminator is None.
+def chunked_batches(chunks, path, parse, batchsize, what, terminator=None):
+    ffi, lib = flows.ffi, flows.lib
+
+    out = ffi.new("unsigned char[]", batchsize*lib.FLOWS_MAX_RECORD_SIZE)
+    out_size = ffi.new("size_t*")
+    consumed = ffi.new("size_t*")
+
+    linenr = 0 # number of records parsed (so the header is line nr. 0)
+    records = [] # serialized records of the current batch
+    count = 0 # number of records in the current batch
+    leftover = b""
+
+    for chunk in itertools.chain(chunks, (None,)):
+        if chunk==None:
+            if len(leftover)==0:
+                break
+            if terminator==None:
+                raise ValueError(f"{path}:{linenr+1}: this {what} "
+                        "is truncated")
+            buf = leftover + terminator
+        elif len(leftover)>0:
+            buf = leftover + chunk
+        else:
+            buf = chunk
+
+        cbuf = ffi.from_buffer("unsigned char[]", buf)
+        pos = 0
+
+        while True:
+            n = parse(cbuf+pos, len(buf)-pos, out, out_size, consumed,
+                    batchsize - count)
+            if n<0:
+                raise ValueError(f"{path}:{linenr-n}: could not parse "
+                        f"this {what}")
+
+            linenr += n
+            count += n
+            pos += consumed[0]
+            records.append(ffi.buffer(out, out_size[0])[:])
+
+            if count==batchsize:
+                request = pep3_pb2.StoreRequest.FromString(b"".join(records))
+                request.id = linenr.to_bytes(8, byteorder="big")
+                yield request
+                records.clear()
+                count = 0
+                continue
+
+            if n==0 or pos==len(buf):
+                break
+
+        leftover = bytes(buf[pos:])
+        ffi.release(cbuf)
+        del buf, chunk
+
+    if count>0:
+        yield pep3_pb2.StoreRequest.FromString(b"".join(records))
+
+
+# Yields the StoreRequests from inputf, which should contain a stream
+# of StoreRequests each preceded by its length (as varint.)
+def delimited_storerequests(inputf, path):
+    while True:
+        size, shift = 0, 0
+        while True:
+            byte = inputf.read(1)
+            if len(byte)==0:
+                if shift==0:
+                    return
+                raise ValueError(f"{path}: truncated length at the end")
+            size |= (byte[0] & 0x7f) << shift
+            shift += 7
+            if byte[0] < 0x80:
+                break
+
+        data = inputf.read(size)
+        if len(data) < size:
+            raise ValueError(f"{path}: truncated StoreRequest at the end")
+        yield pep3_pb2.StoreRequest.FromString(data)
+
+
+# Yields the contents of inputf from its current position in chunks
+# of (about) chunksize bytes.  When inputf is an ordinary uncompressed 
+# file it is memory mapped instead, and yielded in one go.
+def read_chunks(inputf, chunksize=2**20):
+    if isinstance(inputf, io.BufferedReader) \
+            and isinstance(inputf.raw, io.FileIO):
+        st = os.fstat(inputf.fileno())
+        pos = inputf.tell()
+        if stat.S_ISREG(st.st_mode):
+            if st.st_size > pos:
+                # the map is closed when the last view on it is gone
+                yield memoryview(mmap.mmap(inputf.fileno(), 0, 
+                    access=mmap.ACCESS_READ))[pos:]
+            return
+
+    read = getattr(inputf, "read1", inputf.read)
+    while True:
+        chunk = read(chunksize)
+        if len(chunk)==0:
+            return
+        yield chunk
+
+
+# Yields StoreRequests with batchsize records from inputf (as opened
+# by open_input) of the given format (see FORMATS).
+def read_batches(inputf, path, format, batchsize, rowwise=False):
+    if format=="auto":
+        format = guess_format(path)
+
+    if format=="csv":
+        handlers = parse_header(path, inputf.readline().decode('utf-8'))
+        if rowwise:
+            return rowwise_batches(inputf, handlers, batchsize)
+        return columnar_batches(inputf, path, handlers, batchsize)
+
+    if format=="storerequests":
+        return delimited_storerequests(inputf, path)
+
+    parse = { "flowrecords": flows.lib.flows_parse_delimited,
+            "binary": flows.lib.flows_parse_binary }[format]
+    return chunked_batches(read_chunks(inputf), path, parse, 
+            batchsize, "record")
+
+
+# Guesses the format of the file at path from its extension, ignoring 
+# the extension of a compression method;  defaults to csv.
+def guess_format(path):
+    root, ext = os.path.splitext(path)
+    if ext in COMPRESSION_EXTENSIONS:
+        root, ext = os.path.splitext(root)
+    return EXTENSION_TO_FORMAT.get(ext, "csv")
+
+
+# Opens the file at path for reading and, if need be, decompresses it;
+# compression is "auto" or one of COMPRESSIONS.  The opened files are
+# added to the given exit stack.
+def open_input(path, compression, stack):
+    inputf = stack.enter_context(open(path, 'rb'))
+
+    if compression=="auto":
+        magic = inputf.peek(4)[:4]
+        compression = "none"
+        for name, prefix in COMPRESSION_MAGIC.items():
+            if magic.startswith(prefix):
+                compression = name
+
+    if compression=="gzip":
+        inputf = stack.enter_context(gzip.GzipFile(fileobj=inputf))
+    elif compression=="zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(f"{path}: reading zstd compressed files "
+                    "requires the zstandard package")
+        inputf = stack.enter_context(io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(inputf)))
+    else:
+        assert(compression=="none")
+
+    return inputf
+
+
+FORMATS = ("csv", "flowrecords", "storerequests", "binary")
+
+EXTENSION_TO_FORMAT = {
+        ".csv": "csv",
+        ".flowrecords": "flowrecords",
+        ".storerequests": "storerequests",
+        ".bin": "binary",
+}
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+COMPRESSION_MAGIC = {
+        "gzip": b"\x1f\x8b",
+        "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+COMPRESSION_EXTENSIONS = (".gz", ".zst")
+
+
+# the kind of column (see flows.h) handled by the given handler
+def column_kind(handler):
+    if isinstance(handler, HandleIPAddress):
+        return { "source_ip": flows.lib.FLOWS_SOURCE_IP,
+                "destination_ip": flows.lib.FLOWS_DESTINATION_IP, 
+            }[handler.fieldname]
+    if isinstance(handler, HandleInt):
+        return flows.lib.FLOWS_ANONYMOUS_PART \
+                + pep3_pb2.FlowRecord.AnonymousPart.DESCRIPTOR\
+                    .fields_by_name[handler.fieldname].number
+    if isinstance(handler, HandleSerial):
+        return flows.lib.FLOWS_SERIAL
+    return flows.lib.FLOWS_IGNORED
 
 
 class HandleIPAddress:
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+
+import pep3_pb2
+
+# A persistent map from plaintext ips to the (encrypted) pseudonyms
+# the collector computed for them, kept in an SQLite database.
+#
+# The store holds at most maxsize pseudonyms;  when more are added,
+# the least recently used are removed.  The store is emptied when it
+# was made for a different fingerprint, which should change whenever
+# the stored pseudonyms become invalid (e.g. when the keys change.)
+class PseudonymStore:
+    # maximal number of parameters in one sqlite query
+    CHUNKSIZE = 500
+
+    def __init__(self, path, maxsize, fingerprint):
+        assert(maxsize>0)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS pseudonyms ("
+                    "ip BLOB PRIMARY KEY, "
+                    "pseudonym BLOB NOT NULL, "
+                    "last_used INTEGER NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS "
+                    "pseudonyms_by_last_used ON pseudonyms (last_used)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                    "key TEXT PRIMARY KEY, value BLOB)")
+
+            row = self._db.execute("SELECT value FROM meta "
+                    "WHERE key='fingerprint'").fetchone()
+            if row==None or row[0]!=fingerprint:
+                self._db.execute("DELETE FROM pseudonyms")
+                self._db.execute("INSERT OR REPLACE INTO meta "
+                        "VALUES ('fingerprint', ?)", (fingerprint,))
+
+        self._count, self._clock = self._db.execute(
+                "SELECT COUNT(*), COALESCE(MAX(last_used),0) "
+                "FROM pseudonyms").fetchone()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        return self._count
+
+    # returns a dictionary with the pseudonyms (as Pseudonymizables)
+    # known for the given ips
+    def get_many(self, ips):
+        ips = list(set(ips))
+        result = {}
+
+        with self._lock, self._db:
+            self._clock += 1
+            for start in range(0, len(ips), self.CHUNKSIZE):
+                chunk = ips[start:start+self.CHUNKSIZE]
+                marks = ",".join("?"*len(chunk))
+                found = []
+                for ip, pseudonym in self._db.execute(
+                        "SELECT ip, pseudonym FROM pseudonyms "
+                        f"WHERE ip IN ({marks})", chunk):
+                    result[ip] = pep3_pb2.Pseudonymizable.FromString(
+                            pseudonym)
+                    found.append(ip)
+                if len(found)>0:
+                    self._db.execute("UPDATE pseudonyms SET last_used=? "
+                            f"WHERE ip IN ({','.join('?'*len(found))})",
+                            [ self._clock ] + found)
+
+            self.hits += len(result)
+            self.misses += len(ips) - len(result)
+
+        return result
+
+    # stores the given (ip, Pseudonymizable) pairs
+    def put_many(self, items):
+        with self._lock, self._db:
+            self._clock += 1
+            rows = [ (pseudonym.SerializeToString(), self._clock, ip)
+                    for ip, pseudonym in items ]
+            # (the rowcount of the insert is the number of new ips)
+            self._count += self._db.executemany("INSERT OR IGNORE "
+                    "INTO pseudonyms (pseudonym, last_used, ip) "
+                    "VALUES (?, ?, ?)", rows).rowcount
+            self._db.executemany("UPDATE pseudonyms "
+                    "SET pseudonym=?, last_used=? WHERE ip=?", rows)
+
+            if self._count > self.maxsize:
+                self._count -= self._db.execute("DELETE FROM pseudonyms "
+                        "WHERE ip IN (SELECT ip FROM pseudonyms "
+                        "ORDER BY last_used LIMIT ?)",
+                        (self._count - self.maxsize,)).rowcount
+
+    # returns at most n of the most recently used (ip, Pseudonymizable)
+    # pairs
+    def most_recently_used(self, n):
+        with self._lock:
+            return [ (ip, pep3_pb2.Pseudonymizable.FromString(pseudonym))
+                    for ip, pseudonym in self._db.execute(
+                        "SELECT ip, pseudonym FROM pseudonyms "
+                        "ORDER BY last_used DESC LIMIT ?", (n,)) ]
@@ -1,3 +1,5 @@
+import itertools
+
 import pep3_pb2
 import pep3_pb2_grpc
 
@@ -30,10 +32,20 @@ class Researcher(pep3_pb2_grpc.ResearcherServicer):
         self.pep.encrypt(names)
         self.pep.relocalize(names, self.pep.config.warrants.from_me_to_sf)
 
-        for chunk in self.pep.connect_to("storage_facility").Query(query):
+        # so that we only need to relocalize and decrypt each pseudonym
+        # in the result once
+        query.deduplicate_pseudonyms = True
+        pseudonyms = [] # of the result so far, decrypted
+
+        # so the storage facility encrypts the next chunks while we
+        # relocalize this one
+        for chunk in common.read_ahead(
+                self.pep.connect_to("storage_facility").Query(query),
+                self.pep.global_config.query_chunks_in_flight):
 
             # localize from sf to researcher, and decrypt
             names.clear()
+            names.extend(chunk.pseudonyms)
             for row in chunk.rows:
                 for value in row.cells:
                     if value.WhichOneof("kind")=='pseudonymizable_value':
@@ -42,6 +54,17 @@ class Researcher(pep3_pb2_grpc.ResearcherServicer):
             self.pep.relocalize(names, self.pep.config.warrants.from_sf_to_me)
             self.pep.decrypt(names, secret_local_key)
 
+            # and put the pseudonyms back into the cells
+            pseudonyms.extend([ (pseudonym.data, pseudonym.state)
+                for pseudonym in chunk.pseudonyms ])
+            del chunk.pseudonyms[:]
+            for row in chunk.rows:
+                for value in row.cells:
+                    if value.WhichOneof("kind")=='pseudonym_index':
+                        data, state = pseudonyms[value.pseudonym_index]
+                        value.pseudonymizable_value.data = data
+                        value.pseudonymizable_value.state = state
+
             yield chunk
 
     # More of an investigator power:
@@ -55,3 +78,23 @@ class Researcher(pep3_pb2_grpc.ResearcherServicer):
         self.pep.depseudonymize(request, result)
 
         return result
+
+    def DepseudonymizeBulk(self, request_iterator, context):
+        common.authenticate(context,
+                must_be_one_of=[b"PEP3 "
+                    + self.pep.my_type_name.encode('utf-8')])
+
+        batchsize = max(self.pep.global_config.batchsize, 1)
+        warrants = []
+
+        for warrant in itertools.chain(request_iterator, [ None ]):
+            if warrant != None:
+                warrants.append(warrant)
+                if len(warrants) < batchsize:
+                    continue
+
+            results = [ pep3_pb2.Pseudonymizable() for w in warrants ]
+            self.pep.depseudonymize_bulk(warrants, results)
+            warrants = []
+
+            yield from results
@@ -1,3 +1,6 @@
+#include <string.h>
+#include <stdlib.h>
+
 // -- scalar.c --
 
 
@@ -2968,8 +2971,62 @@ void group_ge_scalarmult_base_publicinputs(group_ge *r, const group_scalar *s)
 
 void group_ge_multiscalarmult_publicinputs(group_ge *r, const group_ge *x, const group_scalar *s, unsigned long long xlen)
 {
-  //XXX: Use Bos-Coster (and something else for small values of xlen)
-  group_ge_multiscalarmult(r,x,s,xlen);
+  // Straus' method with sliding windows: the doublings are shared
+  // between all points, and for each point only the odd multiples
+  // x, 3x, ..., 15x are precomputed.
+  unsigned long long i;
+  int j, top = -1;
+  group_ge t, x2;
+  group_ge (*precomp)[8];
+  signed char (*slides)[256];
+
+  *r = group_ge_neutral;
+  if (xlen==0)
+    return;
+
+  precomp = malloc(xlen*sizeof(*precomp));
+  slides = malloc(xlen*sizeof(*slides));
+  if (precomp==NULL || slides==NULL)
+  {
+    free(precomp);
+    free(slides);
+    group_ge_multiscalarmult(r,x,s,xlen);
+    return;
+  }
+
+  for(i=0;i<xlen;i++)
+  {
+    scalar_slide(slides[i], s+i, 5);
+    for(j=255;j>top;j--)
+      if (slides[i][j]) 
+      {
+        top = j;
+        break;
+      }
+
+    precomp[i][0] = x[i];
+    group_ge_double(&x2, x+i);
+    for(j=1;j<8;j++)
+      group_ge_add(&precomp[i][j], &precomp[i][j-1], &x2);
+  }
+
+  for(j=top;j>=0;j--)
+  {
+    group_ge_double(r, r);
+    for(i=0;i<xlen;i++)
+    {
+      if (slides[i][j]>0)
+        group_ge_add(r, r, &precomp[i][slides[i][j]/2]);
+      else if (slides[i][j]<0)
+      {
+        group_ge_negate(&t, &precomp[i][(-slides[i][j])/2]);
+        group_ge_add(r, r, &t);
+      }
+    }
+  }
+
+  free(precomp);
+  free(slides);
 }
 
 int  group_ge_equals_publicinputs(const group_ge *x, const group_ge *y)
@@ -3009,6 +3066,14 @@ void group_scalars_pack(unsigned char r[], const group_scalar x[], int n)
 	}
 }
 
+void group_scalars_from64bytes(group_scalar r[], const unsigned char x[],
+		int n)
+{
+	for (int i=0; i<n; i++) {
+		scalar_from64bytes(&r[i], x + i*64);
+	}
+}
+
 void fe25519s_unpack(fe25519 r[], const unsigned char x[], int n)
 {
 	for (int i=0; i<n; i++) {
@@ -3271,6 +3336,71 @@ void elgamal_triples_rsk(
 	*target_out = tk;
 }
 
+void elgamal_triples_rsk_packed(unsigned char x[],
+		const unsigned char target[GROUP_GE_PACKEDBYTES],
+		const group_scalar *k, const group_scalar *s,
+		const group_scalar r[], int error_codes[], int n)
+{
+	group_ge blinding;
+	group_ge core;
+	group_ge target_in;
+	unsigned char *triple;
+
+	// precomputed
+	group_scalar k_inv_times_s;
+	group_ge tk;
+	unsigned char packed_tk[GROUP_GE_PACKEDBYTES];
+
+	// temporary
+	group_ge ge;
+
+	// precompute
+	group_ge_unpack(&target_in, target);
+
+	group_scalar_invert(&k_inv_times_s, k);
+	group_scalar_mul(&k_inv_times_s, &k_inv_times_s, s);
+
+	group_ge_scalarmult(&tk, &target_in, k);
+	group_ge_pack(packed_tk, &tk);
+
+	for (int i=0; i<n; i++) {
+		triple = x + i*ELGAMAL_TRIPLE_PACKEDBYTES;
+
+		if (memcmp(triple + 2*GROUP_GE_PACKEDBYTES, target,
+					GROUP_GE_PACKEDBYTES)!=0) {
+			error_codes[i] = 3;
+			continue;
+		}
+
+		if (group_ge_unpack(&blinding, triple)!=0) {
+			error_codes[i] = 1;
+			continue;
+		}
+
+		if (group_ge_unpack(&core, triple + GROUP_GE_PACKEDBYTES)!=0) {
+			error_codes[i] = 2;
+			continue;
+		}
+
+		error_codes[i] = 0;
+
+		// compute blinding
+		group_ge_scalarmult(&blinding, &blinding, &k_inv_times_s);
+		group_ge_scalarmult_base(&ge, &r[i]);
+		group_ge_add(&blinding, &blinding, &ge);
+
+		// compute core
+		group_ge_scalarmult(&core, &core, s);
+		group_ge_scalarmult(&ge, &tk, &r[i]);
+		group_ge_add(&core, &core, &ge);
+
+		group_ge_pack(triple, &blinding);
+		group_ge_pack(triple + GROUP_GE_PACKEDBYTES, &core);
+		memcpy(triple + 2*GROUP_GE_PACKEDBYTES, packed_tk,
+				GROUP_GE_PACKEDBYTES);
+	}
+}
+
 void elgamal_triples_encrypt(elgamal_triple y[], const group_ge x[],
 		const group_ge *target, const group_scalar r[], int n)
 {
@@ -3629,6 +3759,84 @@ int dht_proof_is_valid_for(
 	return 1;
 }
 
+int dht_proofs_are_valid_for(
+		const unsigned char x[],
+		const unsigned char A_packed[],
+		const unsigned char M_packed[],
+		const unsigned char N_packed[],
+		const unsigned char z[],
+		int n)
+{
+	int result = 0;
+	group_ge *points, *p; // p = (R_M, R_B, A, M, N) for each proof
+	group_scalar *scalars, *c; // the coefficients of p
+	group_scalar s, h, z1, z2, tmp, base_scalar = group_scalar_zero;
+	group_ge lhs, sB;
+
+	unsigned char to_be_hashed[5*32];
+	unsigned char digest[32];
+	unsigned char weight[32];
+
+	if (n==0)
+		return 1;
+
+	points = malloc(5*n*sizeof(group_ge));
+	scalars = malloc(5*n*sizeof(group_scalar));
+	if (points==NULL || scalars==NULL)
+		goto end;
+
+	memset(weight, 0, 32);
+
+	for (int i=0; i<n; i++) {
+		p = points + 5*i;
+		c = scalars + 5*i;
+
+		if ( group_ge_unpack(&p[0], x + 96*i)!=0 
+				|| group_ge_unpack(&p[1], x + 96*i + 32)!=0 
+				|| group_ge_unpack(&p[2], A_packed + 32*i)!=0 
+				|| group_ge_unpack(&p[3], M_packed + 32*i)!=0 
+				|| group_ge_unpack(&p[4], N_packed + 32*i)!=0 )
+			goto end;
+
+		group_scalar_unpack(&s, x + 96*i + 64);
+
+		// compute h as in dht_proof_is_valid_for
+		memcpy(to_be_hashed, A_packed + 32*i, 32);
+		memcpy(to_be_hashed + 32, M_packed + 32*i, 32);
+		memcpy(to_be_hashed + 64, N_packed + 32*i, 32);
+		memcpy(to_be_hashed + 96, x + 96*i, 64); // R_M and R_B
+
+		sha256(to_be_hashed, 5*32, digest);
+		group_scalar_unpack(&h, digest);
+
+		memcpy(weight, z + 32*i, 16);
+		group_scalar_unpack(&z1, weight);
+		memcpy(weight, z + 32*i + 16, 16);
+		group_scalar_unpack(&z2, weight);
+
+		// add  z1 ( B*s - R_B - A*h ) + z2 ( M*s - R_M - N*h )
+		group_scalar_mul(&tmp, &z1, &s);
+		group_scalar_add(&base_scalar, &base_scalar, &tmp);
+
+		group_scalar_negate(&c[1], &z1);
+		group_scalar_mul(&c[2], &c[1], &h);
+		group_scalar_mul(&c[3], &z2, &s);
+		group_scalar_negate(&c[0], &z2);
+		group_scalar_mul(&c[4], &c[0], &h);
+	}
+
+	group_ge_multiscalarmult_publicinputs(&lhs, points, scalars, 5*n);
+	group_ge_scalarmult_base(&sB, &base_scalar);
+	group_ge_add(&lhs, &lhs, &sB);
+
+	result = group_ge_isneutral_publicinputs(&lhs);
+
+end:
+	free(points);
+	free(scalars);
+	return result;
+}
+
 void product_proof_create(
                 product_proof *y,
                 const group_scalar factors_scalar[],
@@ -168,6 +168,9 @@ void fe25519s_unpack(fe25519 y[], const unsigned char x[], int n);
 void group_scalars_pack(unsigned char y[], const group_scalar x[], int n);
 void group_scalars_unpack(group_scalar y[], const unsigned char x[], 
 		int error_codes[], int n);
+// reduces the n 64-byte strings in x modulo l
+void group_scalars_from64bytes(group_scalar y[], const unsigned char x[],
+		int n);
 
 void group_ges_pack(unsigned char y[], const group_ge x[], int n);
 void group_ges_unpack(group_ge y[], const unsigned char x[], 
@@ -210,6 +213,16 @@ void elgamal_triples_rsk(
 		const group_scalar *k, const group_scalar *s, 
 		const group_scalar r[], int n);
 
+// Same as elgamal_triples_rsk, but on the n packed triples in x, in place.
+// The target of each triple should be equal to the packed target (which
+// should be valid and non-zero), otherwise error_codes[i] is set to 3;
+// error_codes[i] is set to 1 or 2 if the blinding or core of the i-th
+// triple can't be unpacked, and 0 on success.
+void elgamal_triples_rsk_packed(unsigned char x[],
+		const unsigned char target[GROUP_GE_PACKEDBYTES],
+		const group_scalar *k, const group_scalar *s,
+		const group_scalar r[], int error_codes[], int n);
+
 void elgamal_triples_decrypt(group_ge y[], const elgamal_triple x[],
 		const group_scalar *key, int n);
 void elgamal_triples_encrypt(elgamal_triple y[], const group_ge x[],
@@ -312,6 +325,21 @@ int dht_proof_is_valid_for(
 		const unsigned char M_packed[32],
 		const unsigned char N_packed[32]);
 
+// Checks the n DHT proofs in x (96 bytes each) for the packed points
+// in A_packed, M_packed, N_packed (32 bytes each) at once, by checking
+// a linear combination of their verification equations with the 128-bit
+// weights z[32*i : 32*i+16] and z[32*i+16 : 32*i+32], which should be
+// random.  Returns 1 if the combination holds, and 0 if it doesn't or
+// one of the points can't be unpacked; if one of the proofs is invalid
+// the combination holds with probability about 2**-128.
+int dht_proofs_are_valid_for(
+		const unsigned char x[],
+		const unsigned char A_packed[],
+		const unsigned char M_packed[],
+		const unsigned char N_packed[],
+		const unsigned char z[],
+		int n);
+
 void product_proof_create(
 		product_proof *y, // y->number_of_factors should be set
 				  // and y->{partial_products,dht_proofs}
@@ -1,25 +1,110 @@
-import parsimonious
-import importlib.resources
+import re
+import numbers
+import functools
+
+# The subset of SQL accepted here is described by the (parsimonious)
+# grammar in resources/sql.grammar;  it is parsed by hand, in one pass
+# over the tokens, into the syntax tree below.
 
 def check_query(db_desc, param_desc, query):
-    """Checks the query is admissible, and returns a tuple containing 
-    'plain' and 'pseudonymized' describing the result.  
+    """Checks the query is admissible, and returns a tuple containing
+    'plain' and 'pseudonymized' describing the result.
 
     The argument db_desc describes the columns;
-    
+
         db_desc['table']['column']
 
     should be either 'plain' or 'pseudonymized'.
-    
-    Similarly, param_desc[i] describes whether parameter :i is a pseudonym."""
-    try: 
-        return QueryChecker(db_desc, param_desc).parse(query)
-    except parsimonious.exceptions.ParseError as e:
-        raise InvalidQuery(f"couldn't parse sql query: {e}")
-    except parsimonious.exceptions.VisitationError as e:
-        raise InvalidQuery(f'invalid operation used in query: {e}')
-
-class QueryChecker(parsimonious.NodeVisitor):
+
+    Similarly, param_desc[i] describes whether parameter :i is a pseudonym.
+
+    The results are cached by query, param_desc and db_desc, so
+    repeated queries (with different parameter values) are not parsed
+    again."""
+    return list(_check_query_cached(query,
+        tuple(sorted(param_desc.items())),
+        tuple(sorted([ (table, tuple(sorted(column_desc.items())))
+            for table, column_desc in db_desc.items() ]))))
+
+@functools.lru_cache(maxsize=1024)
+def _check_query_cached(query, param_desc, db_desc):
+    db_desc = { table: dict(column_desc) for table, column_desc in db_desc }
+    return tuple(QueryChecker(db_desc, dict(param_desc)).parse(query))
+
+@functools.lru_cache(maxsize=1024)
+def parse(query):
+    """Returns the syntax tree (a Select) of the query, or raises
+    InvalidQuery when the query is not in our subset of SQL.
+    As the result is cached, it should not be changed."""
+    return Parser(query).parse()
+
+def column_bounds(query, column, params):
+    """Returns (lower, upper) such that lower <= column <= upper for all
+    rows selected by the WHERE clause of the (checked) query, where
+    lower and upper are None when there is no such bound.
+
+    Only comparisons of column (e.g. 'peped_flows.start_time') with
+    numeric literals and numeric parameters (from params) that are
+    joined by AND are considered, and strict inequalities are treated
+    as non-strict ones."""
+    lower, upper = None, None
+
+    where = parse(query).where
+    if where==None:
+        return lower, upper
+
+    for comparison in _conjuncts(where):
+        op = comparison.op
+        left = _operand(comparison.left, params)
+        right = _operand(comparison.right, params)
+
+        if right==column and isinstance(left, numbers.Real):
+            left, right = right, left
+            op = { "<": ">", "<=": ">=", ">": "<", ">=": "<=" }.get(op, op)
+        if left!=column or not isinstance(right, numbers.Real):
+            continue
+
+        if op in ("=", ">=", ">"):
+            lower = right if lower==None else max(lower, right)
+        if op in ("=", "<=", "<"):
+            upper = right if upper==None else min(upper, right)
+
+    return lower, upper
+
+def replace_table(query, table, replacement):
+    """Replaces the occurrences of table in the FROM clause of the
+    (checked) query by replacement, e.g. '(SELECT ...) AS table'."""
+    for name in reversed(parse(query).tables):
+        if name.name.lower()!=table:
+            continue
+        query = query[:name.start] + replacement + query[name.end:]
+    return query
+
+# yields the comparisons in the given boolean expression that must all hold
+def _conjuncts(node):
+    if not isinstance(node, Binary):
+        return
+    if node.op=="AND":
+        yield from _conjuncts(node.left)
+        yield from _conjuncts(node.right)
+    elif node.op in COMPARISONS:
+        yield node
+
+# returns 'table.column' for column references, and the value of
+# numeric literals and numeric parameters
+def _operand(node, params):
+    if isinstance(node, ColumnRef):
+        return f"{node.table}.{node.column}"
+    if isinstance(node, Literal) and isinstance(node.value, int):
+        return node.value
+    if isinstance(node, Parameter):
+        value = params.get(node.name)
+        if isinstance(value, numbers.Real) and not isinstance(value, bool):
+            return value
+    return None
+
+
+class QueryChecker:
     def __init__(self, db_desc, param_desc):
         for v in param_desc.values():
             assert(v in ('plain','pseudonymized')), "param_desc should only "\
@@ -29,104 +114,378 @@ class QueryChecker(parsimonious.NodeVisitor):
                 assert(v in ('plain','pseudonymized')), "db_desc should only "\
                         "contain 'plain' and 'pseudonymized'."
 
-        self.grammar = grammar
         self.db_desc = db_desc
         self.param_desc = param_desc
 
-    def generic_visit(self, node, children):
-        result = None
-        for child in children:
-            if child==None:
-                continue
-            assert(result==None), "did not expect two non-None values in "\
-                    f"{node.expr_name}: {children}!"
-            result = child
-        return result
+    def parse(self, query):
+        return self.check(parse(query))
 
-    def visit_column_ref(self, node, children):
-        (table_name_node, dot_node, __node, column_name_node) = node
-        
-        table_name = table_name_node.text.rstrip().lower()
-        column_name = column_name_node.text.rstrip().lower()
-
-        if table_name not in self.db_desc:
-            raise InvalidQuery(f"Unknown table {table_name}")
-    
-        table_desc = self.db_desc[table_name]
-
-        if column_name not in table_desc:
-            raise InvalidQuery(f"Table '{table_name}' has no column"
-                    f" '{column_name}'.")
-
-        return table_desc[column_name]
-    
-    def visit_parameter(self, node, children):
-        (dollar_node, number_node, __node) = node
-        n = number_node.text.rstrip()
-        if n not in self.param_desc:
-            raise InvalidQuery(f"Undescribed parameter ':{n}'.")
-        return self.param_desc[n]
-
-    def visit_string(self, node, children):
-        return "plain"
+    # returns the description of the result of the given Select
+    def check(self, select):
+        result = [ self.expr(column) for column in select.columns ]
 
-    visit_number = visit_string
+        if select.where!=None:
+            self.bool_expr(select.where)
 
-    def visit_add_tail(self, node, children):
-        for child in children:
-            if child=="plain":
-                continue
-            raise InvalidQuery("invalid operation on pseudonyms")
-        return "plain"
+        for expr in select.group_by:
+            self.expr(expr)
 
-    visit_mult_tail = visit_mult_expr = visit_add_expr = visit_add_tail
+        for expr, direction in select.order_by:
+            kind = self.expr(expr)
+            # "ORDER BY 2" orders by the second column of the result,
+            # so e.g. "ORDER BY 2 DESC LIMIT 10" gives the top 10 of 
+            # an aggregate in the second column
+            if isinstance(expr, Literal) and isinstance(expr.value, int):
+                if not 1 <= expr.value <= len(result):
+                    raise InvalidQuery(f"ORDER BY position {expr.value} "
+                            "is not in the result")
+                kind = result[expr.value-1]
+            if kind=="pseudonymized":
+                raise InvalidQuery("can't order by pseudonymized data")
 
-    def visit_exprs(self, node, children):
-        return [children[0]]+children[1]
+        return result
 
-    def visit_exprs_tail(self, node, children):
-        return children
+    # checks a boolean expression
+    def bool_expr(self, node):
+        if isinstance(node, Unary): # NOT
+            self.bool_expr(node.operand)
+            return
 
-    visit_sort_specs = visit_exprs
-    visit_sort_specs_tail = visit_exprs_tail
+        if node.op in ("AND", "OR"):
+            self.bool_expr(node.left)
+            self.bool_expr(node.right)
+            return
 
-    def visit_comp_expr(self, node, children):
-        left, op, _, right = children
-        left_node, op_node, __node, right_node = node
+        left = self.expr(node.left)
+        right = self.expr(node.right)
         if left!=right:
             raise InvalidQuery("comparing a pseudonym with plain text")
-        if left=="pseudonymized":
-            opname = op_node.text.rstrip() 
-            if opname in ("<","<=", ">", ">="):
-                raise InvalidQuery("can't use <, <=, >, >= on pseudonyms")
-            assert(opname in ("=", "<>")), "more operation types then expected"
-        return None
+        if left=="pseudonymized" and node.op not in ("=", "<>"):
+            raise InvalidQuery("can't use <, <=, >, >= on pseudonyms")
 
-    def visit_sum(self, node, children):
-        count, eow, _, expr = children
-        if expr=="pseudonymized":
-            raise InvalidQuery("can't SUM(-) pseudonymized data")
+    # returns 'plain' or 'pseudonymized' for the given value expression
+    def expr(self, node):
+        if isinstance(node, ColumnRef):
+            if node.table not in self.db_desc:
+                raise InvalidQuery(f"Unknown table {node.table}")
+            table_desc = self.db_desc[node.table]
+            if node.column not in table_desc:
+                raise InvalidQuery(f"Table '{node.table}' has no column"
+                        f" '{node.column}'.")
+            return table_desc[node.column]
 
-    def visit_count(self, node, children):
-        return "plain" # yes, pseudonyms can be counted
+        if isinstance(node, Parameter):
+            if node.name not in self.param_desc:
+                raise InvalidQuery(f"Undescribed parameter ':{node.name}'.")
+            return self.param_desc[node.name]
 
-    def visit_sort_spec(self, node, children):
-        if children[0]=="pseudonymized":
-            raise InvalidQuery("can't order by pseudonymized data")
+        if isinstance(node, Literal):
+            return "plain"
 
-    def visit_order_by_clause(self, node, children):
-        pass # don't pass along children
+        if isinstance(node, Call):
+            argument = self.expr(node.argument)
+            if node.function=="SUM" and argument=="pseudonymized":
+                raise InvalidQuery("can't SUM(-) pseudonymized data")
+            return "plain" # yes, pseudonyms can be counted
 
-    def visit_group_by_clause(self, node, children):
-        pass # don't pass along children
+        operands = [ node.operand ] if isinstance(node, Unary) \
+                else [ node.left, node.right ]
+        for operand in operands:
+            if self.expr(operand)!="plain":
+                raise InvalidQuery("invalid operation on pseudonyms")
+        return "plain"
 
-    def visit_limit_clause(self, node, children):
-        pass # don't pass along children
 
-    
+# The syntax tree.  Boolean expressions are made up of Binary nodes
+# with op in COMPARISONS, "AND" and "OR", and Unary nodes with op "NOT";
+# the other nodes are values.
+class Select:
+    def __init__(self):
+        self.columns = []
+        self.tables = [] # Names
+        self.where = None
+        self.group_by = []
+        self.order_by = [] # (expr, "ASC", "DESC" or None) pairs
+        self.limit = None
 
-class InvalidQuery(Exception): pass
+class Name:
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start # the position of the name in the query
+        self.end = end
+
+class ColumnRef:
+    def __init__(self, table, column):
+        self.table = table # in lower case
+        self.column = column # in lower case
+
+class Parameter:
+    def __init__(self, name):
+        self.name = name
+
+class Literal:
+    def __init__(self, value):
+        self.value = value # int or str (without quotes)
+
+class Call:
+    def __init__(self, function, argument):
+        self.function = function # "SUM" or "COUNT"
+        self.argument = argument
+
+class Unary:
+    def __init__(self, op, operand):
+        self.op = op # "-" or "NOT"
+        self.operand = operand
+
+class Binary:
+    def __init__(self, op, left, right):
+        self.op = op # in upper case
+        self.left = left
+        self.right = right
+
+COMPARISONS = ("<=", "<>", "<", ">=", ">", "=")
+
+# the binding strength of the binary operators
+PRECEDENCE = { "OR": 1, "AND": 2, # (3 is NOT's)
+        "<=": 4, "<>": 4, "<": 4, ">=": 4, ">": 4, "=": 4,
+        "+": 5, "-": 5, "*": 6, "/": 6 }
+NOT_PRECEDENCE = 3
+
+# the maximal number of nested parentheses, NOTs and minus signs
+MAX_DEPTH = 50
+
+TOKEN = re.compile(r"""
+      (?P<space>(?:--[^\r\n]*|[ \r\n\t]+)+)
+    | (?P<name>[a-zA-Z_][a-zA-Z_0-9]*)
+    | (?P<number>[0-9]+)
+    | (?P<string>"[^"]*(?:""[^"]*)*")
+    | (?P<parameter>:[a-zA-Z_][a-zA-Z_0-9]*)
+    | (?P<op><=|<>|<|>=|>|=|[-+*/(),.;])
+    """, re.VERBOSE)
+
+def tokenize(query):
+    """Returns the list of (kind, text, start, end) tuples of the tokens
+    in the query, and a final ("end", "", n, n)."""
+    tokens = []
+    pos = 0
+    while pos < len(query):
+        match = TOKEN.match(query, pos)
+        if match==None:
+            raise InvalidQuery(f"couldn't parse sql query: unexpected "
+                    f"character {query[pos]!r} at position {pos}")
+        if match.lastgroup!="space":
+            tokens.append( (match.lastgroup, match.group(),
+                match.start(), match.end()) )
+        pos = match.end()
+    tokens.append( ("end", "", pos, pos) )
+    return tokens
+
+class Parser:
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.pos = 0
+
+    def parse(self):
+        select = Select()
 
-with importlib.resources.open_text('resources', "sql.grammar") as f:
-    grammar = parsimonious.Grammar(f.read())
+        self.keyword("SELECT")
+        select.columns = self.exprs()
 
+        if self.accept_keyword("FROM"):
+            select.tables.append(self.name())
+            while self.accept(","):
+                select.tables.append(self.name())
+
+        if self.accept_keyword("WHERE"):
+            select.where = self.bool_expr(0)
+
+        if self.accept_keyword("GROUP"):
+            self.keyword("BY")
+            select.group_by = self.exprs()
+
+        if self.accept_keyword("ORDER"):
+            self.keyword("BY")
+            while True:
+                expr = self.expr(0)
+                direction = None
+                if self.is_keyword(0, "ASC") or self.is_keyword(0, "DESC"):
+                    direction = self.next()[1].upper()
+                select.order_by.append( (expr, direction) )
+                if not self.accept(","):
+                    break
+
+        if self.accept_keyword("LIMIT"):
+            token = self.next()
+            if token[0]!="number":
+                self.unexpected(token, "a number")
+            select.limit = int(token[1])
+
+        self.accept(";")
+        if self.peek()[0]!="end":
+            self.unexpected(self.peek(), "the end of the query")
+
+        return select
+
+    def exprs(self):
+        exprs = [ self.expr(0) ]
+        while self.accept(","):
+            exprs.append(self.expr(0))
+        return exprs
+
+    def expr(self, depth):
+        node = self.expression(PRECEDENCE["+"], depth)
+        if not is_value(node):
+            raise InvalidQuery("couldn't parse sql query: expected a value,"
+                    " not a condition")
+        return node
+
+    def bool_expr(self, depth):
+        node = self.expression(PRECEDENCE["OR"], depth)
+        if is_value(node):
+            raise InvalidQuery("couldn't parse sql query: expected a "
+                    "condition, not a value")
+        return node
+
+    # precedence climbing;  the operands are checked to be values or
+    # conditions afterwards
+    def expression(self, min_precedence, depth):
+        left = self.prefix(depth)
+        while True:
+            kind, text, start, end = self.peek()
+            op = text.upper()
+            if kind not in ("op", "name") or op not in PRECEDENCE \
+                    or PRECEDENCE[op] < min_precedence:
+                return left
+            self.next()
+            right = self.expression(PRECEDENCE[op]+1, depth)
+            left = Binary(op, left, right)
+
+            # e.g. the left operand of the second "=" in "a = b = c"
+            # is not a value
+            operands_are_values = op not in ("AND", "OR")
+            for operand in (left.left, left.right):
+                if is_value(operand)!=operands_are_values:
+                    raise InvalidQuery("couldn't parse sql query: "
+                            f"invalid operand for {op}")
+
+    def prefix(self, depth):
+        if self.is_keyword(0, "NOT") and self.peek(1)[1]!=".":
+            self.next()
+            self.check_depth(depth)
+            operand = self.expression(NOT_PRECEDENCE+1, depth+1)
+            # NOT may only be applied to a comparison or parentheses
+            if not (isinstance(operand, Binary)
+                    and operand.op in COMPARISONS
+                    or getattr(operand, "parenthesized", False)) \
+                    or is_value(operand):
+                raise InvalidQuery("couldn't parse sql query: "
+                        "invalid operand for NOT")
+            return Unary("NOT", operand)
+
+        if self.accept("-"):
+            self.check_depth(depth)
+            operand = self.primary(depth+1)
+            if not is_value(operand):
+                raise InvalidQuery("couldn't parse sql query: "
+                        "invalid operand for -")
+            return Unary("-", operand)
+
+        return self.primary(depth)
+
+    def primary(self, depth):
+        token = self.next()
+        kind, text, start, end = token
+
+        if kind=="number":
+            return Literal(int(text))
+
+        if kind=="string":
+            return Literal(text[1:-1].replace('""', '"'))
+
+        if kind=="parameter":
+            return Parameter(text[1:])
+
+        if text=="(":
+            self.check_depth(depth)
+            node = self.expression(PRECEDENCE["OR"], depth+1)
+            self.expect(")")
+            node.parenthesized = True
+            return node
+
+        if kind=="name":
+            if self.accept("."):
+                column = self.next()
+                if column[0]!="name":
+                    self.unexpected(column, "a column name")
+                return ColumnRef(text.lower(), column[1].lower())
+
+            function = text.upper()
+            if function in ("SUM", "COUNT") and self.peek()[1]=="(":
+                self.check_depth(depth)
+                self.next()
+                argument = self.expr(depth+1)
+                self.expect(")")
+                return Call(function, argument)
+
+        self.unexpected(token, "a value")
+
+    def name(self):
+        token = self.next()
+        kind, text, start, end = token
+        if kind!="name":
+            self.unexpected(token, "a table name")
+        return Name(text, start, end)
+
+    def check_depth(self, depth):
+        if depth >= MAX_DEPTH:
+            raise InvalidQuery("couldn't parse sql query: "
+                    "too deeply nested")
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos+offset, len(self.tokens)-1)]
+
+    def next(self):
+        token = self.peek()
+        self.pos = min(self.pos+1, len(self.tokens)-1)
+        return token
+
+    def accept(self, text):
+        kind, text_, start, end = self.peek()
+        if kind!="op" or text_!=text:
+            return False
+        self.next()
+        return True
+
+    def expect(self, text):
+        if not self.accept(text):
+            self.unexpected(self.peek(), repr(text))
+
+    def is_keyword(self, offset, keyword):
+        kind, text, start, end = self.peek(offset)
+        return kind=="name" and text.upper()==keyword
+
+    def accept_keyword(self, keyword):
+        if not self.is_keyword(0, keyword):
+            return False
+        self.next()
+        return True
+
+    def keyword(self, keyword):
+        if not self.accept_keyword(keyword):
+            self.unexpected(self.peek(), keyword)
+
+    def unexpected(self, token, expected):
+        kind, text, start, end = token
+        found = "the end of the query" if kind=="end" else repr(text)
+        raise InvalidQuery(f"couldn't parse sql query: expected {expected}"
+                f" at position {start}, but found {found}")
+
+def is_value(node):
+    if isinstance(node, Binary):
+        return node.op not in ("AND", "OR") + COMPARISONS
+    if isinstance(node, Unary):
+        return node.op!="NOT"
+    return True
+
+
+class InvalidQuery(Exception): pass
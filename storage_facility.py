@@ -5,9 +5,14 @@ import common
 import xthreading
 import xqueue
 import xos
+import xasyncio
 
 import queue
 import functools
+import threading
+import collections
+import traceback
+import concurrent.futures
 
 import grpc
 
@@ -22,6 +27,11 @@ class StorageFacility(pep3_pb2_grpc.StorageFacilityServicer):
     def Store(self, request_it, context):
         return self.store_processor.Store(request_it, context)
 
+    async def Store_async(self, request_it, context):
+        async for store_feedback in self.store_processor.Store_async(
+                request_it, context):
+            yield store_feedback
+
     def Query(self, query, context):
         common.authenticate(context,
                 must_be_one_of=[b"PEP3 researcher", b"PEP3 investigator"])
@@ -37,10 +47,15 @@ class StorageFacility(pep3_pb2_grpc.StorageFacilityServicer):
 
         self.pep.decrypt(names, secret_local_key)
 
-        for chunk in self.pep.connect_to("database").Query(query):
+        # so the database fetches the next chunks while we encrypt
+        for chunk in common.read_ahead(
+                self.pep.connect_to("database").Query(query),
+                self.pep.global_config.query_chunks_in_flight):
 
-            # encrypt pseudonymizable cells
+            # encrypt pseudonymizable cells, or the pseudonyms they
+            # refer to (see SqlQuery.deduplicate_pseudonyms)
             names.clear() 
+            names.extend(chunk.pseudonyms)
             for row in chunk.rows:
                 for cell in row.cells:
                     if cell.WhichOneof('kind')=='pseudonymizable_value':
@@ -57,16 +72,35 @@ class StoreProcessor:
         self.sf = sf
         self.cache = xthreading.Cache(
                 self._process_raw_ips, sf.pep.global_config.batchsize)
+        self.batched_decryption = sf.pep.config.batched_decryption
+        self.pseudonym_index = None
+        if sf.pep.config.pseudonym_index_size>0:
+            self.pseudonym_index = PseudonymIndex(
+                    sf.pep.config.pseudonym_index_size)
         self.queue = xqueue.Queue()
+        # the StoreRequests not yet acknowledged by the database
+        self.window = xthreading.Window(
+                sf.pep.config.max_requests_in_flight,
+                sf.pep.config.max_records_in_flight)
         self.request_id_to_feedback_queue = {}
 
-        self.process_queue_fut = \
-                self.sf.pep._executor.submit(self._process_queue_try)
+        # the queue is emptied by number_of_streams threads, each 
+        # sending one request at a time to the database
+        number_of_streams = max(sf.pep.config.number_of_streams, 1)
+        self.streams_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=number_of_streams,
+                thread_name_prefix="StoreProcessor streams")
+        self.process_queue_futs = [ 
+                self.streams_executor.submit(self._process_queue_try)
+                for i in range(number_of_streams) ]
         self.feedback_queues = set()
 
     def shutdown(self):
+        self.window.stop()
         self.queue.stop()
-        self.process_queue_fut.result() # wait
+        for fut in self.process_queue_futs:
+            fut.result() # wait
+        self.streams_executor.shutdown()
         feedback_queues = list(self.feedback_queues)
         for fbq in feedback_queues:
             fbq.stop()
@@ -78,13 +112,18 @@ class StoreProcessor:
 
     def _process_queue(self):
         try:
-            # database has only one thread, so we don't want to hog it
+            # database might have only one thread, so we don't want to 
+            # hog it with a long-lived stream; instead we send it the
+            # requests queued up at the moment in one short stream
+            request = None # the first request of the next Store stream
             while True:
-                request, stopped = self.queue.get()
-                if stopped:
-                    return
+                if request==None:
+                    request, stopped = self.queue.get()
+                    if stopped:
+                        return
+                requests, request = self._gather_requests(request)
                 for store_feedback in self.sf.pep.connect_to("database")\
-                    .Store(iter([request])):
+                    .Store(iter(requests)):
                     try:
                         feedback_queue = self.request_id_to_feedback_queue\
                                 .pop(store_feedback.stored_id)
@@ -94,6 +133,7 @@ class StoreProcessor:
                                 "exception, but not sure if "
                                 "it will register")
                         raise
+                    self.window.release(store_feedback.stored_id)
                     feedback_queue.put(store_feedback)
         except grpc.RpcError as e:
             assert(isinstance(e, grpc.Call))
@@ -110,6 +150,28 @@ class StoreProcessor:
             # unknown RpcError, reraise
             raise e
 
+    # Returns the given StoreRequest together with the StoreRequests 
+    # already queued after it, as long as they fit in one of the
+    # database's transactions, and the request that did not fit (if any.)
+    def _gather_requests(self, request):
+        max_records = self.sf.pep.global_config.database\
+                .max_records_per_transaction
+
+        requests = [ request ]
+        records = len(request.records)
+
+        while True:
+            try:
+                request, stopped = self.queue.get_nowait()
+            except queue.Empty:
+                return requests, None
+            if stopped:
+                return requests, None
+            if records + len(request.records) > max_records:
+                return requests, request
+            requests.append(request)
+            records += len(request.records)
+
     def _process_raw_ips(self, batch):
         pseudonymizables = []
         for raw_ip in batch:
@@ -135,10 +197,38 @@ class StoreProcessor:
             except Exception as e:
                 feedback_queue = self.request_id_to_feedback_queue.pop(
                         request.id)
+                self.window.release(request.id)
                 feedback_queue.put(pep3_pb2.StoreFeedback(
                     stored_id=request.id,
                     errors=[traceback.format_exc()]))
                 return
+        self._queue_request(request)
+
+    # alternative to self.cache.request(..., _handle_request_with_cached_ips)
+    # that decrypts all names of the request at once
+    def _handle_request_batched(self, request):
+        names = []
+        for flowrecord in request.records:
+            names.append(flowrecord.source_ip)
+            names.append(flowrecord.destination_ip)
+
+        try:
+            self.sf.pep.decrypt(names, self.sf.pep.private_keys["pseudonym"])
+        except Exception as e:
+            feedback_queue = self.request_id_to_feedback_queue.pop(
+                    request.id)
+            self.window.release(request.id)
+            feedback_queue.put(pep3_pb2.StoreFeedback(
+                stored_id=request.id,
+                errors=[traceback.format_exc()]))
+            return
+        self._queue_request(request)
+
+    # queues the given decrypted StoreRequest to be sent to the database,
+    # without the flow records it already stored (when configured)
+    def _queue_request(self, request):
+        if self.pseudonym_index!=None:
+            self.pseudonym_index.remove_duplicates(request.records)
         self.queue.put(request)
 
 
@@ -180,29 +270,123 @@ class StoreProcessor:
         requests_stored = 0
 
         for request in request_it:
-            if request.id in self.request_id_to_feedback_queue:
-                raise ValueError("request id already in use")
-
-            self.request_id_to_feedback_queue[request.id] = feedback_queue
+            self._store_request(request, context, feedback_queue)
             requests_stored += 1
 
-            raw_ips = []
-            
-            for flowrecord in request.records:
-                common.check_is_encrypted_pseudonym(
-                        flowrecord.source_ip, context)
-                common.check_is_encrypted_pseudonym(
-                        flowrecord.destination_ip, context)
-                
-                raw_ips.append(flowrecord.source_ip.data)
-                raw_ips.append(flowrecord.destination_ip.data)
-
-            self.cache.request(raw_ips,
-                    functools.partial(
-                        self._handle_request_with_cached_ips, request))
-
         self.cache.flush()
         feedback_queue.put(None) # signal we're almost done
         return requests_stored
 
+    # like Store, but runs on the event loop (see xasyncio.py,) so that
+    # it does not occupy threads while waiting for requests or feedback
+    async def Store_async(self, request_it, context):
+        context = xasyncio.SyncContext(context)
+        executor = self.sf.pep._executor
+        await xasyncio.run(executor, common.authenticate, context,
+                [b"PEP3 collector"])
 
+        expected_responses = 0
+        feedback_queue = xasyncio.Queue()
+        self.feedback_queues.add(feedback_queue)
+
+        async for request in request_it:
+            await xasyncio.run(executor, self._store_request,
+                    request, context, feedback_queue)
+            expected_responses += 1
+
+        await xasyncio.run(executor, self.cache.flush)
+
+        while expected_responses > 0:
+            store_feedback, stopped = await feedback_queue.get()
+            if stopped:
+                return
+            expected_responses -= 1
+            yield store_feedback
+
+        self.feedback_queues.remove(feedback_queue)
+
+    # passes on the request of a Store call for decryption, after which
+    # its StoreFeedback is put on the feedback_queue
+    def _store_request(self, request, context, feedback_queue):
+        if request.id in self.request_id_to_feedback_queue:
+            raise ValueError("request id already in use")
+
+        # check the request before it takes up room in the window
+        raw_ips = []
+        for flowrecord in request.records:
+            common.check_is_encrypted_pseudonym(
+                    flowrecord.source_ip, context)
+            common.check_is_encrypted_pseudonym(
+                    flowrecord.destination_ip, context)
+            
+            raw_ips.append(flowrecord.source_ip.data)
+            raw_ips.append(flowrecord.destination_ip.data)
+
+        # wait until there's room in the window (flushing first,
+        # see Collector.Store)
+        if not self.window.acquire(request.id, len(request.records),
+                block=False):
+            self.cache.flush()
+            if not self.window.acquire(request.id, len(request.records)):
+                context.abort(grpc.StatusCode.UNAVAILABLE,
+                        "storage facility is shutting down")
+
+        self.request_id_to_feedback_queue[request.id] = feedback_queue
+
+        if self.batched_decryption:
+            self._handle_request_batched(request)
+            return
+
+        self.cache.request(raw_ips,
+                functools.partial(
+                    self._handle_request_with_cached_ips, request))
+
+
+
+
+# Remembers the flow records recently stored with a given (decrypted,
+# SF-local) pseudonym as source, for at most maxsize flow records, 
+# forgetting the least recently seen pseudonyms first.  Used to skip
+# flow records that are stored twice (e.g. when a flow passes two
+# exporters, or a collector resends a request.)
+class PseudonymIndex:
+    def __init__(self, maxsize):
+        assert(maxsize>0)
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._records = collections.OrderedDict()
+        # maps pseudonym to the set of (destination pseudonym, 
+        # serialized anonymous part) of the flow records stored with it
+        self._size = 0 # the total number of flow records remembered
+
+    # removes from the given (repeated field of) decrypted flow records
+    # those already seen, and returns their number
+    def remove_duplicates(self, flowrecords):
+        duplicates = []
+        with self._lock:
+            for i, flowrecord in enumerate(flowrecords):
+                pseudonym = flowrecord.source_ip.data
+                key = (flowrecord.destination_ip.data,
+                        flowrecord.anonymous_part.SerializeToString(
+                            deterministic=True))
+                seen = self._records.get(pseudonym)
+                if seen==None:
+                    seen = self._records[pseudonym] = set()
+                else:
+                    self._records.move_to_end(pseudonym)
+                if key in seen:
+                    duplicates.append(i)
+                    continue
+                seen.add(key)
+                self._size += 1
+
+            while self._size > self.maxsize:
+                pseudonym, seen = self._records.popitem(last=False)
+                self._size -= len(seen)
+
+        for i in reversed(duplicates):
+            del flowrecords[i]
+        return len(duplicates)
+
+    def __len__(self):
+        return self._size
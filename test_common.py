@@ -0,0 +1,121 @@
+import unittest
+import threading
+import time
+
+import common
+
+class TestChuck(unittest.TestCase):
+    def wait_for(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            time.sleep(.01)
+        self.fail("condition was not met in time")
+
+    def test_unbounded(self):
+        self.assertEqual(list(common.chuck(range(100))), list(range(100)))
+
+    def test_maxitems(self):
+        read = []
+        def gen():
+            for i in range(10):
+                read.append(i)
+                yield i
+
+        it = common.chuck(gen(), maxitems=3)
+        self.wait_for(lambda: it.size()==3)
+        time.sleep(.05)
+        # one item is read, but waits for room in the queue
+        self.assertEqual(len(read), 4)
+        self.assertEqual(next(it), 0)
+        self.wait_for(lambda: len(read)==5)
+        self.assertEqual(list(it), list(range(1,10)))
+        self.assertGreater(it.producer_stall, 0)
+
+    def test_maxbytes(self):
+        it = common.chuck([ b"a"*5, b"b"*5, b"c"*20, b"d" ],
+                maxbytes=12, sizeof=len)
+        self.wait_for(lambda: it.size()==2)
+        time.sleep(.05)
+        self.assertEqual(it.size(), 2)
+        self.assertEqual(it.nbytes(), 10)
+
+        # an item larger than maxbytes gets in when the queue is empty
+        self.assertEqual(next(it), b"a"*5)
+        self.assertEqual(next(it), b"b"*5)
+        self.wait_for(lambda: it.nbytes()==20)
+        self.assertEqual(list(it), [ b"c"*20, b"d" ])
+
+    def test_exception(self):
+        def gen():
+            yield 1
+            raise KeyError("oops")
+
+        it = common.chuck(gen(), maxitems=1)
+        self.assertEqual(next(it), 1)
+        for i in range(2):
+            with self.assertRaises(KeyError):
+                next(it)
+
+    def test_several_consumers(self):
+        it = common.chuck(range(1000), maxitems=10)
+        results = [ [] for i in range(4) ]
+
+        threads = [ threading.Thread(target=lambda result:
+            result.extend(it), args=(result,)) for result in results ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(sum(results, [])), list(range(1000)))
+        for result in results:
+            self.assertEqual(result, sorted(result))
+
+    def test_close(self):
+        def gen():
+            i = 0
+            while True:
+                yield i
+                i += 1
+
+        it = common.chuck(gen(), maxitems=2)
+        self.assertEqual(next(it), 0)
+        self.wait_for(lambda: it.size()==2)
+        it.close()
+        it._thread.join(1)
+        self.assertFalse(it._thread.is_alive())
+        self.assertEqual(list(it), [1, 2])
+
+
+class TestReadAhead(unittest.TestCase):
+    class Call:
+        def __init__(self, n):
+            self.it = iter(range(n))
+            self.cancelled = False
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return next(self.it)
+
+        def cancel(self):
+            self.cancelled = True
+
+    def test_read_ahead(self):
+        for maxitems in (0, 1, 3):
+            call = self.Call(10)
+            self.assertEqual(list(common.read_ahead(call, maxitems)),
+                    list(range(10)))
+
+    def test_cancel(self):
+        call = self.Call(10)
+        it = common.read_ahead(call, 2)
+        self.assertEqual(next(it), 0)
+        it.close()
+        self.assertTrue(call.cancelled)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
@@ -38,6 +38,58 @@ class cryptoputest(unittest.TestCase):
                     for i in range(N) ]
             )
 
+    def test_in_parallel(self):
+        N = 7
+        pu = cryptopu.CryptoPU(number_of_threads=3)
+
+        k = ed25519.scalar_random()
+        s = ed25519.scalar_random()
+        r = [ ed25519.scalar_random() for i in range(N) ]
+        target = ed25519.Point.random()
+        private_key = ed25519.scalar_random()
+
+        names = [ pep3_pb2.Pseudonymizable(data=ed25519.Point.random().pack())
+                for i in range(N) ]
+        pseudonyms = [ pep3_pb2.Pseudonymizable(data=elgamal.encrypt(
+            ed25519.Point.random(), target).pack()) for i in range(N) ]
+        pseudonyms2 = [ pep3_pb2.Pseudonymizable(data=pseudonym.data)
+                for pseudonym in pseudonyms ]
+
+        pu.rsk(pseudonyms, k, s, r)
+        self.pu.rsk(pseudonyms2, k, s, r)
+        self.assertEqual(pseudonyms, pseudonyms2)
+
+        points = [ name.data for name in names ]
+        pu.encrypt(names, ed25519.Point.B_times(private_key), r)
+        pu.decrypt(names, private_key)
+        self.assertEqual([ name.data for name in names ], points)
+
+        pu.shutdown()
+
+    def test_packed(self):
+        N = 5
+
+        key = ed25519.scalar_random()
+        k = ed25519.scalar_random()
+        s = ed25519.scalar_random()
+        points = [ ed25519.Point.random() for i in range(N) ]
+
+        triples = self.pu.encrypt_packed(
+                b''.join([ point.pack() for point in points ]),
+                ed25519.Point.B_times(key))
+        self.assertEqual(len(triples), 96*N)
+
+        self.pu.rsk_packed(memoryview(triples), k, s)
+
+        self.assertEqual(
+                self.pu.decrypt_packed(bytes(triples), (key*k) % ed25519.l),
+                b''.join([ (point*s).pack() for point in points ]))
+
+        # the targets of the triples must be the same
+        triples[96*N-1] ^= 1
+        with self.assertRaises(cryptopu.InvalidArgument):
+            self.pu.rsk_packed(triples, k, s)
+
     def test_component_public_part(self):
         scalar = ed25519.scalar_random()
         y = self.pu.component_public_part(scalar)
@@ -64,6 +116,87 @@ class cryptoputest(unittest.TestCase):
         self.assertTrue(self.pu.certified_component_is_valid_for(
             cc_protobuf, self.pu.component_public_part(k), e))
 
+    def test_dht_proof(self):
+        a = ed25519.scalar_random()
+        M = ed25519.Point.random()
+        A = ed25519.Point.B_times(a)
+        N = M*a
+
+        proof = self.pu.dht_proof_create(a, M.pack())
+        self.assertEqual(proof, schnorr.DHTProof.create(a, M).pack())
+
+        self.assertTrue(self.pu.dht_proof_is_valid_for(proof,
+            A.pack(), M.pack(), N.pack()))
+        self.assertFalse(self.pu.dht_proof_is_valid_for(proof,
+            A.pack(), N.pack(), M.pack()))
+        self.assertFalse(self.pu.dht_proof_is_valid_for(proof,
+            A.pack(), M.pack(), b"not a point"))
+
+    def test_dht_proofs_are_valid_for(self):
+        instances = []
+        for i in range(4):
+            a = ed25519.scalar_random()
+            M = ed25519.Point.random()
+            instances.append(( self.pu.dht_proof_create(a, M.pack()),
+                ed25519.Point.B_times(a).pack(), M.pack(), (M*a).pack() ))
+
+        self.assertTrue(self.pu.dht_proofs_are_valid_for([]))
+        self.assertTrue(self.pu.dht_proofs_are_valid_for(instances))
+
+        proof, A, M, N = instances[2]
+        instances[2] = (proof, A, M, M)
+        self.assertFalse(self.pu.dht_proofs_are_valid_for(instances))
+
+    def test_product_proof(self):
+        for N in range(5):
+            factors_scalars = [ ed25519.scalar_random() for i in range(N) ]
+
+            msg = pep3_pb2.ProductProof()
+            factors_packed, product_packed = self.pu.product_proof_create(
+                    factors_scalars, msg)
+
+            proof, factors, product = schnorr.ProductProof.create(
+                    factors_scalars)
+            msg2 = pep3_pb2.ProductProof()
+            proof.to_protobuf(msg2)
+
+            self.assertEqual(msg, msg2)
+            self.assertEqual(factors_packed,
+                    [ factor.pack() for factor in factors ])
+            self.assertEqual(product_packed, product.pack())
+
+            self.assertTrue(self.pu.product_proof_is_valid_for(msg,
+                product_packed, factors_packed))
+            self.assertFalse(self.pu.product_proof_is_valid_for(msg,
+                ed25519.Point.random().pack(), factors_packed))
+
+    def test_rs_proof(self):
+        triple = elgamal.encrypt(ed25519.Point.random(),
+                ed25519.Point.random())
+        k, n, r = [ ed25519.scalar_random() for i in range(3) ]
+        K_B = ed25519.Point.B_times(k).pack()
+        N_B = ed25519.Point.B_times(n).pack()
+
+        proof, triple_out = self.pu.rs_proof_create(triple.pack(), n, r)
+        proof2, triple_out2 = schnorr.RSProof.create(triple, n, r)
+        self.assertEqual((proof, triple_out),
+                (proof2.pack(), triple_out2.pack()))
+
+        self.assertTrue(self.pu.rs_proof_is_valid_for(proof,
+            triple.pack(), N_B, triple_out))
+        self.assertFalse(self.pu.rs_proof_is_valid_for(proof,
+            triple.pack(), K_B, triple_out))
+
+        proof, triple_out = self.pu.rsk_proof_create(triple.pack(), k, n, r)
+        proof2, triple_out2 = schnorr.RSKProof.create(triple, k, n, r)
+        self.assertEqual((proof, triple_out),
+                (proof2.pack(), triple_out2.pack()))
+
+        self.assertTrue(self.pu.rsk_proof_is_valid_for(proof,
+            triple.pack(), K_B, N_B, triple_out))
+        self.assertFalse(self.pu.rsk_proof_is_valid_for(proof,
+            triple.pack(), N_B, K_B, triple_out))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=3)
@@ -0,0 +1,171 @@
+import unittest
+import os
+import concurrent
+
+import sqlalchemy
+
+import pep3_pb2
+
+import pep3
+import database
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        config = pep3_pb2.Configuration()
+        secrets = pep3_pb2.Secrets()
+
+        pep3.fill_local_config_messages(config, secrets)
+        config.db_desc['peped_flows'].partition_column = 'start_time'
+        config.db_desc['peped_flows'].partition_length = 100
+
+        self.g = pep3.RunServers(config, secrets, 
+                server_names=[ ('database', None) ],
+                executor_type=concurrent.futures.ThreadPoolExecutor)
+        self.g.__enter__()
+
+        self.db = self.g.contexts[('database', None)].grpc_servicer
+        self.sf = pep3.PepContext(config, secrets, 
+                'storage_facility', None, allow_enrollment=False)
+
+    def tearDown(self):
+        self.g.__exit__(None, None, None)
+        self.sf.shutdown_finish()
+
+    def test_partitions(self):
+        request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        for start_time in (250, 50, 150, 299):
+            flowrecord = request.records.add()
+            flowrecord.source_ip.data = os.urandom(32)
+            flowrecord.destination_ip.data = os.urandom(32)
+            flowrecord.anonymous_part.start_time = start_time
+        for feedback in self.sf.connect_to('database').Store(iter([request])):
+            self.assertEqual(feedback.stored_id, request.id)
+
+        inspector = sqlalchemy.inspect(self.db.engine)
+        self.assertEqual(sorted(inspector.get_table_names()), [ 'peped_flows',
+            'peped_flows_0', 'peped_flows_1', 'peped_flows_2' ])
+        self.assertEqual(sorted([ index['name'] for index 
+            in inspector.get_indexes('peped_flows_1') ]), [
+                'ix_peped_flows_1_p_dst_ip', 'ix_peped_flows_1_p_src_ip', 
+                'ix_peped_flows_1_start_time' ])
+
+        query = pep3_pb2.SqlQuery()
+        query.query = """SELECT peped_flows.start_time FROM peped_flows
+            WHERE peped_flows.start_time >= :start 
+                AND peped_flows.start_time < 280"""
+        query.parameters['start'].number_value = 150
+
+        self.assertNotIn('peped_flows_0', self.db._route_query(query.query,
+            { 'start': 150 }))
+        self.assertIn('peped_flows_2', self.db._route_query(query.query,
+            { 'start': 150 }))
+
+        start_times = [ row.cells[0].number_value 
+                for rows in self.sf.connect_to('database').Query(query)
+                for row in rows.rows ]
+        self.assertEqual(sorted(start_times), [ 150, 250 ])
+
+
+    def test_partition_column(self):
+        config = pep3_pb2.Configuration()
+        config.CopyFrom(self.sf.global_config)
+        for column in ('p_src_ip', 'flow_record_id', 'no_such_column'):
+            config.db_desc['peped_flows'].partition_column = column
+            pep = pep3.PepContext(config, pep3_pb2.Secrets(), 'database',
+                    None, allow_enrollment=False)
+            try:
+                with self.assertRaises(ValueError):
+                    database.Database(pep)
+            finally:
+                pep.shutdown_finish()
+
+    def test_chunks(self):
+        request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        for i in range(10):
+            flowrecord = request.records.add()
+            flowrecord.source_ip.data = os.urandom(32)
+            flowrecord.destination_ip.data = os.urandom(32)
+            flowrecord.anonymous_part.start_time = i
+        list(self.sf.connect_to('database').Store(iter([request])))
+
+        def chunk_sizes(columns, **kwargs):
+            query = pep3_pb2.SqlQuery(**kwargs)
+            query.query = f"SELECT {columns} FROM peped_flows"
+            return [ len(rows.rows) for rows 
+                    in self.sf.connect_to('database').Query(query) ]
+
+        self.assertEqual(chunk_sizes("peped_flows.start_time"), [10])
+        self.assertEqual(chunk_sizes("peped_flows.start_time", 
+            max_rows_per_chunk=3), [3, 3, 3, 1])
+        self.assertEqual(chunk_sizes("peped_flows.p_src_ip, "
+            "peped_flows.p_dst_ip", max_pseudonyms_per_chunk=5), [2]*5)
+        self.assertEqual(chunk_sizes("peped_flows.p_src_ip", 
+            max_pseudonyms_per_chunk=4, max_rows_per_chunk=3), 
+            [3, 3, 3, 1])
+        # each row takes more than 32 bytes
+        self.assertEqual(chunk_sizes("peped_flows.p_src_ip", 
+            max_bytes_per_chunk=64), [2]*5)
+        self.assertEqual(chunk_sizes("peped_flows.p_src_ip", 
+            max_bytes_per_chunk=1), [1]*10)
+
+    def test_deduplicate_pseudonyms(self):
+        request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        ips = [ os.urandom(32) for i in range(3) ]
+        for i in range(10):
+            flowrecord = request.records.add()
+            flowrecord.source_ip.data = ips[i % 3]
+            flowrecord.destination_ip.data = ips[0]
+            flowrecord.anonymous_part.start_time = i
+        list(self.sf.connect_to('database').Store(iter([request])))
+
+        query = pep3_pb2.SqlQuery(deduplicate_pseudonyms=True,
+                max_pseudonyms_per_chunk=3)
+        query.query = """SELECT peped_flows.p_src_ip, peped_flows.p_dst_ip,
+                peped_flows.start_time FROM peped_flows
+            ORDER BY peped_flows.start_time"""
+        chunks = list(self.sf.connect_to('database').Query(query))
+
+        # only new pseudonyms count towards max_pseudonyms_per_chunk
+        self.assertEqual([ len(chunk.rows) for chunk in chunks ], [2, 8])
+        self.assertEqual([ [ pseudonym.data for pseudonym 
+            in chunk.pseudonyms ] for chunk in chunks ], 
+            [ ips[:2], ips[2:] ])
+        self.assertEqual([ [ cell.pseudonym_index for cell in row.cells[:2] ]
+            for chunk in chunks for row in chunk.rows ],
+            [ [i % 3, 0] for i in range(10) ])
+        self.assertEqual(chunks[1].pseudonyms[0].state,
+                pep3_pb2.Pseudonymizable.UNENCRYPTED_PSEUDONYM)
+
+    def test_top(self):
+        request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        ips = [ os.urandom(32) for i in range(5) ]
+        for i in range(30):
+            flowrecord = request.records.add()
+            flowrecord.source_ip.data = ips[i % 5]
+            flowrecord.destination_ip.data = os.urandom(32)
+            flowrecord.anonymous_part.start_time = i * 10
+            flowrecord.anonymous_part.number_of_bytes = i % 5
+        list(self.sf.connect_to('database').Store(iter([request])))
+
+        def top(order_by, limit):
+            query = pep3_pb2.SqlQuery()
+            query.query = f"""SELECT peped_flows.p_src_ip, 
+                    SUM(peped_flows.bytes), COUNT(peped_flows.p_dst_ip)
+                FROM peped_flows
+                WHERE peped_flows.start_time >= :start
+                GROUP BY peped_flows.p_src_ip
+                ORDER BY {order_by} DESC LIMIT {limit}"""
+            query.parameters['start'].number_value = 100
+            return [ [ cell.number_value for cell in row.cells[1:] ]
+                    for rows in self.sf.connect_to('database').Query(query)
+                    for row in rows.rows ]
+
+        # the partitions with start_time >= 100 hold 4 records per ip
+        self.assertEqual(top("SUM(peped_flows.bytes)", 2),
+                [ [16, 4], [12, 4] ])
+        self.assertEqual(top("2", 3), [ [16, 4], [12, 4], [8, 4] ])
+        self.assertEqual(len(top("3", 10)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
@@ -250,6 +250,18 @@ class testPoint(unittest.TestCase):
         s = scalar_random()
         self.assertEqual( Point.B() * s, Point.B_times(s) )
 
+    def test_multiplication(self):
+        a = Point.random()
+        for s in (0, 1, 8, 9, 128, 129, l-1, l, -1, 2**256-1,
+                scalar_random()):
+            expected = double_and_add_multiplication(a, s, Point.Zero())
+            # the second and third multiplications use a FixedBaseTable
+            for j in range(3):
+                self.assertEqual( a * s, expected )
+            self.assertEqual( Point.B_times(s),
+                    double_and_add_multiplication(Point.B(), s % l,
+                        Point.Zero()) )
+
     def test_jacobi_quartic(self):
         for i in range(10):
             if i==0:
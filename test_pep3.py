@@ -3,6 +3,9 @@ import argparse
 import os
 import sys
 import concurrent
+import threading
+
+import grpc
 
 from OpenSSL import crypto
 
@@ -12,13 +15,18 @@ import pep3
 import elgamal
 import ed25519
 import common
+import cheats
+import storage_facility
 
 class pep3test(unittest.TestCase):
+    asyncio = False
+
     def setUp(self):
         config = pep3_pb2.Configuration()
         secrets = pep3_pb2.Secrets()
 
         pep3.fill_local_config_messages(config, secrets)
+        config.asyncio = self.asyncio
 
         executor_type = concurrent.futures.ThreadPoolExecutor
 
@@ -67,6 +75,282 @@ class pep3test(unittest.TestCase):
             ed25519.Point.lizard(name) )
 
 
+    def test_pipelined_relocalization(self):
+        names = [ os.urandom(16) for i in range(5) ]
+        target = b"PEP3 storage_facility"
+
+        pps = [ pep3_pb2.Pseudonymizable(data=name,
+                state=pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME)
+                    for name in names ]
+
+        self.collector.pseudonymize(pps)
+        self.collector.relocalize(pps,
+                self.config.collector.warrants.to_sf, subbatchsize=2)
+
+        s = 1
+        e = ed25519.scalar_unpack(common.sha256(target))
+        for shard_secrets in cheats.secrets_by_shard(self.secrets).values():
+            s *= pow(ed25519.scalar_unpack(
+                shard_secrets.pseudonym_component_secret),e,ed25519.l)
+            s %= ed25519.l
+
+        for name, pp in zip(names, pps):
+            sfp = elgamal.Triple.unpack(pp.data)\
+                    .decrypt(self.sf.private_keys['pseudonym'])
+            self.assertEqual(
+                sfp * ed25519.scalar_inv(s),
+                ed25519.Point.lizard(name) )
+
+    def test_relocalization_without_peers(self):
+        pps = [ pep3_pb2.Pseudonymizable(data=os.urandom(16),
+                state=pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME)
+                    for i in range(5) ]
+        self.collector.pseudonymize(pps)
+
+        peers = [ context.grpc_servicer for (kind, name), context
+                in self.g.contexts.items() if kind=='peer' ]
+        for peer in peers:
+            peer._mode = pep3_pb2.Mode.OFF
+
+        for subbatchsize in (0, 1):
+            with self.assertLogs(level='WARNING'):
+                with self.assertRaisesRegex(RuntimeError,
+                        "^Not enough working peers$"):
+                    self.collector.relocalize(pps,
+                        self.config.collector.warrants.to_sf,
+                        subbatchsize=subbatchsize)
+
+        for peer in peers:
+            peer._mode = pep3_pb2.Mode.ON
+
+        self.collector.relocalize(pps,
+                self.config.collector.warrants.to_sf, subbatchsize=1)
+
+    def test_peer_scalars_cache(self):
+        pep = self.g.contexts[('peer','A')]
+        peer = pep.grpc_servicer
+        act = self.config.collector.warrants.to_sf.act
+        shards = pep.config.shards
+
+        s = 1
+        e = ed25519.scalar_unpack(common.sha256(act.target))
+        for shard in shards:
+            s *= pow(ed25519.scalar_unpack(pep.secrets.by_shard[shard]\
+                    .pseudonym_component_secret),e,ed25519.l)
+            s %= ed25519.l
+
+        k, s_ = peer._relocalization_scalars(shards, act)
+        self.assertEqual(s_, s)
+
+        hits, misses = peer.scalars_cache.hits, peer.scalars_cache.misses
+        self.assertEqual(peer._relocalization_scalars(shards, act), (k, s))
+        self.assertEqual(peer.scalars_cache.hits, hits+1)
+        self.assertEqual(peer.scalars_cache.misses, misses)
+
+        pep.reload_secrets(self.secrets)
+        self.assertEqual(len(peer.scalars_cache), 0)
+        self.assertEqual(peer._relocalization_scalars(shards, act), (k, s))
+        self.assertEqual(peer.scalars_cache.misses, 
+                misses + 1 + 3*len(shards))
+
+    def test_peer_duplicate_shards(self):
+        peer = self.g.contexts[('peer','A')].grpc_servicer
+        shard = self.g.contexts[('peer','A')].config.shards[0]
+        misses = peer.scalars_cache.misses
+
+        request = pep3_pb2.RelocalizationRequest()
+        request.warrant.CopyFrom(self.config.collector.warrants.to_sf)
+        request.which_shards.extend([ shard, shard ])
+        request.names.add().data = elgamal.encrypt(ed25519.Point.random(),
+                ed25519.Point.random()).pack()
+
+        with self.assertRaises(grpc.RpcError) as cm:
+            self.collector.connect_to('peer', 'A').Relocalize(request)
+        self.assertEqual(cm.exception.code(), 
+                grpc.StatusCode.INVALID_ARGUMENT)
+        self.assertIn("duplicates", cm.exception.details())
+
+        request = pep3_pb2.DepseudonymizationRequest()
+        request.which_shards.extend([ shard, shard ])
+        with self.assertRaises(grpc.RpcError) as cm:
+            self.investigator.connect_to('peer', 'A').Depseudonymize(request)
+        self.assertEqual(cm.exception.code(), 
+                grpc.StatusCode.INVALID_ARGUMENT)
+        self.assertIn("duplicates", cm.exception.details())
+
+        self.assertEqual(peer.scalars_cache.misses, misses)
+
+    def test_peer_warrants_cache(self):
+        peer = self.g.contexts[('peer','A')].grpc_servicer
+        warrant = pep3_pb2.RelocalizationRequest.Warrant()
+        warrant.CopyFrom(self.config.collector.warrants.to_sf)
+
+        hits, misses = peer.warrants_cache.hits, peer.warrants_cache.misses
+        self.assertTrue(peer._warrant_is_valid(warrant))
+        self.assertTrue(peer._warrant_is_valid(warrant))
+        self.assertEqual(peer.warrants_cache.hits, hits+1)
+        self.assertEqual(peer.warrants_cache.misses, misses+1)
+
+        # invalid warrants should not be remembered
+        warrant.act.target = b"PEP3 researcher"
+        self.assertFalse(peer._warrant_is_valid(warrant))
+        self.assertFalse(peer._warrant_is_valid(warrant))
+        self.assertEqual(peer.warrants_cache.misses, misses+3)
+
+    def test_store_window(self):
+        collector = self.collector.grpc_servicer
+        store_processor = self.sf.grpc_servicer.store_processor
+        self.assertEqual(collector.window.max_requests, 64)
+
+        # requests with one record don't fill a batch of the caches, 
+        # so with small windows this would hang without flushing
+        collector.window.max_requests = 2
+        store_processor.window.max_records = 3
+        store_processor.batched_decryption = False
+
+        requests = [ self._small_store_request() for i in range(10) ]
+
+        updates = list(self.collector.connect_to('collector').Store(
+                iter(requests)))
+        self.assertEqual(sorted([ update.stored_id for update in updates ]),
+                sorted([ request.id for request in requests ]))
+        self.assertEqual(len(collector.window), 0)
+        self.assertEqual(store_processor.window.records(), 0)
+
+    def test_store_invalid_requests(self):
+        collector = self.collector.grpc_servicer
+        collector.window.max_requests = 1
+
+        # invalid requests should not take up room in the window
+        for i in range(3):
+            request = self._small_store_request()
+            request.records[0].destination_ip.state \
+                    = pep3_pb2.Pseudonymizable.ENCRYPTED_PSEUDONYM
+            with self.assertRaises(grpc.RpcError) as cm:
+                list(self.collector.connect_to('collector').Store(
+                    iter([ request ])))
+            self.assertEqual(cm.exception.code(), 
+                    grpc.StatusCode.INVALID_ARGUMENT)
+            self.assertEqual(len(collector.window), 0)
+            self.assertNotIn(request.id, 
+                    collector.request_id_to_feedback_queue)
+
+        request = self._small_store_request()
+        updates = list(self.collector.connect_to('collector').Store(
+                iter([ request ])))
+        self.assertEqual([ update.stored_id for update in updates ],
+                [ request.id ])
+
+    def test_store_streams(self):
+        collector = self.collector.grpc_servicer
+        store_processor = self.sf.grpc_servicer.store_processor
+        self.assertEqual(len(collector.process_queue_futs), 2)
+        self.assertEqual(len(store_processor.process_queue_futs), 2)
+
+        # small requests are only sent on by the storage facility's cache
+        # when all streams from the collector are flushed
+        store_processor.batched_decryption = False
+
+        def store(results):
+            requests = [ self._small_store_request() for i in range(5) ]
+            updates = self.collector.connect_to('collector').Store(
+                    iter(requests))
+            results.append(( [ request.id for request in requests ],
+                [ update.stored_id for update in updates ] ))
+
+        # each caller should get the feedback on its own requests
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+            for fut in [ ex.submit(store, results) for i in range(4) ]:
+                fut.result()
+
+        self.assertEqual(len(results), 4)
+        for request_ids, stored_ids in results:
+            self.assertEqual(sorted(stored_ids), sorted(request_ids))
+        self.assertEqual(len(collector.request_id_to_feedback_queue), 0)
+        self.assertEqual(len(collector.window), 0)
+        self.assertEqual(len(store_processor.window), 0)
+
+    def _small_store_request(self):
+        request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        flowrecord = request.records.add()
+        for ip in (flowrecord.source_ip, flowrecord.destination_ip):
+            ip.data = os.urandom(16)
+            ip.state = pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME
+        return request
+
+    def test_store_database(self):
+        db = self.g.contexts[('database',None)]
+        db.config.max_records_per_transaction = 3
+
+        requests = []
+        for size in (2, 1, 2, 1, 4):
+            request = pep3_pb2.StoreRequest(id=os.urandom(16))
+            for i in range(size):
+                flowrecord = request.records.add()
+                flowrecord.source_ip.data = os.urandom(32)
+                flowrecord.destination_ip.data = os.urandom(32)
+                flowrecord.anonymous_part.number_of_packets = i+1
+                flowrecord.anonymous_part.number_of_bytes = 2**32-1
+            requests.append(request)
+
+        feedback = list(self.sf.connect_to('database')\
+                .Store(iter(requests)))
+        self.assertEqual([ fb.stored_id for fb in feedback ],
+                [ request.id for request in requests ])
+
+        rows = db.grpc_servicer.engine.execute("""SELECT p_src_ip, p_dst_ip,
+            packets, bytes FROM peped_flows""").fetchall()
+        self.assertEqual(sorted(rows), sorted([ (record.source_ip.data, 
+            record.destination_ip.data, 
+            record.anonymous_part.number_of_packets,
+            record.anonymous_part.number_of_bytes) 
+                for request in requests for record in request.records ]))
+
+    def test_store_duplicates(self):
+        store_processor = self.sf.grpc_servicer.store_processor
+        self.assertEqual(store_processor.pseudonym_index, None)
+        store_processor.pseudonym_index = storage_facility.PseudonymIndex(2)
+
+        request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        source_ip, destination_ip = os.urandom(16), os.urandom(16)
+        for number_of_bytes in (1, 1, 2):
+            flowrecord = request.records.add()
+            flowrecord.source_ip.data = source_ip
+            flowrecord.source_ip.state \
+                    = pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME
+            flowrecord.destination_ip.data = destination_ip
+            flowrecord.destination_ip.state \
+                    = pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME
+            flowrecord.anonymous_part.number_of_bytes = number_of_bytes
+
+        for batched_decryption in (True, False):
+            store_processor.batched_decryption = batched_decryption
+            request.id = os.urandom(16)
+            updates = list(self.collector.connect_to('collector').Store(
+                    iter([ request ])))
+            self.assertEqual([ update.stored_id for update in updates ],
+                    [ request.id ])
+            self.assertEqual(len(updates[0].errors), 0)
+
+        db = self.g.contexts[('database',None)]
+        rows = db.grpc_servicer.engine.execute("""SELECT bytes 
+            FROM peped_flows""").fetchall()
+        self.assertEqual(sorted(rows), [ (1,), (2,) ])
+        self.assertEqual(len(store_processor.pseudonym_index), 2)
+
+        # the pseudonym is forgotten once other ones take its place
+        other_request = pep3_pb2.StoreRequest(id=os.urandom(16))
+        other_request.records.extend(request.records)
+        for flowrecord in other_request.records:
+            flowrecord.source_ip.data = os.urandom(16)
+        for r in (other_request, request):
+            r.id = os.urandom(16)
+            list(self.collector.connect_to('collector').Store(iter([ r ])))
+        rows = db.grpc_servicer.engine.execute("""SELECT bytes 
+            FROM peped_flows""").fetchall()
+        self.assertEqual(len(rows), 2+3+2)
+
     def test_store_and_retrieve(self):
         # first store a record with random source and target ip addresses,
         # and see if we can recover it.
@@ -95,6 +379,16 @@ class pep3test(unittest.TestCase):
         self.assertEqual(len(updates),1)
         self.assertEqual(updates[0].stored_id, col_request.id)
 
+        # and once more, without batched decryption at the SF
+        store_processor = self.sf.grpc_servicer.store_processor
+        self.assertTrue(store_processor.batched_decryption)
+        store_processor.batched_decryption = False
+        col_request.id = os.urandom(16)
+        updates = list(self.collector.connect_to('collector').Store(
+                iter([ col_request ])))
+        self.assertEqual(len(updates),1)
+        self.assertEqual(updates[0].stored_id, col_request.id)
+
         query = pep3_pb2.SqlQuery()
 
         # manually compute storage_facility-local pseudonyms for query
@@ -120,7 +414,7 @@ class pep3test(unittest.TestCase):
         ip.data = ( ed25519.Point.lizard(
                 flowrecord.source_ip.data)*s ).pack()
         ip.state = pep3_pb2.Pseudonymizable.UNENCRYPTED_PSEUDONYM
-        
+
         row = self.sf.connect_to('database')\
                 .Query(query).next().rows[0]
 
@@ -148,10 +442,17 @@ class pep3test(unittest.TestCase):
         query.parameters['ip'].pseudonymizable_value.data \
                 = ( ed25519.Point.lizard(flowrecord.source_ip.data)*s ).pack()
         
-        row = self.researcher.connect_to('researcher')\
-                .Query(query).next().rows[0]
-
-        self.assertEqual(row.cells[0].pseudonymizable_value.data,
+        # (the flowrecord was stored three times, but its pseudonyms
+        # are relocalized only once)
+        chunks = list(self.researcher.connect_to('researcher')\
+                .Query(query))
+        rows = [ row for chunk in chunks for row in chunk.rows ]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(sum([ len(chunk.pseudonyms) 
+            for chunk in chunks ]), 0)
+
+        for row in rows:
+            self.assertEqual(row.cells[0].pseudonymizable_value.data,
                 ( ed25519.Point.lizard(flowrecord.destination_ip.data)*s
                     ).pack())
 
@@ -159,6 +460,59 @@ class pep3test(unittest.TestCase):
     def test_depseudonymize(self):
         ip = os.urandom(16)
 
+        result = self.investigator.connect_to("investigator")\
+                .Depseudonymize(self._create_warrant(ip))
+
+        self.assertEqual(result.data, ip)
+
+    def test_depseudonymize_bulk(self):
+        ips = [ os.urandom(16) for i in range(3) ]
+        warrants = [ self._create_warrant(ip) for ip in ips ]
+        warrants.append(warrants[0])
+
+        results = list(self.investigator.connect_to("investigator")\
+                .DepseudonymizeBulk(iter(warrants)))
+
+        self.assertEqual([ result.data for result in results ],
+                ips + ips[:1])
+
+    def test_depseudonymize_with_invalid_proof(self):
+        peers = self.config.peers
+
+        request = pep3_pb2.DepseudonymizationRequest()
+        request.warrant.CopyFrom(self._create_warrant(os.urandom(16)))
+        request.which_shards.extend(peers['A'].shards)
+        response = self.investigator.connect_to("peer", "A")\
+                .Depseudonymize(request)
+        
+        link = request.chain.add()
+        link.peer = 'A'
+        link.which_shards.extend(peers['A'].shards)
+        link.peer_response.CopyFrom(response)
+
+        request.ClearField('which_shards')
+        request.which_shards.extend(
+                set(peers['B'].shards) - set(peers['A'].shards))
+        for reminder in self.investigator.reminders['B']:
+            if reminder.shard in peers['A'].shards \
+                    and reminder.HasField("pseudonym"):
+                request.reminders.add().CopyFrom(reminder)
+
+        self.investigator.connect_to("peer", "B").Depseudonymize(request)
+
+        # change the scalar of the last DHT proof of the rs proof
+        rs_proof = bytearray(link.peer_response.rs_proof)
+        rs_proof[-32] ^= 1
+        link.peer_response.rs_proof = bytes(rs_proof)
+
+        with self.assertRaises(grpc.RpcError) as cm:
+            self.investigator.connect_to("peer", "B").Depseudonymize(request)
+        self.assertEqual(cm.exception.code(), 
+                grpc.StatusCode.PERMISSION_DENIED)
+        self.assertEqual(cm.exception.details(),
+                "could not verify the rs proof of link #0.")
+
+    def _create_warrant(self, ip):
         # manually compute investigator-local pseudonym
         pseudonym_secrets = {}
         for peer_secrets in self.secrets.peers.values():
@@ -188,10 +542,43 @@ class pep3test(unittest.TestCase):
                     self.secrets.root_certificate_keys.warrants),
                 warrant.act.SerializeToString(), 'sha256')
 
-        result = self.investigator.connect_to("investigator")\
-                .Depseudonymize(warrant)
+        return warrant
 
-        self.assertEqual(result.data, ip)
+
+# the same tests, but with the servers using grpc.aio
+@unittest.skipUnless(hasattr(grpc, "aio"), "grpc.aio is not available")
+class pep3asynciotest(pep3test):
+    asyncio = True
+
+    def test_idle_streams(self):
+        stub = self.collector.connect_to('collector')
+
+        # more idle Store streams than the collector has threads
+        event = threading.Event()
+        def idle():
+            event.wait()
+            return
+            yield
+
+        calls = [ stub.Store(idle()) for i 
+                in range(4*self.config.collector.number_of_threads) ]
+
+        try:
+            request = pep3_pb2.StoreRequest(id=os.urandom(16))
+            flowrecord = request.records.add()
+            flowrecord.source_ip.data = os.urandom(16)
+            flowrecord.source_ip.state \
+                    = pep3_pb2.Pseudonymizable.UNENCRYPTED_NAME
+            flowrecord.destination_ip.CopyFrom(flowrecord.source_ip)
+
+            updates = list(stub.Store(iter([ request ]), timeout=30))
+            self.assertEqual(len(updates), 1)
+            self.assertEqual(updates[0].stored_id, request.id)
+        finally:
+            event.set()
+
+        for call in calls:
+            self.assertEqual(list(call), [])
 
 
 pep3.raise_nofile_limit()
@@ -0,0 +1,122 @@
+import unittest
+import io
+import os
+import contextlib
+import tempfile
+import gzip
+import struct
+
+import pep3_collect
+import pep3_pb2
+
+CSV = b"""serial,src_ip,dst_ip,sport,dport,protocol,tstart,tend,packets,bytes,tcp_flags
+1,1.2.3.4,5.6.7.8,80,1234,6,1500000000000,1500000000100,3,180,0
+2, 10.0.0.1 ,::1,0,53,17,18446744073709551615,0,1,60,x\r
+3,2001:db8::1,255.255.255.255,+443,65535,6,1,2,0,4294967295,
+7,0.0.0.0,1.1.1.1,1,2,3,4,5,6,7,0
+8,9.9.9.9,8.8.8.8,1,2,3,4,5,6,7,0"""
+
+def varint(n):
+    result = bytearray()
+    while n >= 0x80:
+        result.append((n & 0x7f) | 0x80)
+        n >>= 7
+    result.append(n)
+    return bytes(result)
+
+class TestCollect(unittest.TestCase):
+    def parse(self, batches, data, batchsize, **kwargs):
+        inputf = io.BufferedReader(io.BytesIO(data))
+        handlers = pep3_collect.parse_header("test.csv",
+                inputf.readline().decode('utf-8'))
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            result = list(batches(inputf, handlers, batchsize, **kwargs))
+        return result, stdout.getvalue()
+
+    def parse_columnar(self, data, batchsize, **kwargs):
+        return self.parse(lambda inputf, handlers, batchsize, **kwargs:
+                pep3_collect.columnar_batches(inputf, "test.csv",
+                    handlers, batchsize, **kwargs),
+                data, batchsize, **kwargs)
+
+    def test_columnar_batches(self):
+        # the rowwise parser keeps track of the serial numbers it saw
+        pep3_collect.HEADER_NAME_TO_HANDLER["serial"]._last = None
+
+        for batchsize in (1, 2, 5, 512):
+            expected = self.parse(pep3_collect.rowwise_batches,
+                    CSV, batchsize)
+            pep3_collect.HEADER_NAME_TO_HANDLER["serial"]._last = None
+
+            self.assertEqual(sum([ len(request.records)
+                for request in expected[0] ]), 5)
+            self.assertEqual(expected[1],
+                    "WARNING: jump from serial number 3 to 7\n")
+
+            # make sure lines are split over several chunks
+            for chunksize in (1, 7, 2**20):
+                self.assertEqual(self.parse_columnar(CSV, batchsize,
+                        chunksize=chunksize), expected)
+
+    def test_columnar_batches_errors(self):
+        for line in (b"4,1.2.3.4,5.6.7.8,1,2,3,4,5,6,7",
+                b"4,1.2.3.4,5.6.7.8,1,2,3,4,5,6,7,0,0",
+                b"4,1.2.3.4,5.6.7.8,1,2,3,4,5,6,-7,0",
+                b"4,1.2.3.4,5.6.7.8,1,2,3,4,5,6,4294967296,0",
+                b"4,1.2.3.256,5.6.7.8,1,2,3,4,5,6,7,0",
+                b"",):
+            with self.assertRaisesRegex(ValueError, "^test.csv:4:"):
+                self.parse_columnar(CSV.replace(b"\n7,",
+                    b"\n" + line + b"\n7,"), 2)
+
+    def test_formats(self):
+        expected, _ = self.parse(pep3_collect.rowwise_batches, CSV, 2)
+        records = [ record for request in expected 
+                for record in request.records ]
+
+        flowrecords = b"".join([ bytes([record.ByteSize()]) 
+            + record.SerializeToString() for record in records ])
+        storerequests = b"".join([ varint(request.ByteSize())
+            + request.SerializeToString() for request in expected ])
+        binary = b"".join([ struct.pack(">16s16sQQIIHHB3x",
+            record.source_ip.data, record.destination_ip.data,
+            record.anonymous_part.start_time,
+            record.anonymous_part.end_time,
+            record.anonymous_part.number_of_packets,
+            record.anonymous_part.number_of_bytes,
+            record.anonymous_part.source_port,
+            record.anonymous_part.destination_port,
+            record.anonymous_part.protocol) for record in records ])
+        self.assertEqual(len(binary), 5*64)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, data in (("flows.csv", CSV),
+                    ("flows.csv.gz", gzip.compress(CSV)),
+                    ("flows", gzip.compress(CSV)),
+                    ("flows.flowrecords", flowrecords),
+                    ("flows.storerequests", storerequests),
+                    ("flows.bin.gz", gzip.compress(binary))):
+                path = os.path.join(tmpdir, name)
+                with open(path, "wb") as f:
+                    f.write(data)
+
+                with contextlib.ExitStack() as stack, \
+                        contextlib.redirect_stdout(io.StringIO()):
+                    inputf = pep3_collect.open_input(path, "auto", stack)
+                    self.assertEqual(list(pep3_collect.read_batches(
+                        inputf, path, "auto", 2)), expected, name)
+
+            # a truncated record at the end
+            path = os.path.join(tmpdir, "truncated.bin")
+            with open(path, "wb") as f:
+                f.write(binary[:-1])
+            with contextlib.ExitStack() as stack:
+                inputf = pep3_collect.open_input(path, "none", stack)
+                with self.assertRaisesRegex(ValueError, 
+                        f"^{path}:5: this record is truncated"):
+                    list(pep3_collect.read_batches(inputf, path, "auto", 2))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
@@ -0,0 +1,53 @@
+import unittest
+import os
+import tempfile
+
+import pep3_pb2
+import pseudonymstore
+
+class TestPseudonymStore(unittest.TestCase):
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "pseudonyms.sqlite")
+            ips = [ os.urandom(16) for i in range(4) ]
+            pseudonyms = [ pep3_pb2.Pseudonymizable(data=os.urandom(96),
+                state=pep3_pb2.Pseudonymizable.ENCRYPTED_PSEUDONYM)
+                for i in range(4) ]
+
+            store = pseudonymstore.PseudonymStore(path, 3, b"fingerprint")
+            store.put_many(zip(ips[:2], pseudonyms[:2]))
+            self.assertEqual(store.get_many(ips), 
+                    dict(zip(ips[:2], pseudonyms[:2])))
+            self.assertEqual((store.hits, store.misses), (2, 2))
+
+            # ips[0] is used more recently than ips[1], so ips[1] should
+            # be evicted first
+            store.get_many(ips[:1])
+            store.put_many(zip(ips[2:], pseudonyms[2:]))
+            self.assertEqual(len(store), 3)
+            self.assertEqual(dict(store.most_recently_used(3)), 
+                    dict(zip(ips[:1] + ips[2:], 
+                        pseudonyms[:1] + pseudonyms[2:])))
+            self.assertEqual(store.most_recently_used(3)[2],
+                    (ips[0], pseudonyms[0]))
+
+            # replacing a pseudonym does not change the size of the store
+            store.put_many([ (ips[0], pseudonyms[1]) ])
+            self.assertEqual(len(store), 3)
+            self.assertEqual(store.get_many(ips[:1]), 
+                    { ips[0]: pseudonyms[1] })
+            store.close()
+
+            # the store should persist...
+            store = pseudonymstore.PseudonymStore(path, 3, b"fingerprint")
+            self.assertEqual(len(store), 3)
+            store.close()
+
+            # ... unless the fingerprint changes
+            store = pseudonymstore.PseudonymStore(path, 3, b"other")
+            self.assertEqual(len(store), 0)
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
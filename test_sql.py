@@ -1,4 +1,6 @@
 import unittest
+import random
+import importlib.resources
 import parsimonious
 import sql
 
@@ -98,6 +100,194 @@ class Grammar(unittest.TestCase):
                     FROM flowrecords
                     ORDER BY flowrecords.src_ip""")
 
+        # also not by position
+        check("""SELECT flowrecords.src_ip, SUM(flowrecords.bytes)
+                FROM flowrecords GROUP BY flowrecords.src_ip
+                ORDER BY 2 DESC LIMIT 10""")
+        for position in ("1", "(1)", "3", "0"):
+            with self.assertRaises(sql.InvalidQuery):
+                check("""SELECT flowrecords.src_ip, SUM(flowrecords.bytes)
+                        FROM flowrecords GROUP BY flowrecords.src_ip
+                        ORDER BY """ + position)
+
+
+    def test_cache(self):
+        db_desc = { 't': { 'a': 'plain', 'ip': 'pseudonymized' } }
+        query = "SELECT t.a, t.ip FROM t WHERE t.a = :x"
+
+        hits = sql._check_query_cached.cache_info().hits
+        result = sql.check_query(db_desc, { 'x': 'plain' }, query)
+        self.assertEqual(result, [ 'plain', 'pseudonymized' ])
+        result.append('plain')
+        self.assertEqual(sql.check_query(db_desc, { 'x': 'plain' }, query),
+                [ 'plain', 'pseudonymized' ])
+        self.assertEqual(sql._check_query_cached.cache_info().hits, hits+1)
+
+        # the parameter kinds and db_desc are part of the key
+        with self.assertRaises(sql.InvalidQuery):
+            sql.check_query(db_desc, { 'x': 'pseudonymized' }, query)
+        db_desc['t']['a'] = 'pseudonymized'
+        with self.assertRaises(sql.InvalidQuery):
+            sql.check_query(db_desc, { 'x': 'plain' }, query)
+
+    def test_results(self):
+        db_desc = { 't': { 'a': 'plain', 'ip': 'pseudonymized' } }
+        check = lambda q: sql.check_query(db_desc, { 'ip': 'pseudonymized' },
+                "SELECT " + q + " FROM t")
+
+        self.assertEqual(check("t.a, t.ip, SUM(t.a), COUNT(t.ip), -t.a"),
+                [ 'plain', 'pseudonymized', 'plain', 'plain', 'plain' ])
+
+        # the sum of pseudonyms and negated pseudonyms are not allowed
+        for q in ("SUM(t.ip)", "-t.ip", "-:ip", "t.a + -t.ip"):
+            with self.assertRaises(sql.InvalidQuery):
+                check(q)
+
+    def test_depth(self):
+        query = "SELECT t.a FROM t WHERE {}t.a = 1{}"
+        sql.parse(query.format("("*sql.MAX_DEPTH, ")"*sql.MAX_DEPTH))
+        with self.assertRaisesRegex(sql.InvalidQuery, "nested"):
+            sql.parse(query.format("("*(sql.MAX_DEPTH+1), 
+                ")"*(sql.MAX_DEPTH+1)))
+        with self.assertRaises(sql.InvalidQuery):
+            sql.parse("SELECT " + "-("*10000 + "1" + ")"*10000)
+
+    def test_parse(self):
+        select = sql.parse("""select T.A, -sum(t.b) from t, u
+            where not t.a = 1 and t.b < :x or (t.c = "a""b")
+            group by t.a order by 1 desc, t.b limit 5;""")
+
+        self.assertEqual([ (name.name, name.start, name.end) 
+            for name in select.tables ], [ ("t", 27, 28), ("u", 30, 31) ])
+        self.assertEqual((select.columns[0].table, select.columns[0].column),
+                ("t", "a"))
+        self.assertEqual(select.columns[1].op, "-")
+        self.assertEqual(select.columns[1].operand.function, "SUM")
+
+        # AND binds stronger than OR
+        self.assertEqual(select.where.op, "OR")
+        self.assertEqual(select.where.left.op, "AND")
+        self.assertEqual(select.where.left.left.op, "NOT")
+        self.assertEqual(select.where.right.right.value, 'a"b')
+
+        self.assertEqual([ direction for expr, direction 
+            in select.order_by ], [ "DESC", None ])
+        self.assertEqual(select.limit, 5)
+
+    def test_grammar_equivalence(self):
+        # The parser should accept exactly the queries described
+        # by resources/sql.grammar.  We compare the two on random
+        # (mostly invalid) variations of valid queries.
+        grammar = parsimonious.Grammar(importlib.resources.read_text(
+            "resources", "sql.grammar"))
+
+        def accepted_by_grammar(query):
+            try:
+                grammar.parse(query)
+                return True
+            except parsimonious.exceptions.ParseError:
+                return False
+
+        def accepted_by_parser(query):
+            try:
+                sql.parse(query)
+                return True
+            except sql.InvalidQuery:
+                return False
+
+        rng = random.Random(0)
+
+        def expr(depth=0):
+            choice = rng.randrange(9 if depth < 3 else 4)
+            if choice==0:
+                return rng.choice(("t.a", "T . b", "not.c", "sum.d"))
+            if choice==1:
+                return rng.choice(("1", "023", '"x"', '"a""b"', '""'))
+            if choice==2:
+                return rng.choice((":p", ":q1"))
+            if choice==3:
+                return "-" + expr(3)
+            if choice in (4, 5):
+                return expr(depth+1) + rng.choice("+-*/") + expr(depth+1)
+            if choice==6:
+                return "(" + expr(depth+1) + ")"
+            return rng.choice(("SUM", "count")) + "(" + expr(depth+1) + ")"
+
+        def bool_expr(depth=0):
+            choice = rng.randrange(5 if depth < 3 else 1)
+            if choice==0:
+                return expr(2) + rng.choice(("<=", "<>", "<", ">=", ">",
+                    "=")) + expr(2)
+            if choice==1:
+                return "NOT " + bool_expr(depth+1)
+            if choice==2:
+                return "(" + bool_expr(depth+1) + ")"
+            return bool_expr(depth+1) + rng.choice((" AND ", " or ")) \
+                    + bool_expr(depth+1)
+
+        def query():
+            q = "SELECT " + ", ".join([ expr() 
+                for i in range(rng.randrange(1,3)) ])
+            if rng.random() < .8:
+                q += " FROM t" + rng.choice(("", ", u"))
+            if rng.random() < .8:
+                q += " WHERE " + bool_expr()
+            if rng.random() < .3:
+                q += " GROUP BY " + expr()
+            if rng.random() < .3:
+                q += " ORDER BY " + expr() + rng.choice(("", " ASC", 
+                    " desc"))
+            if rng.random() < .3:
+                q += " LIMIT 10"
+            return q + rng.choice(("", ";", " -- comment\n", "\t"))
+
+        pieces = [ " ", "(", ")", "-", "NOT", "AND", ",", ".", ";", ":", 
+                "=", "<", "t.a", "1", '"', "--", "SUM", "FROM", "X" ]
+
+        accepted = 0
+        for i in range(3000):
+            q = query()
+            # mutate the query at some random positions
+            for j in range(rng.randrange(3)):
+                pos = rng.randrange(len(q)+1)
+                if rng.random() < .5:
+                    q = q[:pos] + rng.choice(pieces) + q[pos:]
+                else:
+                    q = q[:pos] + q[pos+rng.randrange(1,4):]
+
+            expected = accepted_by_grammar(q)
+            self.assertEqual(accepted_by_parser(q), expected, q)
+            accepted += expected
+
+        # make sure both valid and invalid queries were tried
+        self.assertGreater(accepted, 500)
+        self.assertLess(accepted, 2500)
+
+    def test_column_bounds(self):
+        bounds = lambda where, params={}: sql.column_bounds(
+                "SELECT t.a FROM t " + where, "t.time", params)
+
+        self.assertEqual(bounds(""), (None, None))
+        self.assertEqual(bounds("WHERE t.time >= 3"), (3, None))
+        self.assertEqual(bounds("WHERE t.time < :end", {'end': 7.5}),
+                (None, 7.5))
+        self.assertEqual(bounds("""WHERE 5 < T.TIME AND (t.a = :a
+            AND t.time <= 10) AND t.time < :end AND NOT t.time > 7""", 
+            { 'end': 20, 'a': 8 }), (5, 10))
+        self.assertEqual(bounds("WHERE t.time = 4 AND t.a = 1"), (4, 4))
+
+        # these say nothing about t.time
+        self.assertEqual(bounds("WHERE t.time > 3 OR t.a = 1"), (None, None))
+        self.assertEqual(bounds("WHERE t.time > t.a"), (None, None))
+        self.assertEqual(bounds("WHERE t.time > :x", {'x': b"x"}),
+                (None, None))
+        self.assertEqual(bounds("WHERE t.time > -3"), (None, None))
+
+    def test_replace_table(self):
+        self.assertEqual(sql.replace_table(
+            "SELECT t.a FROM t, T2 WHERE t.a = 1", "t2", "(SELECT 1) AS t2"),
+            "SELECT t.a FROM t, (SELECT 1) AS t2 WHERE t.a = 1")
+
 
 if __name__ == '__main__':
     unittest.main()
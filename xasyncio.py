@@ -0,0 +1,190 @@
+import asyncio
+import threading
+
+import grpc
+try:
+    import grpc.aio
+except ImportError:
+    pass # (grpcio < 1.32,) see Server
+from google.protobuf import descriptor_pb2
+
+# Helpers to serve the servicers using grpc.aio, see Configuration.asyncio.
+#
+# The methods of a servicer are still plain functions, which are run
+# on an executor, so that long-running (e.g. cryptographic) work does
+# not block the event loop.  The RPCs that take long but do little
+# (like streams that mostly wait for the next request) can be provided
+# by the servicer as coroutine (or async generator) <Method>_async too,
+# which are run on the event loop and so don't occupy a thread while
+# they wait.
+
+
+# Like grpc.Server, but serves RPCs with a grpc.aio.Server on an event
+# loop in a thread of its own.
+class Server:
+    def __init__(self, executor, options=()):
+        if not hasattr(grpc, "aio"):
+            raise RuntimeError("serving with asyncio requires grpc.aio, "
+                    f"which grpcio {grpc.__version__} does not provide")
+
+        self.executor = executor
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                name="asyncio server", daemon=True)
+        self._thread.start()
+
+        # (grpc.aio.server uses the event loop of the calling thread)
+        async def create():
+            return grpc.aio.server(options=options)
+        self._server = self.run(create())
+
+    # runs the given coroutine on the event loop, and returns its result
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def add_secure_port(self, address, server_credentials):
+        return self._server.add_secure_port(address, server_credentials)
+
+    def add_generic_rpc_handlers(self, generic_rpc_handlers):
+        self._server.add_generic_rpc_handlers(generic_rpc_handlers)
+
+    def start(self):
+        self.run(self._server.start())
+
+    def stop(self, grace):
+        if threading.current_thread()==self._thread:
+            self.loop.create_task(self._server.stop(grace))
+            return
+        self.run(self._server.stop(grace))
+
+    # stops the event loop;  the server should have been stopped
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+# Adds servicer to server using add_function (e.g.
+# pep3_pb2_grpc.add_PeerServicer_to_server,) where service is the
+# ServiceDescriptor of the servicer.
+def add_servicer_to_server(servicer, service, add_function, server):
+    add_function(_Servicer(servicer, service, server), server)
+
+class _Servicer:
+    def __init__(self, servicer, service, server):
+        self._servicer = servicer
+        self._service = service
+        self._server = server
+
+    def __getattr__(self, name):
+        native = getattr(self._servicer, name+"_async", None)
+        if native!=None:
+            return native
+
+        method = getattr(self._servicer, name)
+        descriptor = descriptor_pb2.MethodDescriptorProto()
+        self._service.methods_by_name[name].CopyToProto(descriptor)
+        executor = self._server.executor
+        loop = self._server.loop
+
+        def call(request, context):
+            if descriptor.client_streaming:
+                request = SyncIterator(request, loop)
+            return method(request, SyncContext(context, loop))
+
+        if not descriptor.server_streaming:
+            async def unary(request, context):
+                return await loop.run_in_executor(executor,
+                        call, request, context)
+            return unary
+
+        async def stream(request, context):
+            it = iter(await loop.run_in_executor(executor,
+                call, request, context))
+            fut = None
+            try:
+                while True:
+                    fut = executor.submit(next, it, _END)
+                    item = await asyncio.wrap_future(fut)
+                    if item is _END:
+                        return
+                    yield item
+            finally:
+                # e.g. when the call is cancelled;  the generator can
+                # only be closed once it's not running
+                if hasattr(it, "close"):
+                    if fut==None:
+                        it.close()
+                    else:
+                        fut.add_done_callback(lambda fut: it.close())
+        return stream
+
+_END = object()
+
+
+# The iterator over the requests passed to a servicer's method
+# (which runs on an executor) for the given asynchronous iterator.
+class SyncIterator:
+    def __init__(self, aiterator, loop):
+        self._aiterator = aiterator.__aiter__()
+        self._loop = loop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return asyncio.run_coroutine_threadsafe(
+                    self._aiterator.__anext__(), self._loop).result()
+        except StopAsyncIteration:
+            raise StopIteration
+
+
+# The context passed to a servicer's method (which runs on an executor)
+# for the given grpc.aio.ServicerContext, whose abort is a coroutine.
+class SyncContext:
+    def __init__(self, context, loop=None):
+        if loop==None:
+            loop = asyncio.get_event_loop()
+        self._context = context
+        self._loop = loop
+
+    def abort(self, code, details):
+        asyncio.run_coroutine_threadsafe(
+                self._context.abort(code, details), self._loop).result()
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+
+# Like xqueue.Queue, but get is a coroutine.  The queue should be 
+# created on the event loop on which get is awaited;  the other methods
+# may be called from any thread.
+class Queue:
+    def __init__(self):
+        self._loop = asyncio.get_event_loop()
+        self._queue = asyncio.Queue()
+        self._stopped = False
+
+    async def get(self):
+        if self._stopped:
+            return None, True
+        item = await self._queue.get()
+        if self._stopped:
+            # wake the next waiter (if there is one)
+            self._queue.put_nowait(None)
+            return None, True
+        return item, False
+
+    def stop(self):
+        if self._stopped: return
+        self._stopped = True
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    def put(self, item):
+        if not self._stopped:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+
+# runs fn(*args) on the executor, and returns (a future for) its result
+def run(executor, fn, *args):
+    return asyncio.get_event_loop().run_in_executor(executor, fn, *args)
@@ -17,6 +17,16 @@ class Queue:
             return None, True
         return item, False
 
+    # like get(), but raises queue.Empty instead of waiting
+    def get_nowait(self):
+        if self._stopped:
+            return None, True
+        item = self._simplequeue.get(block=False)
+        if self._stopped:
+            self._simplequeue.put(None) 
+            return None, True
+        return item, False
+
     def stop(self):
         if self._stopped: return
         self._stopped = True
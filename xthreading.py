@@ -115,6 +115,18 @@ class Cache:
         self._emit_batches(batches)
         self._prune()
 
+    # puts the given (item, value) pairs in the cache as if they were 
+    # computed by the constructor (most recently the last), e.g. to warm
+    # it up;  items already in the cache are skipped.
+    def preload(self, items_and_values):
+        with self._lock:
+            for item, value in items_and_values:
+                if item in self._on_hand or item in self._in_progress \
+                        or item in self._in_line_set:
+                    continue
+                self._on_hand[item] = error.ErrorOr(value=value)
+        self._prune()
+
     def flush(self, callback=None):
         self.request((), callback, flush=True)
 
@@ -264,3 +276,64 @@ class Cache:
         @property
         def key(self):
             return self.args[0]
+
+
+# Limits the number of requests that are "in flight," i.e. that have been
+# accepted, but not yet acknowledged, and the total number of records
+# in them;  a limit of 0 means no limit.  A request that exceeds the limit
+# on the number of records by itself is accepted when nothing else is
+# in flight.
+class Window:
+    def __init__(self, max_requests=0, max_records=0):
+        self.max_requests = max_requests
+        self.max_records = max_records
+        self._cond = threading.Condition()
+        self._in_flight = {} # maps request id to its number of records
+        self._records = 0
+        self._stopped = False
+
+    # Adds the request with the given id and number of records, waiting
+    # (if block is set) until there is room for it.  Returns False when 
+    # it was not added, because there was no room and block wasn't set,
+    # or because the window was stopped.
+    def acquire(self, request_id, records, block=True):
+        with self._cond:
+            while not self._has_room_for(records):
+                if not block or self._stopped:
+                    return False
+                self._cond.wait()
+            if self._stopped:
+                return False
+            self._in_flight[request_id] = records
+            self._records += records
+            return True
+
+    # to be called when the request with the given id is acknowledged
+    def release(self, request_id):
+        with self._cond:
+            records = self._in_flight.pop(request_id, None)
+            if records==None:
+                return
+            self._records -= records
+            self._cond.notify_all()
+
+    # makes all current and future calls to acquire return False
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _has_room_for(self, records):
+        if len(self._in_flight)==0:
+            return True
+        if self.max_requests>0 and len(self._in_flight)>=self.max_requests:
+            return False
+        if self.max_records>0 and self._records+records>self.max_records:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def records(self):
+        return self._records